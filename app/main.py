@@ -1,19 +1,73 @@
-from fastapi import FastAPI, Request, Form, UploadFile, File
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
 from pathlib import Path
-from app.models.db import init_db, get_conn
-from app.services.patterns_engine import load_patterns_from_dir, parse_yaml
-from app.services.renderer import render_placeholder_chart, render_chart_png
-from app.services.scanner import run_scan
-from app.services.scheduler import start_scheduler
-import yaml
+from app.models.db import init_db, get_conn, submit_write
+from app.metrics import render_prometheus
+from datetime import datetime
+import asyncio
 import os
+import re
+import json
+import logging
+import threading
+from datetime import timedelta
+
+# Services (pandas, numpy, PIL, yaml, ccxt, ...) are imported inside the
+# endpoints that use them, so importing the app stays cheap; see
+# bench/import_time.py for the budget.
 
 APP_DIR = Path(__file__).parent
 ROOT = APP_DIR.parent
 
-app = FastAPI(title="SMC Pattern Scanner (Skeleton)")
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the DB; unless APP_ROLE=web, also run the scanner in this process (see app/worker.py)."""
+    init_db()
+    background = os.getenv('APP_ROLE', 'all') != 'web'
+    if background:
+        from app.worker import start_background
+        start_background()
+    yield
+    if background:
+        from app.worker import stop_background
+        stop_background()
+
+
+app = FastAPI(title="SMC Pattern Scanner (Skeleton)", lifespan=lifespan)
+
+
+# Event charts are rendered on first request (declared before the /storage mount)
+@app.get("/storage/images/{name}")
+def storage_image(name: str):
+    name = os.path.basename(name)
+    path = ROOT / "storage" / "images" / name
+    if path.is_file():
+        return FileResponse(path)
+    m = re.match(r"event_(\d+)_.*\.png$", name)
+    if not m:
+        raise HTTPException(status_code=404)
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT id, symbol, timeframe, created_at FROM events WHERE id=?", (int(m.group(1)),)
+    ).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404)
+    try:
+        until = datetime.fromisoformat(str(row['created_at']))
+    except Exception:
+        until = datetime.utcnow()
+    from app.services.data import get_ohlcv_df_until
+    from app.services.renderer import render_event_chart
+    df = get_ohlcv_df_until(row['symbol'], row['timeframe'], until)
+    out = render_event_chart(row['symbol'], row['timeframe'], row['id'], df)
+    return FileResponse(out)
+
+
 app.mount("/static", StaticFiles(directory=APP_DIR / "web" / "static"), name="static")
 app.mount("/storage", StaticFiles(directory=ROOT / "storage"), name="storage")
 
@@ -69,6 +123,8 @@ def patterns_table():
 
 @app.post("/patterns/upload", response_class=HTMLResponse)
 async def patterns_upload(yaml: str = Form(...)):
+    from app.services.patterns_engine import parse_yaml
+    from app.services.pattern_registry import invalidate_patterns
     # parse and save
     try:
         d = parse_yaml(yaml)
@@ -83,16 +139,26 @@ async def patterns_upload(yaml: str = Form(...)):
         (name, version, yaml, 1),
     )
     conn.commit()
+    invalidate_patterns()
     return patterns_table()
 
 @app.post("/patterns/media/upload", response_class=HTMLResponse)
 async def patterns_media_upload(pattern_id: int = Form(...), file: UploadFile = File(...)):
+    from app.services.pattern_registry import invalidate_patterns
+    from app.services.scoring import invalidate_templates
+    from app.services.template_index import get_index
     content = await file.read()
     safe_name = f"p{pattern_id}_" + os.path.basename(file.filename).replace(' ', '_')
     out_dir = ROOT / "storage" / "patterns"
     out_dir.mkdir(parents=True, exist_ok=True)
     out_path = out_dir / safe_name
     out_path.write_bytes(content)
+    invalidate_templates(out_path)
+    try:
+        get_index().add(f"storage/patterns/{safe_name}")
+    except OSError:
+        # the index is a cache: the next scan's sync embeds the template
+        logger.exception("could not add %s to the template index", safe_name)
     width = height = None
     mime = file.content_type or "image/png"
     try:
@@ -107,6 +173,7 @@ async def patterns_media_upload(pattern_id: int = Form(...), file: UploadFile =
         (pattern_id, 'template', f"storage/patterns/{safe_name}", mime, width, height),
     )
     conn.commit()
+    invalidate_patterns()
     return patterns_table2()
 
 @app.get("/patterns/media/{pattern_id}", response_class=HTMLResponse)
@@ -268,6 +335,10 @@ def alerts_table2():
 
 @app.post("/scan/run", response_class=HTMLResponse)
 async def scan_run(symbol: str = Form(...), timeframe: str = Form(...)):
+    from app.services.notifier import save_alert_record
+    from app.services.patterns_engine import load_patterns_from_dir
+    from app.services.renderer import render_placeholder_chart
+    from app.services.scoring import score_simple
     # This is a stub: loads patterns and creates a fake "match" with score
     patterns = load_patterns_from_dir(Path("patterns"))
     if not patterns:
@@ -275,17 +346,16 @@ async def scan_run(symbol: str = Form(...), timeframe: str = Form(...)):
     # choose the first pattern and compute a simple score
     p = patterns[0]
     score = score_simple(p)
-    # create event
-    conn = get_conn()
-    cur = conn.execute(
+    # create event through the writer thread: an uncommitted insert on this
+    # thread's connection would hold SQLite's write lock and stall it
+    event_id = await asyncio.wrap_future(submit_write(lambda c: c.execute(
         "INSERT INTO events (symbol, timeframe, pattern_name, score, status) VALUES (?,?,?,?,?)",
         (symbol, timeframe, p.get('name','Unnamed'), score, 'sent')
-    )
-    event_id = cur.lastrowid
+    ).lastrowid))
     # render a placeholder chart image
     img_path = render_placeholder_chart(symbol, timeframe, event_id)
-    # record alert
-    save_alert_record(event_id, img_path)
+    # record alert (committed before the response)
+    await asyncio.wrap_future(save_alert_record(event_id, img_path))
     html = f"""
     <div class='card'>
       <div>✅ Scan complete for <b>{symbol} {timeframe}</b>.</div>
@@ -297,6 +367,7 @@ async def scan_run(symbol: str = Form(...), timeframe: str = Form(...)):
 
 @app.post("/scan/run2", response_class=HTMLResponse)
 async def scan_run2(symbol: str = Form(...), timeframe: str = Form(...)):
+    from app.services.scanner import run_scan
     try:
         name, score, eff_threshold, img_path = run_scan(symbol, timeframe)
     except Exception as e:
@@ -311,10 +382,72 @@ async def scan_run2(symbol: str = Form(...), timeframe: str = Form(...)):
     """
     return HTMLResponse(html)
 
+@app.post("/api/backtest/run")
+async def backtest_run(request: Request):
+    # body: {"pattern": name|path, "symbols": [...], "timeframe": "1h", "days": 30, "horizons": [5,10,20], "threshold": 0.7}
+    from app.services.backtest import DEFAULT_HORIZONS, compile_rules, create_run, load_pattern, run_backtest
+    body = await request.json()
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="expected a JSON object")
+    symbols = body.get('symbols') or []
+    timeframe = body.get('timeframe')
+    if not isinstance(symbols, list) or not isinstance(body.get('pattern', ''), str):
+        raise HTTPException(status_code=400, detail="symbols must be a list and pattern a string")
+    if not body.get('pattern') or not symbols or not timeframe:
+        raise HTTPException(status_code=400, detail="pattern, symbols and timeframe are required")
+    try:
+        pattern = load_pattern(body['pattern'])
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    try:
+        compile_rules(pattern)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    name = pattern.get('name', body['pattern'])
+    try:
+        days = float(body.get('days', 30))
+        horizons = [int(h) for h in body.get('horizons') or DEFAULT_HORIZONS]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="days must be a number and horizons a list of integers")
+    if not days > 0 or not all(h > 0 for h in horizons):
+        raise HTTPException(status_code=400, detail="days and horizons must be positive")
+    until = datetime.utcnow()
+    try:
+        since = until - timedelta(days=days)
+    except OverflowError:
+        raise HTTPException(status_code=400, detail="days is out of range")
+    run_id = create_run(name, symbols, timeframe, since, until, horizons)
+    threading.Thread(
+        target=run_backtest,
+        args=(body['pattern'], symbols, timeframe),
+        kwargs=dict(days=days, until=until, horizons=horizons, threshold=body.get('threshold'), run_id=run_id),
+        daemon=True,
+    ).start()
+    return {"run_id": run_id, "status": "running"}
+
+@app.get("/api/backtest/{run_id}")
+def backtest_get(run_id: int, limit: int = 500):
+    conn = get_conn()
+    run = conn.execute("SELECT * FROM backtest_runs WHERE id=?", (run_id,)).fetchone()
+    if run is None:
+        raise HTTPException(status_code=404)
+    rows = conn.execute(
+        "SELECT symbol, bar_time, score, entry, returns_json, mfe, mae FROM backtest_results "
+        "WHERE run_id=? ORDER BY symbol, bar_time LIMIT ?",
+        (run_id, limit),
+    ).fetchall()
+    out = dict(run)
+    out['params'] = json.loads(out.pop('params_json') or '{}')
+    out['summary'] = json.loads(out.pop('summary_json') or '{}')
+    out['results'] = [dict(r, returns=json.loads(r['returns_json'])) for r in rows]
+    for r in out['results']:
+        r.pop('returns_json')
+    return out
+
 @app.get("/api/health")
 def health():
     return {"status": "ok"}
 
-# ---- App startup: ensure DB and folders ----
-init_db()
-start_scheduler()
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def api_metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
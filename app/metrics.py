@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+"""In-process counters, gauges and histograms, rendered as Prometheus text.
+
+Metrics are created on first use and keyed by name plus labels:
+
+    metrics.inc('scans_total', result='scored')
+    metrics.observe('scan_seconds', 0.12)
+    with metrics.timer('scan_stage_seconds', stage='fetch'):
+        ...
+
+`render_prometheus()` backs `/api/metrics`. Values live in the process that
+recorded them: with `"scan_pool": "process"` the per-scan metrics stay in
+the worker processes, and only cycle-level metrics reach the endpoint.
+
+This module imports nothing from the app, so any layer (models included)
+can record metrics without depending on the services.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+PREFIX = 'smc_'
+
+# seconds; covers sub-ms stages up to scans near scan_timeout_sec
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HELP = {
+    'scans_total': 'Scans by outcome (scored, dedup, error).',
+    'scan_seconds': 'End-to-end run_scan duration.',
+    'scan_stage_seconds': 'run_scan duration per stage.',
+    'score_fallback_total': 'Patterns that could not be scored and were skipped (or scored 0), by pattern kind.',
+    'slow_scans_total': 'Scans slower than SLOW_SCAN_MS.',
+    'cycle_seconds': 'Watchlist cycle duration per timeframe group.',
+    'cycle_scans_total': 'Scans finished inside cycles, by result.',
+    'cycle_skipped_total': 'Cycles skipped because the previous one was still running.',
+    'cycle_last_timestamp_seconds': 'Unix time the last cycle finished.',
+    'scan_queue_lag_seconds': 'Time a scan waited in the pool before it started.',
+    'ohlcv_fetch_seconds': 'Exchange OHLCV request duration.',
+    'ohlcv_prefetch_seconds': 'Batched OHLCV prefetch duration per cycle.',
+    'ohlcv_fetch_errors_total': 'Exchange OHLCV requests that raised.',
+    'ohlcv_synthetic_fallback_total': 'OHLCV requests answered with synthetic data.',
+    'db_write_lag_seconds': 'Time from submit_write to the commit of its batch.',
+    'db_write_queue_depth': 'Jobs waiting for the DB writer.',
+    'scheduler_job_errors_total': 'Scheduler jobs that raised.',
+    'stream_candles_total': 'Closed candles received from the stream.',
+    'stream_scans_total': 'Scans triggered by a streamed bar close.',
+    'stream_scans_skipped_total': 'Streamed bars skipped because the series was still being scanned.',
+    'stream_close_lag_seconds': 'Time from a live bar close to its arrival from the feed.',
+    'template_index_queries_total': 'Scans whose templates were shortlisted by the template index.',
+    'template_index_size': 'Templates in the nearest-neighbour index (this process).',
+    'render_seconds': 'Chart render time in the render pool, from submit to done.',
+    'render_errors_total': 'Chart renders that raised in the render pool.',
+    'render_rejected_total': 'Chart renders refused because the render queue stayed full.',
+    'render_queue_depth': 'Chart renders queued or running in the render pool.',
+    'telegram_sent_total': 'Telegram sends by kind (message, photo, media_group, digest).',
+    'telegram_retries_total': 'Telegram sends retried after an error.',
+    'telegram_failed_total': 'Telegram sends abandoned after TELEGRAM_MAX_RETRIES.',
+    'telegram_dropped_total': 'Alerts dropped because the Telegram queue was full.',
+    'telegram_queue_depth': 'Alerts waiting for Telegram delivery.',
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[LabelKey, float]] = {}
+_gauges: Dict[str, Dict[LabelKey, float]] = {}
+_hists: Dict[str, Dict[LabelKey, list]] = {}  # [bucket counts..., sum, count]
+_gauge_fns: Dict[str, Callable[[], float]] = {}
+
+
+def _key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels) -> None:
+    k = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[k] = series.get(k, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges.setdefault(name, {})[_key(labels)] = float(value)
+
+
+def gauge_fn(name: str, fn: Callable[[], float]) -> None:
+    """Register `fn()` to be sampled for an unlabelled gauge at render time."""
+    with _lock:
+        _gauge_fns[name] = fn
+
+
+def observe(name: str, value: float, **labels) -> None:
+    k = _key(labels)
+    i = bisect.bisect_left(DEFAULT_BUCKETS, value)
+    with _lock:
+        h = _hists.setdefault(name, {}).get(k)
+        if h is None:
+            h = _hists[name][k] = [0] * len(DEFAULT_BUCKETS) + [0.0, 0]
+        if i < len(DEFAULT_BUCKETS):
+            h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """Observe the block's duration in seconds, also when it raises."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+
+def _fmt_labels(k: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(k) + ([extra] if extra else [])
+    if not items:
+        return ''
+    esc = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{n}="{esc(v)}"' for n, v in items) + '}'
+
+
+def _header(lines: list, name: str, kind: str) -> None:
+    if name in HELP:
+        lines.append(f"# HELP {PREFIX}{name} {HELP[name]}")
+    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format (v0.0.4)."""
+    with _lock:
+        fns = dict(_gauge_fns)
+    sampled = {}
+    for name, fn in fns.items():
+        try:
+            sampled[name] = float(fn())
+        except Exception:
+            continue
+    lines: list = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            _header(lines, name, 'counter')
+            for k, v in sorted(series.items()):
+                lines.append(f"{PREFIX}{name}{_fmt_labels(k)} {float(v)!r}")
+        gauges = {n: dict(s) for n, s in _gauges.items()}
+        for name, v in sampled.items():
+            gauges.setdefault(name, {})[()] = v
+        for name, series in sorted(gauges.items()):
+            _header(lines, name, 'gauge')
+            for k, v in sorted(series.items()):
+                lines.append(f"{PREFIX}{name}{_fmt_labels(k)} {float(v)!r}")
+        for name, series in sorted(_hists.items()):
+            _header(lines, name, 'histogram')
+            for k, h in sorted(series.items()):
+                acc = 0
+                for b, n in zip(DEFAULT_BUCKETS, h):
+                    acc += n
+                    lines.append(f"{PREFIX}{name}_bucket{_fmt_labels(k, ('le', f'{b:g}'))} {acc}")
+                lines.append(f"{PREFIX}{name}_bucket{_fmt_labels(k, ('le', '+Inf'))} {h[-1]}")
+                lines.append(f"{PREFIX}{name}_sum{_fmt_labels(k)} {float(h[-2])!r}")
+                lines.append(f"{PREFIX}{name}_count{_fmt_labels(k)} {h[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics() -> None:
+    """Drop every recorded value (gauge callbacks stay registered)."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _hists.clear()
@@ -0,0 +1,138 @@
+"""Local OHLCV store keyed by exchange/symbol/timeframe.
+
+Candles live in their own SQLite file so bulk writes from the data layer never
+contend with the events database. Each thread gets its own connection.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+OHLCV_DB_PATH = os.getenv("OHLCV_DB_PATH", "storage/ohlcv.sqlite")
+
+Candle = Tuple[int, float, float, float, float, float]  # (ts_ms, o, h, l, c, v)
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _init(conn: sqlite3.Connection) -> None:
+    conn.executescript(
+        '''
+        CREATE TABLE IF NOT EXISTS candles (
+            exchange TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            timeframe TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            open REAL, high REAL, low REAL, close REAL, volume REAL,
+            PRIMARY KEY (exchange, symbol, timeframe, ts)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS candle_fetches (
+            exchange TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            timeframe TEXT NOT NULL,
+            fetched_at INTEGER NOT NULL,
+            PRIMARY KEY (exchange, symbol, timeframe)
+        ) WITHOUT ROWID;
+        '''
+    )
+    conn.commit()
+
+
+def get_candle_conn() -> sqlite3.Connection:
+    global _initialized
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        Path(OHLCV_DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(OHLCV_DB_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with _init_lock:
+            if not _initialized:
+                _init(conn)
+                _initialized = True
+        _local.conn = conn
+    return conn
+
+
+def last_timestamp(exchange: str, symbol: str, timeframe: str) -> Optional[int]:
+    row = get_candle_conn().execute(
+        "SELECT MAX(ts) FROM candles WHERE exchange=? AND symbol=? AND timeframe=?",
+        (exchange, symbol, timeframe),
+    ).fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def first_timestamp(exchange: str, symbol: str, timeframe: str) -> Optional[int]:
+    row = get_candle_conn().execute(
+        "SELECT MIN(ts) FROM candles WHERE exchange=? AND symbol=? AND timeframe=?",
+        (exchange, symbol, timeframe),
+    ).fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def last_fetch(exchange: str, symbol: str, timeframe: str) -> Optional[int]:
+    row = get_candle_conn().execute(
+        "SELECT fetched_at FROM candle_fetches WHERE exchange=? AND symbol=? AND timeframe=?",
+        (exchange, symbol, timeframe),
+    ).fetchone()
+    return int(row[0]) if row else None
+
+
+def upsert_candles(exchange: str, symbol: str, timeframe: str, rows: Sequence[Sequence[float]]) -> int:
+    """Merge ccxt-style rows ([ts, o, h, l, c, v]) into the store.
+
+    Existing bars are overwritten, so a bar fetched while still forming is
+    corrected on the next delta fetch. Also records the fetch time.
+    """
+    conn = get_candle_conn()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO candles (exchange, symbol, timeframe, ts, open, high, low, close, volume) "
+            "VALUES (?,?,?,?,?,?,?,?,?)",
+            [(exchange, symbol, timeframe, int(r[0]), r[1], r[2], r[3], r[4], r[5]) for r in rows],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO candle_fetches (exchange, symbol, timeframe, fetched_at) VALUES (?,?,?,?)",
+            (exchange, symbol, timeframe, int(time.time() * 1000)),
+        )
+    return len(rows)
+
+
+def load_candles(
+    exchange: str,
+    symbol: str,
+    timeframe: str,
+    limit: Optional[int] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+) -> List[Candle]:
+    """Return stored candles in ascending time order.
+
+    With `limit`, the most recent `limit` bars inside [since, until] are returned.
+    """
+    sql = "SELECT ts, open, high, low, close, volume FROM candles WHERE exchange=? AND symbol=? AND timeframe=?"
+    params: list = [exchange, symbol, timeframe]
+    if since is not None:
+        sql += " AND ts >= ?"
+        params.append(int(since))
+    if until is not None:
+        sql += " AND ts <= ?"
+        params.append(int(until))
+    if limit is not None:
+        sql += " ORDER BY ts DESC LIMIT ?"
+        params.append(int(limit))
+        rows = get_candle_conn().execute(sql, params).fetchall()
+        rows.reverse()
+        return rows
+    return get_candle_conn().execute(sql + " ORDER BY ts", params).fetchall()
+
+
+def reset_candle_connections() -> None:
+    """Forget this process's connections, e.g. in a forked worker."""
+    global _local
+    _local = threading.local()
@@ -1,19 +1,120 @@
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Optional
 import os
 
+from app import metrics
+
 DB_PATH = os.getenv("DB_PATH", "storage/events.sqlite")
 Path("storage").mkdir(exist_ok=True, parents=True)
 
-_conn: Optional[sqlite3.Connection] = None
+# One connection per thread (sqlite3 connections aren't safe to share), all in
+# WAL mode so dashboard reads never block the scanner's writes.
+_local = threading.local()
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
 
 def get_conn() -> sqlite3.Connection:
-    global _conn
-    if _conn is None:
-        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        _conn.row_factory = sqlite3.Row
-    return _conn
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+    return conn
+
+
+# --- Write queue: scanner inserts are grouped into shared transactions ---
+_write_q: "queue.Queue[tuple]" = queue.Queue()
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+
+
+def _batch_size() -> int:
+    return max(1, int(os.getenv('DB_WRITE_BATCH', '200')))
+
+
+def _linger_sec() -> float:
+    return max(0.0, float(os.getenv('DB_WRITE_LINGER_MS', '20')) / 1000.0)
+
+
+def _writer_loop() -> None:
+    conn = _connect()
+    conn.isolation_level = None  # transactions are managed explicitly below
+    while True:
+        batch = [_write_q.get()]
+        try:
+            while len(batch) < _batch_size():
+                batch.append(_write_q.get(timeout=_linger_sec()))
+        except queue.Empty:
+            pass
+        results = []
+        try:
+            conn.execute("BEGIN")
+            for fn, fut, _ in batch:
+                # a failing job only rolls back its own savepoint
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((fut, fn(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((fut, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            try:
+                conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            results = [(fut, None, e) for _, fut, _ in batch]
+        now = time.monotonic()
+        for _, _, queued in batch:
+            metrics.observe('db_write_lag_seconds', now - queued)
+        for fut, res, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+
+def submit_write(fn: Callable[[sqlite3.Connection], Any]) -> "Future[Any]":
+    """Queue `fn(conn)` for the writer thread; returns a Future with its result.
+
+    Jobs run in submission order and are committed together in batches of up
+    to DB_WRITE_BATCH (default: 200), waiting at most DB_WRITE_LINGER_MS
+    (default: 20) for a batch to fill. The future resolves after the commit.
+    """
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                _writer = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+                _writer.start()
+    fut: "Future[Any]" = Future()
+    _write_q.put((fn, fut, time.monotonic()))
+    return fut
+
+
+metrics.gauge_fn('db_write_queue_depth', lambda: _write_q.qsize())
+
+
+def reset_connections() -> None:
+    """Forget this process's connections and writer, e.g. in a forked worker."""
+    global _local, _writer, _write_q
+    _local = threading.local()
+    _writer = None
+    _write_q = queue.Queue()
+
 
 def init_db():
     conn = get_conn()
@@ -70,6 +171,35 @@ def init_db():
             key TEXT PRIMARY KEY,
             value TEXT
         );
+        CREATE TABLE IF NOT EXISTS backtest_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pattern_name TEXT,
+            timeframe TEXT,
+            since TEXT,
+            until TEXT,
+            params_json TEXT,
+            status TEXT,
+            summary_json TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS backtest_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER,
+            symbol TEXT,
+            bar_time TEXT,
+            score REAL,
+            entry REAL,
+            returns_json TEXT,
+            mfe REAL,
+            mae REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_backtest_results_run ON backtest_results(run_id);
+        CREATE INDEX IF NOT EXISTS idx_events_symbol_tf ON events(symbol, timeframe);
+        CREATE INDEX IF NOT EXISTS idx_pattern_media_pattern ON pattern_media(pattern_id);
+        CREATE INDEX IF NOT EXISTS idx_watchlist_symbol_tf ON watchlist(symbol, timeframe);
+        CREATE INDEX IF NOT EXISTS idx_alerts_event ON alerts(event_id);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_events_unique_key ON events(unique_key) WHERE unique_key IS NOT NULL;
         '''
     )
     conn.commit()
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+"""Historical backtests of rule patterns over stored candles.
+
+A symbol's whole history is scored in one vectorized pass with
+`patterns_engine.score_series`. Every feature at bar i uses only bars <= i,
+so this equals running the scanner on each bar without calling `run_scan` per
+bar. Forward returns and excursions come from shifted and sliding-window views
+of the same arrays. Symbols run in parallel on a process pool, and each
+symbol's matches are written to the database as soon as it finishes.
+"""
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.models.db import get_conn, submit_write
+from app.services.data import backfill_ohlcv, get_ohlcv_range
+from app.services.patterns_engine import compile_logic, load_patterns_from_dir, parse_yaml, score_series
+
+DEFAULT_HORIZONS = (5, 10, 20)
+PATTERNS_DIR = Path('patterns')
+
+
+def load_pattern(name_or_path: str) -> dict:
+    """Resolve a pattern by name among `patterns/` and the DB, or by a YAML file in `patterns/`.
+
+    File references (e.g. 'patterns/ob.yml' or 'ob.yml') must resolve inside
+    `patterns/`, since they can come from an HTTP request.
+    """
+    p = Path(name_or_path)
+    if p.suffix in ('.yml', '.yaml'):
+        root = PATTERNS_DIR.resolve()
+        f = (p if p.parts[:1] == (PATTERNS_DIR.name,) else PATTERNS_DIR / p).resolve()
+        if root not in f.parents:
+            raise ValueError(f"Pattern files must be under {PATTERNS_DIR}/: {name_or_path}")
+        if f.is_file():
+            return parse_yaml(f.read_text(encoding='utf-8'))
+    for d in load_patterns_from_dir(PATTERNS_DIR):
+        if d.get('name') == name_or_path:
+            return d
+    row = get_conn().execute(
+        "SELECT yaml FROM patterns WHERE name=? ORDER BY id DESC LIMIT 1", (name_or_path,)
+    ).fetchone()
+    if row is None:
+        raise ValueError(f"Unknown pattern: {name_or_path}")
+    return parse_yaml(row['yaml'])
+
+
+def compile_rules(pattern: dict) -> list:
+    """The pattern's compiled `logic` rules; ValueError if it has none.
+
+    Backtests score rules only, so a template-only pattern would otherwise
+    report zero matches for every symbol.
+    """
+    rules = compile_logic(pattern)
+    if not rules:
+        raise ValueError(f"Pattern {pattern.get('name', '?')!r} has no `logic` rules to backtest")
+    return rules
+
+
+def _side(pattern: dict) -> int:
+    """+1 long / -1 short, from `backtest.side` or the pattern's BOS direction."""
+    side = str((pattern.get('backtest') or {}).get('side', '')).lower()
+    if side in ('long', 'short'):
+        return 1 if side == 'long' else -1
+    for feature, attr, value in pattern.get('__rules') or compile_logic(pattern):
+        if (feature, attr) == ('bos', 'direction'):
+            return -1 if value == -1 else 1
+    return 1
+
+
+def _forward_extremes(values: np.ndarray, idx: np.ndarray, h: int, fn) -> np.ndarray:
+    """fn (np.max / np.min) over values[i+1 : i+h+1] for each i in idx; NaN past the end."""
+    out = np.full(idx.size, np.nan)
+    if values.size <= h:
+        return out
+    win = np.lib.stride_tricks.sliding_window_view(values[1:], h)  # win[i] = values[i+1:i+h+1]
+    ok = idx < win.shape[0]
+    out[ok] = fn(win[idx[ok]], axis=1)
+    return out
+
+
+def backtest_frame(pattern: dict, df, horizons: Sequence[int] = DEFAULT_HORIZONS,
+                   threshold: Optional[float] = None) -> Dict[str, object]:
+    """Matches and forward statistics for one OHLCV history.
+
+    A match is the first bar of each run of bars scoring >= threshold
+    (default: `scoring.threshold_alert`). Returns a dict of equal-length
+    arrays ('bar', 'score', 'entry', 'ret_<h>', 'mfe', 'mae'), plus the
+    side and the horizons used.
+    """
+    res = score_series(pattern, df)
+    horizons = [int(h) for h in horizons if int(h) > 0]
+    if res is None:
+        return {'bar': np.array([], dtype=np.int64), 'side': 1, 'horizons': horizons}
+    scores = res[0]
+    if threshold is None:
+        threshold = float((pattern.get('scoring') or {}).get('threshold_alert', 0.7))
+    on = scores >= threshold
+    edge = on & ~np.concatenate(([False], on[:-1]))
+    idx = np.flatnonzero(edge)
+
+    close = np.asarray(df['Close'], dtype=np.float64)
+    high = np.asarray(df['High'], dtype=np.float64)
+    low = np.asarray(df['Low'], dtype=np.float64)
+    side = _side(pattern)
+    entry = close[idx]
+    out: Dict[str, object] = {'bar': idx, 'score': scores[idx], 'entry': entry, 'side': side, 'horizons': horizons}
+    for h in horizons:
+        fwd = np.full(idx.size, np.nan)
+        ok = idx + h < close.size
+        fwd[ok] = (close[idx[ok] + h] / entry[ok] - 1.0) * side
+        out[f'ret_{h}'] = fwd
+    if horizons:
+        hmax = max(horizons)
+        hi = _forward_extremes(high, idx, hmax, np.max)
+        lo = _forward_extremes(low, idx, hmax, np.min)
+        fav, adv = (hi, lo) if side > 0 else (lo, hi)
+        out['mfe'] = (fav / entry - 1.0) * side
+        out['mae'] = (adv / entry - 1.0) * side
+    return out
+
+
+def _summarize(res: Dict[str, object]) -> dict:
+    summary = {'matches': int(len(res['bar']))}
+    for h in res['horizons']:
+        r = np.asarray(res.get(f'ret_{h}', []), dtype=np.float64)
+        r = r[~np.isnan(r)]
+        summary[f'hit_rate_{h}'] = float((r > 0).mean()) if r.size else None
+        summary[f'mean_ret_{h}'] = float(r.mean()) if r.size else None
+    return summary
+
+
+def _init_worker() -> None:
+    # workers never share the parent's sqlite connections or exchange clients
+    from app.models import candles, db
+    from app.services.exchanges import reset_exchange_pools
+    candles.reset_candle_connections()
+    db.reset_connections()
+    reset_exchange_pools()
+
+
+def _run_symbol(pattern: dict, symbol: str, timeframe: str, since: datetime, until: datetime,
+                horizons: Sequence[int], threshold: Optional[float], backfill: bool):
+    if backfill:
+        backfill_ohlcv(symbol, timeframe, since, until)
+    df = get_ohlcv_range(symbol, timeframe, since, until, synthetic=False)
+    if df is None or len(df) == 0:
+        return symbol, [], {'status': 'no_data', 'matches': 0, 'bars': 0}
+    res = backtest_frame(pattern, df, horizons, threshold)
+    times = df.index[res['bar']].strftime('%Y-%m-%d %H:%M:%S')
+    n = len(res['bar'])
+    mfe = res.get('mfe', np.full(n, np.nan))
+    mae = res.get('mae', np.full(n, np.nan))
+    rows = []
+    for k in range(n):
+        rets = {str(h): _num(res[f'ret_{h}'][k]) for h in res['horizons']}
+        rows.append((
+            symbol, times[k], float(res['score'][k]), float(res['entry'][k]),
+            json.dumps(rets), _num(mfe[k]), _num(mae[k]),
+        ))
+    summary = _summarize(res)
+    summary['bars'] = int(len(df))
+    return symbol, rows, summary
+
+
+def _num(x) -> Optional[float]:
+    return None if np.isnan(x) else float(x)
+
+
+def run_backtest(
+    pattern_ref: str,
+    symbols: Sequence[str],
+    timeframe: str,
+    days: float = 30,
+    until: Optional[datetime] = None,
+    horizons: Sequence[int] = DEFAULT_HORIZONS,
+    threshold: Optional[float] = None,
+    workers: Optional[int] = None,
+    backfill: bool = True,
+    run_id: Optional[int] = None,
+) -> int:
+    """Backtest a rule pattern over `days` of history for many symbols.
+
+    Runs symbols on a process pool (`workers`, default: env BACKTEST_WORKERS
+    or the CPU count). Matches go to `backtest_results` as each symbol
+    completes, and per-symbol stats to `backtest_runs.summary_json`.
+    Returns the run id.
+    """
+    pattern = load_pattern(pattern_ref)
+    pattern['__rules'] = compile_rules(pattern)
+    until = until or datetime.utcnow()
+    since = until - timedelta(days=days)
+    horizons = [int(h) for h in horizons]
+    if run_id is None:
+        run_id = create_run(pattern.get('name', pattern_ref), symbols, timeframe, since, until, horizons)
+
+    if workers is None:
+        workers = int(os.getenv('BACKTEST_WORKERS', '0')) or (os.cpu_count() or 1)
+    summary: Dict[str, dict] = {}
+    status = 'done'
+    try:
+        # spawned: forking would copy the parent's threads and their locks
+        # (db writer, notifier, scheduler) into the workers
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(symbols) or 1)),
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker) as pool:
+            futs = {
+                pool.submit(_run_symbol, pattern, s, timeframe, since, until, horizons, threshold, backfill): s
+                for s in symbols
+            }
+            for fut in as_completed(futs):
+                try:
+                    symbol, rows, stats = fut.result()
+                except Exception as e:
+                    summary[futs[fut]] = {'error': str(e)}
+                    continue
+                summary[symbol] = stats
+                if rows:
+                    submit_write(lambda c, rows=rows: c.executemany(
+                        "INSERT INTO backtest_results (run_id, symbol, bar_time, score, entry, returns_json, mfe, mae) "
+                        "VALUES (?,?,?,?,?,?,?,?)",
+                        [(run_id,) + r for r in rows],
+                    ))
+    except Exception as e:
+        status = f'error: {e}'
+    submit_write(lambda c: c.execute(
+        "UPDATE backtest_runs SET status=?, summary_json=?, finished_at=CURRENT_TIMESTAMP WHERE id=?",
+        (status, json.dumps(summary), run_id),
+    )).result()
+    return run_id
+
+
+def create_run(pattern_name: str, symbols: Sequence[str], timeframe: str, since: datetime,
+               until: datetime, horizons: List[int]) -> int:
+    params = {'symbols': list(symbols), 'horizons': horizons}
+    return submit_write(lambda c: c.execute(
+        "INSERT INTO backtest_runs (pattern_name, timeframe, since, until, params_json, status) VALUES (?,?,?,?,?,?)",
+        (pattern_name, timeframe, since.strftime('%Y-%m-%d %H:%M:%S'), until.strftime('%Y-%m-%d %H:%M:%S'),
+         json.dumps(params), 'running'),
+    ).lastrowid).result()
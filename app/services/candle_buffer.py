@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+"""Fixed-capacity OHLCV ring buffer stored as NumPy columns.
+
+Each column (ts int64 ms; open/high/low/close/volume float64) is one
+contiguous array of 2 * capacity. Every value is written at `i` and
+`i + capacity`, so the newest n bars are always one contiguous slice and
+`window(n)` returns zero-copy views. Appends are O(1).
+
+`CandleWindow` supports the parts of the DataFrame interface that the
+scoring code reads: `w['Open']`, `len(w)` and `w.index` (datetime64[ms]).
+Use `to_frame()` / `as_frame()` only where pandas is really needed
+(mplfinance charts). `resample` derives coarser bars from a window.
+"""
+
+import threading
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+
+try:
+    import pandas as pd  # type: ignore
+except Exception:  # pragma: no cover
+    pd = None  # type: ignore
+
+COLUMNS = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+
+class CandleWindow:
+    """Aligned column arrays for a run of consecutive bars (oldest first)."""
+
+    __slots__ = ('ts', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, ts: np.ndarray, open: np.ndarray, high: np.ndarray, low: np.ndarray,
+                 close: np.ndarray, volume: np.ndarray):
+        self.ts, self.open, self.high, self.low, self.close, self.volume = ts, open, high, low, close, volume
+
+    def __len__(self) -> int:
+        return int(self.ts.size)
+
+    def __getitem__(self, col: str) -> np.ndarray:
+        return getattr(self, col.lower())
+
+    @property
+    def empty(self) -> bool:
+        return self.ts.size == 0
+
+    @property
+    def index(self) -> np.ndarray:
+        """Bar open times as a datetime64[ms] view of `ts` (naive UTC)."""
+        return self.ts.view('datetime64[ms]')
+
+    def upto(self, ts_ms: int) -> "CandleWindow":
+        """Bars with ts <= ts_ms (a view)."""
+        n = int(np.searchsorted(self.ts, ts_ms, side='right'))
+        return CandleWindow(*(a[:n] for a in self._cols()))
+
+    def tail(self, n: int) -> "CandleWindow":
+        """The newest n bars (a view)."""
+        start = max(0, len(self) - int(n))
+        return CandleWindow(*(a[start:] for a in self._cols()))
+
+    def copy(self) -> "CandleWindow":
+        """Detached copy, safe to hand to another thread or process."""
+        return CandleWindow(*(a.copy() for a in self._cols()))
+
+    def to_frame(self):
+        """pandas DataFrame in the `get_ohlcv_df` layout (copies the data)."""
+        if pd is None:
+            return None
+        return pd.DataFrame(
+            {'Open': self.open, 'High': self.high, 'Low': self.low, 'Close': self.close, 'Volume': self.volume},
+            index=pd.DatetimeIndex(self.ts.astype('datetime64[ms]').astype('datetime64[ns]')),
+            copy=True,
+        )
+
+    def _cols(self):
+        return self.ts, self.open, self.high, self.low, self.close, self.volume
+
+
+def as_frame(data):
+    """DataFrame for `data` (a CandleWindow or an existing DataFrame/None)."""
+    return data.to_frame() if isinstance(data, CandleWindow) else data
+
+
+def as_window(data) -> Optional[CandleWindow]:
+    """CandleWindow for `data` (a DataFrame in the `get_ohlcv_df` layout, a window or None)."""
+    if data is None or isinstance(data, CandleWindow):
+        return data
+    ts = np.asarray(data.index.values.astype('datetime64[ms]').astype(np.int64))
+    return CandleWindow(ts, *(np.asarray(data[c], dtype=np.float64) for c in COLUMNS))
+
+
+def resample(win: CandleWindow, period_ms: int) -> CandleWindow:
+    """Aggregate bars into `period_ms` bars aligned to the epoch, as exchanges do.
+
+    Open/close are the first/last bar's, high/low the extremes and volume the
+    sum. A leading bucket that starts before the first bar is dropped (it is
+    incomplete); the last bucket may still be forming, like any newest bar.
+    """
+    bucket = win.ts - win.ts % period_ms
+    if bucket.size and win.ts[0] != bucket[0]:
+        skip = int(np.searchsorted(bucket, bucket[0], side='right'))
+        win = CandleWindow(*(a[skip:] for a in win._cols()))
+        bucket = bucket[skip:]
+    if not bucket.size:
+        return CandleWindow(*(a[:0].copy() for a in win._cols()))
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], bucket.size] - 1
+    return CandleWindow(
+        bucket[starts],
+        win.open[starts],
+        np.maximum.reduceat(win.high, starts),
+        np.minimum.reduceat(win.low, starts),
+        win.close[ends],
+        np.add.reduceat(win.volume, starts),
+    )
+
+
+class CandleBuffer:
+    """Ring buffer of the latest `capacity` bars of one series.
+
+    Writes are serialized by `lock`; views from `window()` see later writes,
+    so take `window(...).copy()` (cheap: one memcpy per column) to hand data
+    to another thread.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be >= 1")
+        self.capacity = int(capacity)
+        self._ts = np.zeros(2 * self.capacity, dtype=np.int64)
+        self._vals = np.zeros((5, 2 * self.capacity), dtype=np.float64)  # o, h, l, c, v rows
+        self._pos = 0  # next write slot in [0, capacity)
+        self._len = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Sequence[float]], capacity: Optional[int] = None) -> "CandleBuffer":
+        buf = cls(capacity or max(1, len(rows)))
+        buf.extend(rows)
+        return buf
+
+    def __len__(self) -> int:
+        return self._len
+
+    @property
+    def last_ts(self) -> Optional[int]:
+        return int(self._ts[self._pos - 1 + self.capacity]) if self._len else None
+
+    def _write(self, slot: int, ts: int, vals) -> None:
+        self._ts[slot] = self._ts[slot + self.capacity] = ts
+        self._vals[:, slot] = self._vals[:, slot + self.capacity] = vals
+
+    def append(self, ts: int, o: float, h: float, l: float, c: float, v: float) -> None:
+        """Add a bar after the newest one; the oldest drops out when full."""
+        self._write(self._pos, int(ts), (o, h, l, c, v))
+        self._pos = (self._pos + 1) % self.capacity
+        self._len = min(self._len + 1, self.capacity)
+
+    def update_last(self, o: float, h: float, l: float, c: float, v: float) -> None:
+        """Overwrite the newest bar in place (a forming bar's latest values)."""
+        if not self._len:
+            raise IndexError("empty buffer")
+        slot = (self._pos - 1) % self.capacity
+        self._write(slot, int(self._ts[slot]), (o, h, l, c, v))
+
+    def push(self, row: Sequence[float]) -> bool:
+        """Merge a ccxt-style row: replace the newest bar on equal ts, append if newer.
+
+        Returns False for a row older than the newest bar (ignored).
+        """
+        ts = int(row[0])
+        last = self.last_ts
+        if last is not None and ts < last:
+            return False
+        if last is not None and ts == last:
+            self.update_last(*row[1:6])
+        else:
+            self.append(ts, *row[1:6])
+        return True
+
+    def extend(self, rows: Iterable[Sequence[float]]) -> None:
+        """Append many rows at once; rows must be newer than the newest bar."""
+        arr = np.asarray(list(rows) if not isinstance(rows, np.ndarray) else rows, dtype=np.float64)
+        if arr.size == 0:
+            return
+        arr = arr.reshape(-1, 6)[-self.capacity:]
+        n = arr.shape[0]
+        slots = (self._pos + np.arange(n)) % self.capacity
+        ts = arr[:, 0].astype(np.int64)
+        for off in (0, self.capacity):
+            self._ts[slots + off] = ts
+            self._vals[:, slots + off] = arr[:, 1:6].T
+        self._pos = (self._pos + n) % self.capacity
+        self._len = min(self._len + n, self.capacity)
+
+    def window(self, n: Optional[int] = None) -> CandleWindow:
+        """The newest n bars (all by default) as zero-copy views, oldest first."""
+        n = self._len if n is None else max(0, min(int(n), self._len))
+        end = self._pos + self.capacity
+        sl = slice(end - n, end)
+        v = self._vals[:, sl]
+        return CandleWindow(self._ts[sl], v[0], v[1], v[2], v[3], v[4])
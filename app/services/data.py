@@ -2,28 +2,147 @@ from __future__ import annotations
 
 """Data provider abstraction for OHLCV.
 
-Current implementation returns a synthetic series for demo. You can replace
-`get_ohlcv_df` with a ccxt-backed fetcher later.
+`get_ohlcv_df` serves candles from the local store in `app.models.candles`,
+fetching only bars newer than the last cached one from the exchange (ccxt,
+through the pooled clients in `app.services.exchanges`).
+Without ccxt or network access it falls back to a synthetic series for demo.
+
+Recent bars of each series are also kept in memory in a `CandleBuffer`, so a
+scan reads only the rows added since the last one. `get_ohlcv_window`
+returns them as NumPy columns, without building a DataFrame.
+
+Timeframes of one symbol are derived from a shared finer series where
+possible (see `plan_timeframes`): e.g. 2m and 5m are resampled from one 1m
+fetch instead of two exchange requests.
 """
 
+import asyncio
 from datetime import datetime, timedelta
 import os
+import time
+import zlib
+import threading
+from typing import Dict, Iterable, Optional, Tuple
 import numpy as np
 
+from app.models.candles import first_timestamp, last_fetch, last_timestamp, load_candles, upsert_candles
+from app.services.exchanges import CCXT_AVAILABLE, async_exchange_client, exchange_client, run_async
+from app import metrics
+from app.services.candle_buffer import CandleBuffer, CandleWindow, as_frame, as_window, resample
+
 try:
     import pandas as pd  # type: ignore
 except Exception:  # pragma: no cover
     pd = None  # type: ignore
 
+TF_MINUTES = {'1m': 1, '2m': 2, '3m': 3, '5m': 5, '15m': 15, '30m': 30, '1h': 60, '2h': 120, '4h': 240, '1d': 60 * 24}
+
+
+# 'M' (month) is approximate; use `bar_close_ms` where the exact close matters
+_TF_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, 'M': 30 * 86400}
+
+
+def timeframe_seconds(timeframe: str, default_min: int = 5) -> int:
+    """Bar length of a ccxt-style timeframe ('1m', '4h', '1d', ...) in seconds."""
+    if timeframe in TF_MINUTES:
+        return TF_MINUTES[timeframe] * 60
+    unit = _TF_UNITS.get(str(timeframe)[-1:])
+    try:
+        return int(str(timeframe)[:-1]) * unit if unit else default_min * 60
+    except ValueError:
+        return default_min * 60
+
+
+# units whose bars have a fixed length and start on multiples of it since the
+# epoch; weeks ('1w' opens on Monday, epoch weeks on Thursday) and months
+# ('1M') are calendar-aligned and never resampled
+_FIXED_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def fixed_timeframe_seconds(timeframe: str) -> Optional[int]:
+    """Bar length of an epoch-aligned fixed-length timeframe, or None (unknown or calendar-based)."""
+    tf = str(timeframe)
+    unit = _FIXED_UNITS.get(tf[-1:])
+    if unit is None or not tf[:-1].isdigit() or int(tf[:-1]) <= 0:
+        return None
+    return int(tf[:-1]) * unit
+
+
+def calendar_timeframe(timeframe: str) -> Optional[Tuple[str, int]]:
+    """('w', n) or ('M', n) for calendar timeframes like '1w' and '1M', else None."""
+    tf = str(timeframe)
+    if tf[-1:] in ('w', 'M') and tf[:-1].isdigit() and int(tf[:-1]) > 0:
+        return tf[-1:], int(tf[:-1])
+    return None
+
+
+def bar_close_ms(timeframe: str, open_ms: int) -> Optional[int]:
+    """Close time (the next bar's open) of the bar opening at `open_ms`; None if unknown.
+
+    Weeks are as long as they say (exchange weeks open on Monday, so the
+    bar's own open anchors them); months close on the first of a later month.
+    """
+    secs = fixed_timeframe_seconds(timeframe)
+    if secs is not None:
+        return int(open_ms) + secs * 1000
+    cal = calendar_timeframe(timeframe)
+    if cal is None:
+        return None
+    unit, n = cal
+    if unit == 'w':
+        return int(open_ms) + n * 7 * 86_400_000
+    opened = datetime(1970, 1, 1) + timedelta(milliseconds=int(open_ms))
+    months = opened.year * 12 + opened.month - 1 + n
+    closes = datetime(months // 12, months % 12 + 1, 1)
+    return int((closes - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def last_closed_bar(df, timeframe: str, now: Optional[datetime] = None):
+    """Timestamp of the newest bar in `df` that has closed (naive UTC), or None.
+
+    Calendar timeframes ('1w', '1M') close on the calendar. For unknown
+    timeframes the close can't be known, so None is returned and the scan
+    runs without closed-bar dedup.
+    """
+    if df is None or len(df) == 0:
+        return None
+    now = now or datetime.utcnow()
+    now_ms = int((now - datetime(1970, 1, 1)).total_seconds() * 1000)
+    ts = df.ts if isinstance(df, CandleWindow) else df.index.as_unit('ms').asi8
+    secs = fixed_timeframe_seconds(timeframe)
+    if secs is not None:
+        # ts ascends, so the closed bars are a prefix
+        i = int(np.searchsorted(ts + secs * 1000, now_ms, side='right')) - 1
+    else:
+        i = -1
+        for j in range(len(ts) - 1, -1, -1):
+            close = bar_close_ms(timeframe, int(ts[j]))
+            if close is None:
+                return None
+            if close <= now_ms:
+                i = j
+                break
+    if i < 0:
+        return None
+    return pd.Timestamp(int(ts[i]), unit='ms') if isinstance(df, CandleWindow) else df.index[i]
+
+
+def upto_bar(df, bar):
+    """Bars of `df` (DataFrame or CandleWindow) up to and including `bar`."""
+    if isinstance(df, CandleWindow):
+        return df.upto(int(bar.value // 1_000_000))
+    return df.loc[:bar]
+
 
 def _synthetic_df(symbol: str, timeframe: str, limit: int = 150):
     if pd is None:
         return None
-    now = datetime.utcnow()
-    tf_map = {'1m': 1, '2m': 2, '3m': 3, '5m': 5, '15m': 15, '30m': 30, '1h': 60, '2h': 120, '4h': 240, '1d': 60 * 24}
-    step = tf_map.get(timeframe, 5)
-    idx = [now - timedelta(minutes=step * (limit - i)) for i in range(limit)]
-    rng = np.random.default_rng(abs(hash(symbol + timeframe)) % (2**32))
+    step = TF_MINUTES.get(timeframe, 5)
+    # bars aligned to the timeframe like exchange data; the last one is still forming
+    now = datetime.utcfromtimestamp(int(time.time()) // (step * 60) * (step * 60))
+    idx = [now - timedelta(minutes=step * (limit - 1 - i)) for i in range(limit)]
+    # crc32 rather than hash(): str hashes are salted per process
+    rng = np.random.default_rng(zlib.crc32(f"{symbol}{timeframe}".encode()))
     prices = np.cumsum(rng.normal(0, 0.5, size=limit)) + 100
     opens = prices + rng.normal(0, 0.2, size=limit)
     highs = np.maximum(opens, prices) + rng.random(size=limit) * 0.5
@@ -33,46 +152,408 @@ def _synthetic_df(symbol: str, timeframe: str, limit: int = 150):
     return pd.DataFrame({'Open': opens, 'High': highs, 'Low': lows, 'Close': closes, 'Volume': vols}, index=pd.DatetimeIndex(idx))
 
 
+def _rows_to_df(rows):
+    if not rows:
+        return None
+    arr = np.asarray(rows, dtype=np.float64)
+    idx = pd.to_datetime(arr[:, 0].astype(np.int64), unit='ms')
+    return pd.DataFrame({
+        'Open': arr[:, 1],
+        'High': arr[:, 2],
+        'Low': arr[:, 3],
+        'Close': arr[:, 4],
+        'Volume': arr[:, 5],
+    }, index=idx)
+
+
+def _cache_enabled() -> bool:
+    return os.getenv('OHLCV_CACHE', '1') != '0'
+
+
+def _delta_since(ex_id: str, symbol: str, timeframe: str, limit: int):
+    """Decide what to fetch for a series.
+
+    Returns (need_fetch, since_ms). No fetch is needed when the last fetch
+    happened within the current bar; `since` is None when the cache is empty
+    or too old to be extended with a single request of `limit` bars.
+    """
+    if not _cache_enabled():
+        return True, None
+    tf_ms = timeframe_seconds(timeframe) * 1000
+    now_ms = int(time.time() * 1000)
+    last_ts = last_timestamp(ex_id, symbol, timeframe)
+    if last_ts is None:
+        return True, None
+    fetched = last_fetch(ex_id, symbol, timeframe)
+    if fetched is not None and fetched // tf_ms == now_ms // tf_ms:
+        return False, None
+    if now_ms - last_ts > limit * tf_ms:
+        return True, None
+    # re-fetch the last cached bar: it may have been stored while still forming
+    return True, last_ts
+
+
+_buffers: Dict[Tuple[str, str, str], CandleBuffer] = {}
+_buffers_lock = threading.Lock()
+
+
+def _buffer_bars() -> int:
+    return max(1, int(os.getenv('OHLCV_BUFFER_BARS', '500')))
+
+
+def _load_window(ex_id: str, symbol: str, timeframe: str, limit: int) -> Optional[CandleWindow]:
+    """Newest `limit` stored bars via the series' in-memory buffer (a detached copy)."""
+    key = (ex_id, symbol, timeframe)
+    with _buffers_lock:
+        buf = _buffers.get(key)
+        if buf is None or buf.capacity < limit:
+            buf = _buffers[key] = CandleBuffer(max(limit, _buffer_bars()))
+    with buf.lock:
+        last = buf.last_ts
+        if last is None:
+            buf.extend(load_candles(ex_id, symbol, timeframe, limit=buf.capacity))
+        else:
+            # only rows since the newest buffered bar; that bar may have been forming
+            rows = load_candles(ex_id, symbol, timeframe, limit=buf.capacity, since=last)
+            if rows and int(rows[0][0]) == last:
+                buf.update_last(*rows[0][1:6])
+                rows = rows[1:]
+            buf.extend(rows)
+        return buf.window(limit).copy() if len(buf) else None
+
+
+def _merge_and_load(ex_id: str, symbol: str, timeframe: str, data, limit: int):
+    """Store freshly fetched rows (if any) and return the window from the store.
+
+    Returns a CandleWindow, or a DataFrame when falling back to synthetic data.
+    """
+    if not _cache_enabled():
+        return _rows_to_df(data) if data else _synthetic_df(symbol, timeframe, limit)
+    if data:
+        upsert_candles(ex_id, symbol, timeframe, data)
+    win = _load_window(ex_id, symbol, timeframe, limit)
+    return win if win is not None else _synthetic_df(symbol, timeframe, limit)
+
+
 def get_ohlcv_df(symbol: str, timeframe: str, limit: int = 150):
     """Return OHLCV as pandas DataFrame. Tries ccxt if available, else synthetic.
 
     Env:
       - EXCHANGE_ID (default: binance)
       - EXCHANGE_API_KEY / EXCHANGE_API_SECRET (optional)
+      - EXCHANGE_POOL_SIZE / EXCHANGE_MARKETS_TTL_SEC (see services/exchanges.py)
+      - OHLCV_CACHE=0 disables the local candle store
+      - OHLCV_BUFFER_BARS (default: 500) bars kept in memory per series
+      - OHLCV_RESAMPLE=0 fetches every timeframe directly (see `plan_timeframes`)
     """
+    return as_frame(_fetch_ohlcv(symbol, timeframe, limit))
+
+
+def get_ohlcv_window(symbol: str, timeframe: str, limit: int = 150) -> Optional[CandleWindow]:
+    """Like `get_ohlcv_df`, as a CandleWindow (no DataFrame is built)."""
+    return as_window(_fetch_ohlcv(symbol, timeframe, limit))
+
+
+def _fetch_series(symbol: str, timeframe: str, limit: int):
     # Try ccxt
     try:
-        import ccxt  # type: ignore
         if pd is None:
             return None
-        ex_id = os.getenv('EXCHANGE_ID', 'binance')
-        cls = getattr(ccxt, ex_id, None)
-        if cls is None:
+        if not CCXT_AVAILABLE:
+            metrics.inc('ohlcv_synthetic_fallback_total', reason='no_ccxt')
             return _synthetic_df(symbol, timeframe, limit)
-        opts = {
-            'apiKey': os.getenv('EXCHANGE_API_KEY'),
-            'secret': os.getenv('EXCHANGE_API_SECRET'),
-            'enableRateLimit': True,
-        }
-        exchange = cls({k: v for k, v in opts.items() if v is not None})
-        # Some exchanges need markets loaded before fetch
+        ex_id = os.getenv('EXCHANGE_ID', 'binance')
+        need_fetch, since = _delta_since(ex_id, symbol, timeframe, limit)
+        if need_fetch:
+            with exchange_client(ex_id) as exchange:
+                if exchange is None:
+                    metrics.inc('ohlcv_synthetic_fallback_total', reason='no_exchange')
+                    return _synthetic_df(symbol, timeframe, limit)
+                try:
+                    with metrics.timer('ohlcv_fetch_seconds', mode='sync'):
+                        data = exchange.fetch_ohlcv(symbol, timeframe=timeframe, since=since, limit=limit)
+                except Exception:
+                    metrics.inc('ohlcv_fetch_errors_total')
+                    data = None
+            return _merge_and_load(ex_id, symbol, timeframe, data, limit)
+        return _merge_and_load(ex_id, symbol, timeframe, None, limit)
+    except Exception:
+        metrics.inc('ohlcv_synthetic_fallback_total', reason='error')
+        return _synthetic_df(symbol, timeframe, limit)
+
+
+# --- deriving coarser timeframes from one finer fetch ---
+
+# timeframes fetched as a base: the ones every ccxt exchange is likely to offer
+RESAMPLE_BASES = ('1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '8h', '12h', '1d')
+
+_derived: Dict[Tuple[str, str, str], Tuple[tuple, CandleWindow]] = {}
+_derived_lock = threading.Lock()
+
+
+def _resample_enabled() -> bool:
+    return os.getenv('OHLCV_RESAMPLE', '1') != '0'
+
+
+def _resample_max_bars() -> int:
+    return max(1, int(os.getenv('OHLCV_RESAMPLE_MAX_BARS', '1000')))
+
+
+def plan_timeframes(timeframes: Iterable[str], limit: int = 150) -> Dict[str, list]:
+    """Group one symbol's timeframes by the series to fetch for them: {base: [timeframes]}.
+
+    A base must divide each of its timeframes and cover `limit` bars of them
+    in at most OHLCV_RESAMPLE_MAX_BARS (default: 1000, one exchange request)
+    base bars. Bases are picked greedily to cover the most timeframes,
+    preferring the coarser one. Timeframes no base can serve are fetched as
+    they are (base == timeframe), and so are timeframes without a fixed,
+    epoch-aligned length: unknown ones and calendar ones like '1w' and '1M'.
+    """
+    tfs = set(timeframes)
+    if not _resample_enabled():
+        return {tf: [tf] for tf in sorted(tfs, key=timeframe_seconds)}
+    secs = {tf: fixed_timeframe_seconds(tf) for tf in tfs}
+    # unknown and calendar-aligned timeframes are fetched as they are
+    plan: Dict[str, list] = {tf: [tf] for tf in sorted(tfs, key=timeframe_seconds) if secs[tf] is None}
+    remaining = sorted((tf for tf in tfs if secs[tf] is not None), key=secs.get)
+    cap = _resample_max_bars()
+    while remaining:
+        best_base, best = None, []
+        for base in RESAMPLE_BASES:
+            b = fixed_timeframe_seconds(base)
+            covered = [tf for tf in remaining if secs[tf] % b == 0 and limit * (secs[tf] // b) <= cap]
+            if len(covered) >= len(best) and covered:
+                best_base, best = base, covered  # bases ascend, so ties go to the coarser one
+        if best_base is None:
+            best_base, best = remaining[0], [remaining[0]]
+        plan.setdefault(best_base, []).extend(best)
+        remaining = [tf for tf in remaining if tf not in best]
+    return plan
+
+
+def _base_limit(base: str, timeframes: Iterable[str], limit: int) -> int:
+    b = timeframe_seconds(base)
+    return limit * max(timeframe_seconds(tf) // b for tf in timeframes)
+
+
+def _derive(symbol: str, base: str, data, timeframes: Iterable[str], limit: int) -> Dict[str, object]:
+    """The newest `limit` bars of each timeframe from the base series `data`.
+
+    Resampled windows are cached per symbol and timeframe until the base
+    series changes.
+    """
+    out: Dict[str, object] = {}
+    win = as_window(data)
+    for tf in timeframes:
+        if win is None:
+            out[tf] = None
+        elif tf == base:
+            out[tf] = data.iloc[-limit:] if not isinstance(data, CandleWindow) else win.tail(limit)
+        else:
+            sig = (base, len(win), int(win.ts[-1]), float(win.close[-1]), float(win.volume[-1])) if len(win) else None
+            key = (os.getenv('EXCHANGE_ID', 'binance'), symbol, tf)
+            with _derived_lock:
+                hit = _derived.get(key)
+            if hit is not None and sig is not None and hit[0] == sig and len(hit[1]) >= limit:
+                out[tf] = hit[1].tail(limit).copy()
+                continue
+            res = resample(win, timeframe_seconds(tf) * 1000).tail(limit).copy()
+            with _derived_lock:
+                _derived[key] = (sig, res)
+            out[tf] = res
+    return out
+
+
+def _fetch_ohlcv(symbol: str, timeframe: str, limit: int):
+    plan = plan_timeframes([timeframe], limit)
+    base = next(iter(plan))
+    if base == timeframe:
+        return _fetch_series(symbol, timeframe, limit)
+    data = _fetch_series(symbol, base, _base_limit(base, plan[base], limit))
+    return _derive(symbol, base, data, [timeframe], limit)[timeframe]
+
+
+def get_ohlcv_df_until(symbol: str, timeframe: str, until: datetime, limit: int = 150):
+    """Stored window of `limit` bars ending at `until` (naive UTC), e.g. to redraw an old alert.
+
+    Falls back to the current window from `get_ohlcv_df` when the store has nothing.
+    """
+    if pd is not None and CCXT_AVAILABLE and _cache_enabled():
         try:
-            exchange.load_markets()
+            ex_id = os.getenv('EXCHANGE_ID', 'binance')
+            df = _rows_to_df(load_candles(ex_id, symbol, timeframe, limit=limit, until=_to_ms(until)))
+            if df is not None:
+                return df
         except Exception:
             pass
-        data = exchange.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
-        if not data:
-            return _synthetic_df(symbol, timeframe, limit)
-        ts = [row[0] for row in data]
-        idx = pd.to_datetime(ts, unit='ms')
-        df = pd.DataFrame({
-            'Open': [row[1] for row in data],
-            'High': [row[2] for row in data],
-            'Low': [row[3] for row in data],
-            'Close': [row[4] for row in data],
-            'Volume': [row[5] for row in data],
-        }, index=idx)
-        return df
-    except Exception:
-        return _synthetic_df(symbol, timeframe, limit)
+    return get_ohlcv_df(symbol, timeframe, limit)
+
+
+def _to_ms(dt: datetime) -> int:
+    return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def backfill_ohlcv(symbol: str, timeframe: str, since: datetime, until: Optional[datetime] = None, page: int = 1000) -> int:
+    """Page exchange history for [since, until] (naive UTC) into the candle store.
+
+    Resumes after the newest stored bar when the store already reaches back
+    to `since`. Returns the number of bars written (0 offline).
+    """
+    if not CCXT_AVAILABLE or not _cache_enabled():
+        return 0
+    ex_id = os.getenv('EXCHANGE_ID', 'binance')
+    tf_ms = timeframe_seconds(timeframe) * 1000
+    since_ms = _to_ms(since)
+    until_ms = _to_ms(until) if until is not None else int(time.time() * 1000)
+    first = first_timestamp(ex_id, symbol, timeframe)
+    last = last_timestamp(ex_id, symbol, timeframe)
+    cursor = last if first is not None and first <= since_ms and last is not None else since_ms
+    total = 0
+    with exchange_client(ex_id) as exchange:
+        if exchange is None:
+            return 0
+        while cursor < until_ms:
+            try:
+                rows = exchange.fetch_ohlcv(symbol, timeframe=timeframe, since=cursor, limit=page)
+            except Exception:
+                break
+            if not rows:
+                break
+            upsert_candles(ex_id, symbol, timeframe, rows)
+            total += len(rows)
+            nxt = int(rows[-1][0]) + tf_ms
+            if nxt <= cursor:
+                break
+            cursor = nxt
+    return total
+
+
+def get_ohlcv_range(symbol: str, timeframe: str, since: datetime, until: Optional[datetime] = None,
+                    synthetic: bool = True):
+    """All stored bars in [since, until] (naive UTC) as a DataFrame.
 
+    Offline (no ccxt or an empty store) returns a synthetic history of the
+    same length, or None with `synthetic=False`.
+    """
+    if pd is None:
+        return None
+    until = until or datetime.utcnow()
+    if (CCXT_AVAILABLE or not synthetic) and _cache_enabled():
+        try:
+            ex_id = os.getenv('EXCHANGE_ID', 'binance')
+            df = _rows_to_df(load_candles(ex_id, symbol, timeframe, since=_to_ms(since), until=_to_ms(until)))
+            if df is not None:
+                return df
+        except Exception:
+            pass
+    if not synthetic:
+        return None
+    n = int((until - since).total_seconds() // timeframe_seconds(timeframe))
+    return _synthetic_df(symbol, timeframe, max(1, n)) if n > 0 else None
+
+
+Pair = Tuple[str, str]
+
+
+async def fetch_ohlcv_many(pairs: Iterable[Pair], limit: int = 150, concurrency: Optional[int] = None,
+                           frames: bool = True, siblings: Optional[Dict[str, Iterable[str]]] = None
+                           ) -> Dict[Pair, object]:
+    """Fetch many (symbol, timeframe) pairs concurrently; returns {pair: DataFrame}.
+
+    With `frames=False` the values are CandleWindows instead.
+
+    Each symbol's timeframes are fetched through `plan_timeframes`: one base
+    series per group, resampled for the others. `siblings` ({symbol:
+    timeframes}, e.g. the whole watchlist) lets a call for some timeframes
+    plan with the symbol's other ones, so separate per-timeframe cycles share
+    the same stored base series.
+
+    Requests go through one ccxt.async_support client, so they share its rate
+    limiter, and at most `concurrency` (env OHLCV_FETCH_CONCURRENCY, default:
+    10) are in flight. Delta fetching and the candle store work as in
+    `get_ohlcv_df`; pairs that can't be fetched fall back to synthetic data.
+    """
+    pairs = list(dict.fromkeys((str(s), str(tf)) for s, tf in pairs))
+    if pd is None:
+        return {p: None for p in pairs}
+    conv = as_frame if frames else as_window
+    by_symbol: Dict[str, set] = {}
+    for s, tf in pairs:
+        by_symbol.setdefault(s, set()).add(tf)
+    groups = []  # (symbol, base, requested timeframes)
+    limits: Dict[Pair, int] = {}
+    for s, tfs in by_symbol.items():
+        plan = plan_timeframes(tfs | set((siblings or {}).get(s, ())), limit)
+        for base, members in plan.items():
+            wanted = [tf for tf in members if tf in tfs]
+            if wanted:
+                groups.append((s, base, wanted))
+                # sized for every member, so all cycles keep the same base window
+                limits[(s, base)] = _base_limit(base, members, limit)
+    fetched = await _fetch_many(list(limits), limits, concurrency)
+
+    def derive_all() -> Dict[Pair, object]:
+        out: Dict[Pair, object] = {}
+        for s, base, wanted in groups:
+            for tf, v in _derive(s, base, fetched.get((s, base)), wanted, limit).items():
+                out[(s, tf)] = conv(v)
+        return out
+
+    # resampling and DataFrame building are CPU work: keep them off the loop
+    return await asyncio.to_thread(derive_all)
+
+
+def _merge_many(ex_id: str, pairs, fetched: Dict[Pair, object], limits: Dict[Pair, int]) -> Dict[Pair, object]:
+    out: Dict[Pair, object] = {}
+    for p in pairs:
+        try:
+            out[p] = _merge_and_load(ex_id, p[0], p[1], fetched.get(p), limits[p])
+        except Exception:
+            metrics.inc('ohlcv_synthetic_fallback_total', reason='error')
+            out[p] = _synthetic_df(p[0], p[1], limits[p])
+    return out
+
+
+async def _fetch_many(pairs, limits: Dict[Pair, int], concurrency: Optional[int]) -> Dict[Pair, object]:
+    if concurrency is None:
+        concurrency = int(os.getenv('OHLCV_FETCH_CONCURRENCY', '10'))
+    if not CCXT_AVAILABLE:
+        return {p: _synthetic_df(p[0], p[1], limits[p]) for p in pairs}
+    ex_id = os.getenv('EXCHANGE_ID', 'binance')
+    # the candle store is sqlite: read and write it off the event loop
+    plans = await asyncio.to_thread(lambda: {p: _delta_since(ex_id, p[0], p[1], limits[p]) for p in pairs})
+    todo = [p for p in pairs if plans[p][0]]
+    fetched: Dict[Pair, object] = {}
+    if todo:
+        sem = asyncio.Semaphore(max(1, concurrency))
+        async with async_exchange_client(ex_id) as exchange:
+            if exchange is None:
+                return {p: _synthetic_df(p[0], p[1], limits[p]) for p in pairs}
+
+            async def one(symbol: str, timeframe: str):
+                async with sem:
+                    t0 = time.perf_counter()
+                    try:
+                        return await exchange.fetch_ohlcv(symbol, timeframe=timeframe,
+                                                          since=plans[(symbol, timeframe)][1],
+                                                          limit=limits[(symbol, timeframe)])
+                    except Exception:
+                        metrics.inc('ohlcv_fetch_errors_total')
+                        return None
+                    finally:
+                        metrics.observe('ohlcv_fetch_seconds', time.perf_counter() - t0, mode='async')
+
+            fetched = dict(zip(todo, await asyncio.gather(*(one(s, tf) for s, tf in todo))))
+    return await asyncio.to_thread(_merge_many, ex_id, pairs, fetched, limits)
+
+
+def get_ohlcv_many(pairs: Iterable[Pair], limit: int = 150, concurrency: Optional[int] = None,
+                   frames: bool = True, siblings: Optional[Dict[str, Iterable[str]]] = None
+                   ) -> Dict[Pair, object]:
+    """Blocking wrapper around `fetch_ohlcv_many` for threads without an event loop.
+
+    Runs on the shared fetch loop (`exchanges.run_async`), so the async
+    exchange client and its HTTP session are reused across calls.
+    """
+    return run_async(fetch_ohlcv_many(pairs, limit=limit, concurrency=concurrency, frames=frames,
+                                        siblings=siblings))
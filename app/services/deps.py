@@ -0,0 +1,16 @@
+"""Checks for optional dependencies that don't import them.
+
+Importing ccxt or mplfinance takes seconds, so modules that use them test
+for them with `installed()` at import time and import them on first use.
+"""
+
+import importlib.util
+import sys
+
+
+def installed(name: str) -> bool:
+    """True if module `name` is imported or importable (found, not imported)."""
+    try:
+        return name in sys.modules or importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+"""Process-wide registry of ccxt exchange clients.
+
+Clients are pooled per (exchange id, api key, secret). Each client keeps its
+own HTTP session and is checked out by one thread at a time, since ccxt's sync
+clients are not thread-safe. Market metadata is loaded once per key and shared
+by every client in the pool, then refreshed after `EXCHANGE_MARKETS_TTL_SEC`.
+
+Batched async fetches run on one long-lived event loop (`run_async`), which
+keeps one ccxt.async_support client per key open across calls;
+`close_exchange_clients()` closes them at shutdown.
+
+Env:
+  - EXCHANGE_ID (default: binance)
+  - EXCHANGE_API_KEY / EXCHANGE_API_SECRET (optional)
+  - EXCHANGE_POOL_SIZE (default: 4) clients per key
+  - EXCHANGE_MARKETS_TTL_SEC (default: 3600)
+"""
+
+import asyncio
+import importlib
+import os
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from app.services.deps import installed
+
+# importing ccxt takes seconds; it is deferred until the first client is made
+CCXT_AVAILABLE = installed('ccxt')
+_modules: Dict[str, object] = {}
+
+
+def _ccxt(name: str = 'ccxt'):
+    """The imported module `name` ('ccxt' or 'ccxt.async_support'), or None if unavailable."""
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except Exception:
+            _modules[name] = None
+    return _modules[name]
+
+PoolKey = Tuple[str, Optional[str], Optional[str]]
+
+_pools: Dict[PoolKey, dict] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_key(ex_id: Optional[str] = None) -> PoolKey:
+    return (
+        ex_id or os.getenv('EXCHANGE_ID', 'binance'),
+        os.getenv('EXCHANGE_API_KEY'),
+        os.getenv('EXCHANGE_API_SECRET'),
+    )
+
+
+def _markets_ttl() -> float:
+    try:
+        return float(os.getenv('EXCHANGE_MARKETS_TTL_SEC', '3600'))
+    except ValueError:
+        return 3600.0
+
+
+def _get_pool(key: PoolKey) -> Optional[dict]:
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            cls = getattr(_ccxt(), key[0], None) if CCXT_AVAILABLE else None
+            if cls is None:
+                return None
+            pool = {
+                'cls': cls,
+                'idle': queue.LifoQueue(),
+                'created': 0,
+                'size': max(1, int(os.getenv('EXCHANGE_POOL_SIZE', '4'))),
+                'markets': None,
+                'markets_at': 0.0,
+                'markets_gen': 0,
+                'lock': threading.Lock(),
+                'load_lock': threading.Lock(),
+            }
+            _pools[key] = pool
+        return pool
+
+
+def _client_opts(key: PoolKey) -> dict:
+    opts = {'apiKey': key[1], 'secret': key[2], 'enableRateLimit': True}
+    return {k: v for k, v in opts.items() if v is not None}
+
+
+def _new_client(key: PoolKey, pool: dict):
+    return pool['cls'](_client_opts(key))
+
+
+def _markets_stale(pool: dict) -> bool:
+    with pool['lock']:
+        return pool['markets'] is None or time.monotonic() - pool['markets_at'] > _markets_ttl()
+
+
+def _store_markets(pool: dict, markets) -> int:
+    """Share freshly loaded markets with the pool; returns their generation."""
+    with pool['lock']:
+        pool['markets'] = markets
+        pool['markets_at'] = time.monotonic()
+        pool['markets_gen'] += 1
+        return pool['markets_gen']
+
+
+def _ensure_markets(client, pool: dict) -> None:
+    """Load markets at most once per TTL for the whole pool; share the result.
+
+    One thread loads, outside the pool lock so checkouts aren't blocked on
+    the request. While a refresh is in flight other threads keep the old
+    markets (or wait for the first load). Clients remember the generation
+    they were given, so `set_markets` only re-indexes after a reload.
+    """
+    if _markets_stale(pool):
+        if pool['load_lock'].acquire(blocking=pool['markets'] is None):
+            try:
+                if _markets_stale(pool):  # not just loaded by the thread we waited for
+                    try:
+                        markets = client.load_markets(reload=pool['markets'] is not None)
+                    except Exception:
+                        # keep serving with whatever we had; retry on the next checkout
+                        markets = None
+                    if markets is not None:
+                        # load_markets already indexed them on this client
+                        client._smc_markets_gen = _store_markets(pool, markets)
+            finally:
+                pool['load_lock'].release()
+    with pool['lock']:
+        markets, gen = pool['markets'], pool['markets_gen']
+    if markets is not None and getattr(client, '_smc_markets_gen', None) != gen:
+        client.set_markets(markets)
+        client._smc_markets_gen = gen
+
+
+@contextmanager
+def exchange_client(ex_id: Optional[str] = None) -> Iterator[Optional[object]]:
+    """Check out a ready-to-use ccxt client; yields None if ccxt or the exchange is unavailable.
+
+    Blocks while all `EXCHANGE_POOL_SIZE` clients for the key are in use.
+    """
+    key = _pool_key(ex_id)
+    pool = _get_pool(key)
+    if pool is None:
+        yield None
+        return
+    client = None
+    try:
+        client = pool['idle'].get_nowait()
+    except queue.Empty:
+        with pool['lock']:
+            grow = pool['created'] < pool['size']
+            if grow:
+                pool['created'] += 1
+        if grow:
+            try:
+                client = _new_client(key, pool)
+            except Exception:
+                with pool['lock']:
+                    pool['created'] -= 1
+                raise
+        else:
+            client = pool['idle'].get()
+    try:
+        _ensure_markets(client, pool)
+        yield client
+    finally:
+        pool['idle'].put(client)
+
+
+async def _ensure_markets_async(client, pool: dict) -> None:
+    """`_ensure_markets` for an async client: share the pool's markets, refresh them past the TTL."""
+    if _markets_stale(pool):
+        try:
+            markets = await client.load_markets(reload=pool['markets'] is not None)
+        except Exception:
+            markets = None
+        if markets is not None:
+            client._smc_markets_gen = _store_markets(pool, markets)
+    with pool['lock']:
+        markets, gen = pool['markets'], pool['markets_gen']
+    if markets is not None and getattr(client, '_smc_markets_gen', None) != gen:
+        client.set_markets(markets)
+        client._smc_markets_gen = gen
+
+
+# the fetch loop: one long-lived event loop whose async clients stay open
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_async_clients: Dict[PoolKey, dict] = {}
+
+
+def _fetch_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='exchange-loop', daemon=True).start()
+        return _loop
+
+
+def run_async(coro, timeout: Optional[float] = None):
+    """Run `coro` on the shared fetch loop and wait for its result.
+
+    Async clients used on that loop are kept between calls, so their HTTP
+    sessions and rate limiters persist across scan cycles. Must not be
+    called from the fetch loop itself.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _fetch_loop()).result(timeout)
+
+
+@asynccontextmanager
+async def async_exchange_client(ex_id: Optional[str] = None) -> AsyncIterator[Optional[object]]:
+    """Yield a ccxt.async_support client; yields None if the async interface is unavailable.
+
+    All requests made through the yielded client share its rate limiter.
+    On the fetch loop (`run_async`) the client is created once per key and
+    kept open; on any other loop it lives for this one batch and is closed.
+    Markets come from the sync pool's cache when fresh, and a fresh load is
+    shared back to it.
+    """
+    key = _pool_key(ex_id)
+    cls = getattr(_ccxt('ccxt.async_support'), key[0], None) if CCXT_AVAILABLE else None
+    pool = _get_pool(key)
+    if cls is None or pool is None:
+        yield None
+        return
+    if asyncio.get_running_loop() is _loop:
+        # only coroutines on this loop touch the entry, so no thread lock is needed
+        entry = _async_clients.get(key)
+        if entry is None:
+            entry = _async_clients[key] = {'client': cls(_client_opts(key)), 'lock': asyncio.Lock()}
+        async with entry['lock']:
+            await _ensure_markets_async(entry['client'], pool)
+        yield entry['client']
+        return
+    client = cls(_client_opts(key))
+    try:
+        await _ensure_markets_async(client, pool)
+        yield client
+    finally:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+async def _close_async_clients() -> None:
+    clients = [e['client'] for e in _async_clients.values()]
+    _async_clients.clear()
+    for client in clients:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+def close_exchange_clients(timeout: float = 10.0) -> None:
+    """Close the fetch loop's async clients and stop the loop (at shutdown)."""
+    global _loop
+    with _loop_lock:
+        loop, _loop = _loop, None
+    if loop is None or loop.is_closed():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_close_async_clients(), loop).result(timeout)
+    except Exception:
+        pass
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def reset_exchange_pools() -> None:
+    """Drop every pooled client (e.g. after credentials change)."""
+    with _pools_lock:
+        _pools.clear()
+    with _loop_lock:
+        loop = _loop
+    if loop is not None and not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(_close_async_clients(), loop)
@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+"""Smart-money-concept primitives computed over whole OHLC arrays.
+
+Every function works on NumPy arrays aligned bar-by-bar with the input and
+never loops over bars in Python. Levels derived from swing points only become
+visible `swing_len` bars after the pivot, so a value at bar i never depends on
+bars after i.
+"""
+
+from collections import deque
+from typing import Dict, Optional
+
+import numpy as np
+
+FeatureMap = Dict[str, Dict[str, np.ndarray]]
+
+
+def ohlc_arrays(data) -> Optional[Dict[str, np.ndarray]]:
+    """Return float64 open/high/low/close arrays from an OHLCV DataFrame."""
+    if data is None or len(data) == 0:
+        return None
+    return {
+        'open': np.asarray(data['Open'], dtype=np.float64),
+        'high': np.asarray(data['High'], dtype=np.float64),
+        'low': np.asarray(data['Low'], dtype=np.float64),
+        'close': np.asarray(data['Close'], dtype=np.float64),
+    }
+
+
+def _last_index(mask: np.ndarray) -> np.ndarray:
+    """For each bar, index of the latest True at or before it (-1 if none)."""
+    idx = np.where(mask, np.arange(mask.size), -1)
+    return np.maximum.accumulate(idx) if idx.size else idx
+
+
+def _ffill(mask: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Carry values[j] forward from every bar j where mask is True (NaN before the first)."""
+    last = _last_index(mask)
+    out = np.full(mask.size, np.nan)
+    ok = last >= 0
+    out[ok] = values[last[ok]]
+    return out
+
+
+def swing_points(high: np.ndarray, low: np.ndarray, swing_len: int = 2):
+    """Fractal swing highs/lows: the extreme of a centred 2*swing_len+1 window.
+
+    Returns boolean masks aligned to the pivot bar.
+    """
+    n = high.size
+    sh = np.zeros(n, dtype=bool)
+    sl = np.zeros(n, dtype=bool)
+    w = 2 * swing_len + 1
+    if n < w:
+        return sh, sl
+    hw = np.lib.stride_tricks.sliding_window_view(high, w)
+    lw = np.lib.stride_tricks.sliding_window_view(low, w)
+    sh[swing_len:n - swing_len] = hw[:, swing_len] == hw.max(axis=1)
+    sl[swing_len:n - swing_len] = lw[:, swing_len] == lw.min(axis=1)
+    return sh, sl
+
+
+def swing_levels(high: np.ndarray, low: np.ndarray, swing_len: int = 2):
+    """Latest confirmed swing high / low level as known at each bar."""
+    sh, sl = swing_points(high, low, swing_len)
+    # a pivot at j is confirmed at j + swing_len
+    conf_h = np.zeros_like(sh)
+    conf_l = np.zeros_like(sl)
+    conf_h[swing_len:] = sh[:sh.size - swing_len]
+    conf_l[swing_len:] = sl[:sl.size - swing_len]
+    src_h = np.empty_like(high)
+    src_l = np.empty_like(low)
+    src_h[swing_len:] = high[:high.size - swing_len]
+    src_l[swing_len:] = low[:low.size - swing_len]
+    return _ffill(conf_h, src_h), _ffill(conf_l, src_l)
+
+
+def _crossed_above(x: np.ndarray, level: np.ndarray) -> np.ndarray:
+    prev = np.concatenate(([np.nan], x[:-1]))
+    with np.errstate(invalid='ignore'):
+        return (x > level) & ~(prev > level)
+
+
+def _crossed_below(x: np.ndarray, level: np.ndarray) -> np.ndarray:
+    prev = np.concatenate(([np.nan], x[:-1]))
+    with np.errstate(invalid='ignore'):
+        return (x < level) & ~(prev < level)
+
+
+def break_of_structure(close: np.ndarray, swing_high: np.ndarray, swing_low: np.ndarray) -> np.ndarray:
+    """+1 where close breaks above the last swing high, -1 below the last swing low."""
+    out = np.zeros(close.size, dtype=np.int8)
+    out[_crossed_above(close, swing_high)] = 1
+    out[_crossed_below(close, swing_low)] = -1
+    return out
+
+
+def order_blocks(o: np.ndarray, h: np.ndarray, l: np.ndarray, c: np.ndarray, bos: np.ndarray):
+    """Order block behind each break of structure.
+
+    A bullish OB is the last down candle before an upward BOS, a bearish OB
+    the last up candle before a downward BOS. Returns (side, top, bottom)
+    aligned to the BOS bar; side is +1/-1/0 and bounds are NaN where side is 0.
+    """
+    n = c.size
+    # strictly before the BOS bar
+    last_down = np.full(n, -1)
+    last_up = np.full(n, -1)
+    last_down[1:] = _last_index(c < o)[:-1]
+    last_up[1:] = _last_index(c > o)[:-1]
+    src = np.where(bos > 0, last_down, np.where(bos < 0, last_up, -1))
+    side = np.where(src >= 0, bos, 0).astype(np.int8)
+    top = np.full(n, np.nan)
+    bottom = np.full(n, np.nan)
+    ok = side != 0
+    top[ok] = h[src[ok]]
+    bottom[ok] = l[src[ok]]
+    return side, top, bottom
+
+
+def liquidity_sweeps(h: np.ndarray, l: np.ndarray, c: np.ndarray, swing_high: np.ndarray, swing_low: np.ndarray) -> np.ndarray:
+    """+1 for a sell-side sweep (wick below the last swing low, close back above),
+    -1 for a buy-side sweep (wick above the last swing high, close back below)."""
+    out = np.zeros(c.size, dtype=np.int8)
+    with np.errstate(invalid='ignore'):
+        out[(l < swing_low) & (c > swing_low)] = 1
+        out[(h > swing_high) & (c < swing_high)] = -1
+    return out
+
+
+def fair_value_gaps(h: np.ndarray, l: np.ndarray):
+    """Three-candle imbalances, aligned to the third candle.
+
+    Returns (bull, bear, top, bottom): a bullish gap spans (high[i-2], low[i]),
+    a bearish gap spans (high[i], low[i-2]).
+    """
+    n = h.size
+    bull = np.zeros(n, dtype=bool)
+    bear = np.zeros(n, dtype=bool)
+    top = np.full(n, np.nan)
+    bottom = np.full(n, np.nan)
+    if n < 3:
+        return bull, bear, top, bottom
+    bull[2:] = l[2:] > h[:-2]
+    bear[2:] = h[2:] < l[:-2]
+    top[2:] = np.where(bull[2:], l[2:], np.where(bear[2:], l[:-2], np.nan))
+    bottom[2:] = np.where(bull[2:], h[:-2], np.where(bear[2:], h[2:], np.nan))
+    return bull, bear, top, bottom
+
+
+def balanced_price_ranges(h: np.ndarray, l: np.ndarray):
+    """Overlap of a new FVG with the most recent opposite FVG.
+
+    Returns (exists, top, bottom) aligned to the bar of the newer gap.
+    """
+    bull, bear, top, bottom = fair_value_gaps(h, l)
+    bull_top, bull_bot = _ffill(bull, top), _ffill(bull, bottom)
+    bear_top, bear_bot = _ffill(bear, top), _ffill(bear, bottom)
+    o_top = np.where(bull, bear_top, np.where(bear, bull_top, np.nan))
+    o_bot = np.where(bull, bear_bot, np.where(bear, bull_bot, np.nan))
+    with np.errstate(invalid='ignore'):
+        # NaN (no opposite gap yet) must propagate, so no fmin/fmax here
+        b_top = np.minimum(top, o_top)
+        b_bot = np.maximum(bottom, o_bot)
+        exists = b_top > b_bot
+    return exists, np.where(exists, b_top, np.nan), np.where(exists, b_bot, np.nan)
+
+
+def compute_features(data, swing_len: int = 2) -> Optional[FeatureMap]:
+    """Compute every primitive the pattern DSL can reference.
+
+    Returns {feature: {attribute: array}}, e.g. features['bos']['direction'].
+    """
+    arr = ohlc_arrays(data)
+    if arr is None:
+        return None
+    o, h, l, c = arr['open'], arr['high'], arr['low'], arr['close']
+    sw_high, sw_low = swing_levels(h, l, swing_len)
+    bos = break_of_structure(c, sw_high, sw_low)
+    ob_side, ob_top, ob_bottom = order_blocks(o, h, l, c, bos)
+    fvg_bull, fvg_bear, fvg_top, fvg_bottom = fair_value_gaps(h, l)
+    bpr_exists, bpr_top, bpr_bottom = balanced_price_ranges(h, l)
+    return {
+        'swing': {'high': sw_high, 'low': sw_low},
+        'bos': {'direction': bos},
+        'ob': {'side': ob_side, 'top': ob_top, 'bottom': ob_bottom},
+        'sweep': {'type': liquidity_sweeps(h, l, c, sw_high, sw_low)},
+        'fvg': {
+            'direction': fvg_bull.astype(np.int8) - fvg_bear.astype(np.int8),
+            'top': fvg_top,
+            'bottom': fvg_bottom,
+        },
+        'bpr': {'exists': bpr_exists, 'top': bpr_top, 'bottom': bpr_bottom},
+    }
+
+
+# (feature, attribute) pairs with discrete values; FeatureState tracks the
+# last bar each non-zero value was seen so lookback checks stay O(1)
+DISCRETE_ATTRS = (
+    ('bos', 'direction'),
+    ('ob', 'side'),
+    ('sweep', 'type'),
+    ('fvg', 'direction'),
+    ('bpr', 'exists'),
+)
+
+_NAN = float('nan')
+
+
+class FeatureState:
+    """Incremental counterpart of `compute_features`.
+
+    Holds just enough state (the last 2*swing_len+1 highs/lows, current swing
+    levels, the last up/down candle and the last bullish/bearish FVG) to
+    produce the features of a newly appended candle in O(1). The values match
+    the last row of `compute_features` over the same history.
+    """
+
+    def __init__(self, swing_len: int = 2):
+        self.swing_len = swing_len
+        self.window = 2 * swing_len + 1
+        self.count = 0
+        self.highs: deque = deque(maxlen=max(self.window, 3))
+        self.lows: deque = deque(maxlen=max(self.window, 3))
+        self.prev_close = _NAN
+        self.swing_high = _NAN
+        self.swing_low = _NAN
+        self.last_down: Optional[tuple] = None  # (high, low) of last close < open
+        self.last_up: Optional[tuple] = None
+        self.last_bull_fvg = (_NAN, _NAN)  # (top, bottom)
+        self.last_bear_fvg = (_NAN, _NAN)
+        self.last_seen: Dict[tuple, int] = {}
+        self.latest: Optional[Dict[str, Dict[str, float]]] = None
+
+    @classmethod
+    def from_data(cls, data, swing_len: int = 2) -> "FeatureState":
+        """Seed the state from a history with one vectorized pass."""
+        st = cls(swing_len)
+        arr = ohlc_arrays(data)
+        if arr is None:
+            return st
+        feats = compute_features(data, swing_len)
+        o, h, l, c = arr['open'], arr['high'], arr['low'], arr['close']
+        n = c.size
+        st.count = n
+        st.highs.extend(h[-st.highs.maxlen:].tolist())
+        st.lows.extend(l[-st.lows.maxlen:].tolist())
+        st.prev_close = float(c[-1])
+        st.swing_high = float(feats['swing']['high'][-1])
+        st.swing_low = float(feats['swing']['low'][-1])
+        down = np.flatnonzero(c < o)
+        up = np.flatnonzero(c > o)
+        st.last_down = (float(h[down[-1]]), float(l[down[-1]])) if down.size else None
+        st.last_up = (float(h[up[-1]]), float(l[up[-1]])) if up.size else None
+        fdir, ftop, fbot = feats['fvg']['direction'], feats['fvg']['top'], feats['fvg']['bottom']
+        bull = np.flatnonzero(fdir > 0)
+        bear = np.flatnonzero(fdir < 0)
+        if bull.size:
+            st.last_bull_fvg = (float(ftop[bull[-1]]), float(fbot[bull[-1]]))
+        if bear.size:
+            st.last_bear_fvg = (float(ftop[bear[-1]]), float(fbot[bear[-1]]))
+        for feature, attr in DISCRETE_ATTRS:
+            vals = feats[feature][attr].astype(np.int8)
+            for v in np.unique(vals[vals != 0]).tolist():
+                st.last_seen[(feature, attr, v)] = int(np.flatnonzero(vals == v)[-1])
+        st.latest = {f: {a: v[-1].item() for a, v in attrs.items()} for f, attrs in feats.items()}
+        return st
+
+    def bars_since(self, feature: str, attr: str, value) -> Optional[int]:
+        """Bars since `feature.attr` last had `value` (0 = latest bar), or None."""
+        seen = self.last_seen.get((feature, attr, int(value)))
+        return None if seen is None else self.count - 1 - seen
+
+    def update(self, o: float, h: float, l: float, c: float) -> Dict[str, Dict[str, float]]:
+        """Append one closed candle and return its features."""
+        L = self.swing_len
+        i = self.count
+        h2 = self.highs[-2] if len(self.highs) >= 2 else _NAN
+        l2 = self.lows[-2] if len(self.lows) >= 2 else _NAN
+        self.highs.append(h)
+        self.lows.append(l)
+
+        if i >= 2 * L:
+            hw = list(self.highs)[-self.window:]
+            lw = list(self.lows)[-self.window:]
+            if hw[L] == max(hw):
+                self.swing_high = hw[L]
+            if lw[L] == min(lw):
+                self.swing_low = lw[L]
+        sh, sl = self.swing_high, self.swing_low
+
+        bos = 0
+        if c > sh and not self.prev_close > sh:
+            bos = 1
+        if c < sl and not self.prev_close < sl:
+            bos = -1
+
+        src = self.last_down if bos > 0 else self.last_up if bos < 0 else None
+        ob_side = bos if src is not None else 0
+        ob_top, ob_bottom = src if src is not None else (_NAN, _NAN)
+
+        sweep = 0
+        if l < sl and c > sl:
+            sweep = 1
+        if h > sh and c < sh:
+            sweep = -1
+
+        fvg = 0
+        f_top = f_bottom = _NAN
+        if l > h2:
+            fvg, f_top, f_bottom = 1, l, h2
+        elif h < l2:
+            fvg, f_top, f_bottom = -1, l2, h
+        bpr = False
+        b_top = b_bottom = _NAN
+        if fvg:
+            opp = self.last_bear_fvg if fvg > 0 else self.last_bull_fvg
+            t, b = min(f_top, opp[0]), max(f_bottom, opp[1])
+            if opp[0] == opp[0] and t > b:  # opp is NaN until the first opposite gap
+                bpr, b_top, b_bottom = True, t, b
+            if fvg > 0:
+                self.last_bull_fvg = (f_top, f_bottom)
+            else:
+                self.last_bear_fvg = (f_top, f_bottom)
+
+        if c < o:
+            self.last_down = (h, l)
+        elif c > o:
+            self.last_up = (h, l)
+        self.prev_close = c
+        self.count = i + 1
+
+        out = {
+            'swing': {'high': sh, 'low': sl},
+            'bos': {'direction': bos},
+            'ob': {'side': ob_side, 'top': ob_top, 'bottom': ob_bottom},
+            'sweep': {'type': sweep},
+            'fvg': {'direction': fvg, 'top': f_top, 'bottom': f_bottom},
+            'bpr': {'exists': bpr, 'top': b_top, 'bottom': b_bottom},
+        }
+        for feature, attr in DISCRETE_ATTRS:
+            v = int(out[feature][attr])
+            if v:
+                self.last_seen[(feature, attr, v)] = i
+        self.latest = out
+        return out
@@ -1,30 +1,338 @@
-from app.models.db import get_conn
+from __future__ import annotations
+
+"""Alert records and queued Telegram delivery.
+
+`send_telegram_alert` only enqueues; a single background thread owns the
+transport (one `telegram.Bot` for the process) and delivers in order:
+  - alerts arriving within TELEGRAM_BATCH_WINDOW_MS (default: 1000) of each
+    other are coalesced: photos into one media group (up to 10), text-only
+    alerts into one digest message;
+  - sends to a chat are spaced by 1/TELEGRAM_CHAT_RATE seconds (default: 1
+    msg/s, Telegram's per-chat limit);
+  - failures are retried up to TELEGRAM_MAX_RETRIES (default: 5) with
+    exponential backoff, honouring Telegram's RetryAfter when given;
+  - the returned message id is written to `alerts.telegram_msg_id`.
+
+TELEGRAM_TRANSPORT=stub swaps the Bot for an in-memory transport (append
+TELEGRAM_STUB_LOG=path to also write each send as a JSON line), so the queue
+can be exercised without a token or network.
+"""
+
+import inspect
+import itertools
+import json
+import logging
 import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple, Union
+
+from app.models.db import submit_write
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GROUP_MAX = 10
+TEXT_MAX = 4096
+CAPTION_MAX = 1024
 
 
 def save_alert_record(event_id: int, image_path: str):
-    conn = get_conn()
-    conn.execute(
+    """Queue the alert row; it is committed with the writer's next batch."""
+    return submit_write(lambda conn: conn.execute(
         "INSERT INTO alerts (event_id, image_path) VALUES (?,?)",
         (event_id, image_path),
-    )
-    conn.commit()
+    ).lastrowid)
 
 
-def send_telegram_alert(text: str, image_path: str | None = None) -> None:
-    """Try to send a Telegram message with optional photo. Fails gracefully."""
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    chat_id = os.getenv('TELEGRAM_CHAT_ID')
-    if not token or not chat_id:
-        return
+def _env_float(name: str, default: float) -> float:
     try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+# --- transports: send_* return the Telegram message id(s) ---
+
+class StubTransport:
+    """Records sends instead of calling Telegram."""
+
+    def __init__(self, log_path: Optional[str] = None):
+        self.sent: List[dict] = []
+        self.log_path = log_path
+        self._ids = itertools.count(1)
+
+    def _record(self, kind: str, chat_id: str, items: list) -> List[int]:
+        ids = [next(self._ids) for _ in items]
+        entry = {'kind': kind, 'chat_id': chat_id, 'items': items, 'message_ids': ids, 'at': time.time()}
+        self.sent.append(entry)
+        if self.log_path:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+        return ids
+
+    def send_message(self, chat_id: str, text: str) -> int:
+        return self._record('message', chat_id, [{'text': text}])[0]
+
+    def send_photo(self, chat_id: str, path: str, caption: str) -> int:
+        return self._record('photo', chat_id, [{'photo': path, 'caption': caption}])[0]
+
+    def send_media_group(self, chat_id: str, photos: List[Tuple[str, str]]) -> List[int]:
+        return self._record('media_group', chat_id, [{'photo': p, 'caption': c} for p, c in photos])
+
+
+class BotTransport:
+    """One python-telegram-bot client for the process (sync v13 or async v20+ API)."""
+
+    def __init__(self, token: str):
         from telegram import Bot  # type: ignore
-        bot = Bot(token=token)
-        if image_path and os.path.exists(image_path):
-            with open(image_path, 'rb') as f:
-                bot.send_photo(chat_id=chat_id, photo=f, caption=text)
-        else:
-            bot.send_message(chat_id=chat_id, text=text)
+        self.bot = Bot(token=token)
+        self._loop = None
+        init = getattr(self.bot, 'initialize', None)
+        if init is not None:
+            self._run(init())
+
+    def _run(self, res):
+        if not inspect.isawaitable(res):
+            return res
+        if self._loop is None:
+            import asyncio
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(res)
+
+    def send_message(self, chat_id: str, text: str) -> int:
+        return self._run(self.bot.send_message(chat_id=chat_id, text=text)).message_id
+
+    def send_photo(self, chat_id: str, path: str, caption: str) -> int:
+        with open(path, 'rb') as f:
+            return self._run(self.bot.send_photo(chat_id=chat_id, photo=f, caption=caption)).message_id
+
+    def send_media_group(self, chat_id: str, photos: List[Tuple[str, str]]) -> List[int]:
+        from telegram import InputMediaPhoto  # type: ignore
+        files = [open(p, 'rb') for p, _ in photos]
+        try:
+            media = [InputMediaPhoto(media=f, caption=c) for f, (_, c) in zip(files, photos)]
+            return [m.message_id for m in self._run(self.bot.send_media_group(chat_id=chat_id, media=media))]
+        finally:
+            for f in files:
+                f.close()
+
+
+def _make_transport():
+    kind = os.getenv('TELEGRAM_TRANSPORT', 'bot').lower()
+    if kind == 'stub':
+        return StubTransport(os.getenv('TELEGRAM_STUB_LOG'))
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        return None
+    try:
+        return BotTransport(token)
     except Exception:
-        # Silently ignore; logging could be added later
-        return
+        logger.exception("Telegram bot unavailable; alerts will not be delivered")
+        return None
+
+
+# --- delivery queue ---
+
+AlertRef = Union[int, Future, None]
+ImageRef = Union[str, Future, None]  # a path, or a render future resolving to one
+_Item = Tuple[str, str, ImageRef, AlertRef]  # (chat_id, text, image, alert id or future)
+
+_q: "queue.Queue[_Item]" = queue.Queue(maxsize=max(1, int(os.getenv('TELEGRAM_QUEUE_MAX', '1000'))))
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+_transport = None
+_last_sent: dict = {}  # chat_id -> monotonic time of the last send
+
+
+def get_transport():
+    """The process's transport, created on first use (None if Telegram is not configured)."""
+    global _transport
+    with _worker_lock:
+        if _transport is None:
+            _transport = _make_transport()
+        return _transport
+
+
+def _pace(chat_id: str) -> None:
+    gap = 1.0 / max(1e-6, _env_float('TELEGRAM_CHAT_RATE', 1.0))
+    wait = _last_sent.get(chat_id, 0.0) + gap - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _retry_after(err: Exception) -> Optional[float]:
+    ra = getattr(err, 'retry_after', None)
+    if ra is None:
+        return None
+    return ra.total_seconds() if hasattr(ra, 'total_seconds') else float(ra)
+
+
+def _deliver(transport, kind: str, chat_id: str, send):
+    """Call `send()` with pacing and retries; returns its result or None once retries run out."""
+    retries = int(_env_float('TELEGRAM_MAX_RETRIES', 5))
+    for attempt in range(retries + 1):
+        _pace(chat_id)
+        try:
+            res = send()
+            _last_sent[chat_id] = time.monotonic()
+            metrics.inc('telegram_sent_total', kind=kind)
+            return res
+        except Exception as e:
+            _last_sent[chat_id] = time.monotonic()
+            if attempt == retries:
+                metrics.inc('telegram_failed_total', kind=kind)
+                logger.error("Telegram %s to %s failed after %d attempts: %r", kind, chat_id, attempt + 1, e)
+                return None
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(60.0, 2.0 ** attempt) * (0.5 + random.random() / 2)
+            metrics.inc('telegram_retries_total', kind=kind)
+            logger.warning("Telegram %s to %s failed (%r); retrying in %.1fs", kind, chat_id, e, delay)
+            time.sleep(delay)
+    return None
+
+
+def _record_msg_ids(items: List[_Item], msg_ids: List[Optional[int]]) -> None:
+    pairs = []
+    for (_, _, _, alert), mid in zip(items, msg_ids):
+        if alert is None or mid is None:
+            continue
+        try:
+            alert_id = alert.result(timeout=30) if isinstance(alert, Future) else alert
+        except Exception:
+            continue
+        pairs.append((str(mid), alert_id))
+    if pairs:
+        submit_write(lambda c: c.executemany("UPDATE alerts SET telegram_msg_id=? WHERE id=?", pairs))
+
+
+def _digest(items: List[_Item]) -> List[Tuple[str, List[_Item]]]:
+    """Join texts into as few messages under TEXT_MAX as possible: [(body, items)]."""
+    out: List[Tuple[str, List[_Item]]] = []
+    cur, members = '', []
+    for it in items:
+        line = it[1][:TEXT_MAX]
+        if cur and len(cur) + 1 + len(line) > TEXT_MAX:
+            out.append((cur, members))
+            cur, members = line, [it]
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+            members.append(it)
+    if members:
+        out.append((cur, members))
+    return out
+
+
+def _resolve_image(image: ImageRef) -> Optional[str]:
+    if not isinstance(image, Future):
+        return image
+    try:
+        return image.result(timeout=_env_float('TELEGRAM_IMAGE_WAIT_SEC', 60))
+    except Exception as e:
+        logger.warning("alert image not rendered (%r); sending text only", e)
+        return None
+
+
+def _send_batch(transport, chat_id: str, items: List[_Item]) -> None:
+    items = [(c, text, _resolve_image(image), alert) for c, text, image, alert in items]
+    photos, texts = [], []
+    for it in items:
+        (photos if it[2] and os.path.exists(it[2]) else texts).append(it)
+
+    for i in range(0, len(photos), MEDIA_GROUP_MAX):
+        group = photos[i:i + MEDIA_GROUP_MAX]
+        if len(group) == 1:
+            _, text, path, _ = group[0]
+            mid = _deliver(transport, 'photo', chat_id, lambda: transport.send_photo(chat_id, path, text[:CAPTION_MAX]))
+            _record_msg_ids(group, [mid])
+        else:
+            ids = _deliver(transport, 'media_group', chat_id, lambda: transport.send_media_group(
+                chat_id, [(path, text[:CAPTION_MAX]) for _, text, path, _ in group]))
+            _record_msg_ids(group, list(ids) if ids else [])
+
+    if len(texts) == 1:
+        mid = _deliver(transport, 'message', chat_id, lambda: transport.send_message(chat_id, texts[0][1][:TEXT_MAX]))
+        _record_msg_ids(texts, [mid])
+    elif texts:
+        # a digest is one message for several alerts; each alert records its id
+        for body, members in _digest(texts):
+            mid = _deliver(transport, 'digest', chat_id, lambda: transport.send_message(chat_id, body))
+            _record_msg_ids(members, [mid] * len(members))
+
+
+def _worker_loop() -> None:
+    window = _env_float('TELEGRAM_BATCH_WINDOW_MS', 1000) / 1000.0
+    while True:
+        batch = [_q.get()]
+        deadline = time.monotonic() + window
+        while len(batch) < MEDIA_GROUP_MAX * 2:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(_q.get(timeout=left))
+            except queue.Empty:
+                break
+        try:
+            transport = get_transport()
+            if transport is not None:
+                by_chat: dict = {}
+                for it in batch:
+                    by_chat.setdefault(it[0], []).append(it)
+                for chat_id, items in by_chat.items():
+                    _send_batch(transport, chat_id, items)
+        except Exception:
+            logger.exception("Telegram delivery failed")
+        finally:
+            for _ in batch:
+                _q.task_done()
+
+
+def _ensure_worker() -> None:
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        with _worker_lock:
+            if _worker is None or not _worker.is_alive():
+                _worker = threading.Thread(target=_worker_loop, name='telegram-notifier', daemon=True)
+                _worker.start()
+
+
+def send_telegram_alert(text: str, image_path: ImageRef = None, alert_id: AlertRef = None,
+                        chat_id: Optional[str] = None) -> bool:
+    """Queue a Telegram message with optional photo; never blocks on delivery.
+
+    `image_path` may be a render future (`renderer.submit_event_chart`); the
+    notifier waits up to TELEGRAM_IMAGE_WAIT_SEC (default: 60) for it.
+    `alert_id` (an id or the future from `save_alert_record`) gets the sent
+    message id recorded. Returns False if Telegram isn't configured or the
+    queue is full.
+    """
+    chat_id = chat_id or os.getenv('TELEGRAM_CHAT_ID')
+    stub = os.getenv('TELEGRAM_TRANSPORT', 'bot').lower() == 'stub'
+    if not chat_id or not (stub or os.getenv('TELEGRAM_BOT_TOKEN')):
+        return False
+    _ensure_worker()
+    try:
+        _q.put_nowait((str(chat_id), text, image_path, alert_id))
+    except queue.Full:
+        metrics.inc('telegram_dropped_total')
+        logger.error("Telegram queue full; dropping alert: %s", text)
+        return False
+    return True
+
+
+def flush_notifications(timeout: Optional[float] = None) -> bool:
+    """Wait until every queued alert has been handled; False on timeout."""
+    end = None if timeout is None else time.monotonic() + timeout
+    while _q.unfinished_tasks:
+        if end is not None and time.monotonic() >= end:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+metrics.gauge_fn('telegram_queue_depth', lambda: _q.qsize())
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+"""In-process cache of parsed and compiled patterns.
+
+`get_patterns` returns active DB patterns (or the YAML files in `patterns/`
+when the DB has none), each with its compiled rules under `__rules` and its
+latest template under `__media`. The list is rebuilt only when:
+  - `invalidate_patterns()` is called (pattern/media upload endpoints),
+  - the patterns/media tables change (checked with one cheap query at most
+    every PATTERN_REGISTRY_CHECK_SEC, default 5s, so scan processes that
+    never see the upload call still pick changes up), or
+  - a YAML file in the patterns dir is added, removed or modified.
+Callers must treat the returned dicts as read-only.
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from app.models.db import get_conn
+from app.services.patterns_engine import compile_logic, parse_yaml
+
+PATTERNS_DIR = Path("patterns")
+
+_lock = threading.Lock()
+_patterns: Optional[List[dict]] = None
+_db_sig: Optional[tuple] = None
+_dir_sig: Optional[tuple] = None
+_checked_at = 0.0
+
+
+def _check_interval() -> float:
+    try:
+        return float(os.getenv('PATTERN_REGISTRY_CHECK_SEC', '5'))
+    except ValueError:
+        return 5.0
+
+
+def _db_signature(conn) -> tuple:
+    row = conn.execute(
+        "SELECT (SELECT COUNT(1) FROM patterns WHERE is_active=1), (SELECT MAX(id) FROM patterns), "
+        "(SELECT COUNT(1) FROM pattern_media), (SELECT MAX(id) FROM pattern_media)"
+    ).fetchone()
+    return tuple(row)
+
+
+def _dir_signature(path: Path) -> tuple:
+    if not path.exists():
+        return ()
+    files = list(path.glob('*.yml')) + list(path.glob('*.yaml'))
+    sig = []
+    for p in files:
+        try:
+            sig.append((p.name, p.stat().st_mtime_ns))
+        except OSError:
+            continue
+    return tuple(sorted(sig))
+
+
+def _compile(d: dict) -> dict:
+    try:
+        d['__rules'] = compile_logic(d)
+    except ValueError:
+        # evaluate_rules reports the pattern as unscorable
+        pass
+    return d
+
+
+def _build(conn) -> List[dict]:
+    patterns = []
+    for r in conn.execute(
+        "SELECT id, name, version, yaml, is_active FROM patterns WHERE is_active=1 ORDER BY id DESC"
+    ).fetchall():
+        try:
+            d = parse_yaml(r['yaml'])
+        except Exception:
+            continue
+        d['__db_id'] = r['id']
+        patterns.append(_compile(d))
+    if patterns:
+        media = {
+            r['pattern_id']: str(r['filename']).replace('\\', '/')
+            for r in conn.execute(
+                "SELECT pattern_id, filename FROM pattern_media "
+                "WHERE id IN (SELECT MAX(id) FROM pattern_media GROUP BY pattern_id)"
+            ).fetchall()
+        }
+        for d in patterns:
+            d['__media'] = media.get(d['__db_id'])
+        return patterns
+
+    for p in sorted(list(PATTERNS_DIR.glob('*.yml')) + list(PATTERNS_DIR.glob('*.yaml'))):
+        try:
+            d = parse_yaml(p.read_text(encoding='utf-8'))
+        except Exception:
+            continue
+        d['__db_id'] = None
+        d['__media'] = None
+        patterns.append(_compile(d))
+    return patterns
+
+
+def get_patterns() -> List[dict]:
+    global _patterns, _db_sig, _dir_sig, _checked_at
+    with _lock:
+        now = time.monotonic()
+        if _patterns is not None and now - _checked_at < _check_interval():
+            return _patterns
+        conn = get_conn()
+        db_sig = _db_signature(conn)
+        dir_sig = _dir_signature(PATTERNS_DIR)
+        _checked_at = now
+        if _patterns is None or db_sig != _db_sig or dir_sig != _dir_sig:
+            _patterns = _build(conn)
+            _db_sig, _dir_sig = db_sig, dir_sig
+        return _patterns
+
+
+def invalidate_patterns() -> None:
+    """Force a rebuild on the next `get_patterns` call."""
+    global _patterns
+    with _lock:
+        _patterns = None
@@ -1,6 +1,45 @@
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import yaml
 
+import numpy as np
+
+from app.services.features import DISCRETE_ATTRS, compute_features
+
+# DSL values -> the codes used by the feature arrays in features.py
+VALUE_CODES = {
+    ('bos', 'direction'): {'up': 1, 'down': -1},
+    ('ob', 'side'): {'bullish': 1, 'bearish': -1},
+    ('sweep', 'type'): {'sell_side': 1, 'buy_side': -1},
+    ('fvg', 'direction'): {'bullish': 1, 'bearish': -1},
+}
+
+# UTC hours [start, end) for the `filters.session` values
+SESSION_HOURS = {
+    'ASIA': (0, 9),
+    'LONDON': (7, 16),
+    'NY': (13, 21),
+}
+
+DEFAULT_LOOKBACK = 20
+
+
+def _normalize_weights(weights) -> dict:
+    # `{bos:0.3}` in flow style parses as {'bos:0.3': None}; recover the pairs
+    out = {}
+    if not isinstance(weights, dict):
+        return out
+    for k, v in weights.items():
+        key = str(k)
+        if v is None and ':' in key:
+            key, _, v = key.partition(':')
+        try:
+            out[key.strip()] = float(v)
+        except (TypeError, ValueError):
+            continue
+    return out
+
+
 def parse_yaml(text: str) -> dict:
     data = yaml.safe_load(text)
     if not isinstance(data, dict):
@@ -9,10 +48,12 @@ def parse_yaml(text: str) -> dict:
         raise ValueError("Pattern YAML must include a 'name' field")
     # Normalize optional extensions
     data.setdefault('version', '1.0')
-    data.setdefault('type', 'template_image')
+    data.setdefault('type', 'rules' if 'logic' in data else 'template_image')
     data.setdefault('scoring', {})
     if isinstance(data['scoring'], dict):
         data['scoring'].setdefault('threshold_alert', 0.7)
+        if 'weights' in data['scoring']:
+            data['scoring']['weights'] = _normalize_weights(data['scoring']['weights'])
     return data
 
 def load_patterns_from_dir(path: Path):
@@ -24,3 +65,149 @@ def load_patterns_from_dir(path: Path):
     for p in path.glob('*.yaml'):
         items.append(parse_yaml(p.read_text(encoding='utf-8')))
     return items
+
+
+def compile_logic(pattern: dict) -> List[Tuple[str, str, object]]:
+    """Turn `logic.all` entries like `bos.direction: up` into (feature, attr, code).
+
+    Raises ValueError for predicates the engine cannot evaluate.
+    """
+    logic = pattern.get('logic') or {}
+    preds = logic.get('all', []) if isinstance(logic, dict) else []
+    rules = []
+    for item in preds or []:
+        if not isinstance(item, dict):
+            raise ValueError(f"Invalid logic predicate: {item!r}")
+        for ref, value in item.items():
+            feature, _, attr = str(ref).partition('.')
+            if not attr:
+                raise ValueError(f"Predicate must be 'feature.attribute': {ref!r}")
+            codes = VALUE_CODES.get((feature, attr))
+            if codes is not None:
+                if value not in codes:
+                    raise ValueError(f"Unknown value {value!r} for {ref}")
+                value = codes[value]
+            rules.append((feature, attr, value))
+    return rules
+
+
+def _session_mask(index, session: str) -> Optional[np.ndarray]:
+    hours = SESSION_HOURS.get(str(session).upper())
+    if hours is None:
+        return None
+    if hasattr(index, 'hour'):
+        h = np.asarray(index.hour)
+    elif np.issubdtype(getattr(index, 'dtype', np.dtype(object)), np.datetime64):
+        # numpy datetime64 index (CandleWindow)
+        h = index.astype('datetime64[h]').astype(np.int64) % 24
+    else:
+        return None
+    return (h >= hours[0]) & (h < hours[1])
+
+
+def _recent(mask: np.ndarray, lookback: int) -> np.ndarray:
+    """True where mask was True in the last `lookback` bars (inclusive)."""
+    cs = np.cumsum(mask, dtype=np.int64)
+    prev = np.zeros_like(cs)
+    prev[lookback:] = cs[:-lookback]
+    return cs - prev > 0
+
+
+def score_series(pattern: dict, df, features=None) -> Optional[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """Weighted rule score for every bar of `df`.
+
+    Each predicate counts as satisfied on a bar if it held on any of the
+    previous `logic.lookback` bars (default 20). Weights come from
+    `scoring.weights` keyed by feature name; `session` is matched against
+    `filters.session`. Returns (scores, per-key satisfied masks).
+    """
+    rules = pattern.get('__rules')
+    if rules is None:
+        rules = compile_logic(pattern)
+    if features is None:
+        features = compute_features(df)
+    if features is None:
+        return None
+    n = len(df)
+    logic = pattern.get('logic') or {}
+    lookback = max(1, int(logic.get('lookback', DEFAULT_LOOKBACK)))
+
+    hits: Dict[str, np.ndarray] = {}
+    for feature, attr, value in rules:
+        arr = features.get(feature, {}).get(attr)
+        if arr is None:
+            ok = np.zeros(n, dtype=bool)
+        elif isinstance(value, bool):
+            ok = arr.astype(bool) == value
+        else:
+            ok = arr == value
+        ok = _recent(ok, lookback)
+        hits[feature] = hits[feature] & ok if feature in hits else ok
+
+    weights = dict((pattern.get('scoring') or {}).get('weights') or {})
+    session = (pattern.get('filters') or {}).get('session')
+    if 'session' in weights:
+        mask = _session_mask(df.index, session) if session else None
+        hits['session'] = mask if mask is not None else np.ones(n, dtype=bool)
+    for key in hits:
+        weights.setdefault(key, 1.0 / max(1, len(hits)))
+
+    total = sum(weights[k] for k in hits)
+    scores = np.zeros(n, dtype=np.float64)
+    if total <= 0:
+        return scores, hits
+    for key, ok in hits.items():
+        scores += weights[key] * ok
+    return scores / total, hits
+
+
+def evaluate_rules(pattern: dict, df) -> Optional[float]:
+    """Rule score in [0,1] on the latest bar of `df`; None if it can't be evaluated."""
+    try:
+        res = score_series(pattern, df)
+    except ValueError:
+        return None
+    if res is None or len(res[0]) == 0:
+        return None
+    return float(res[0][-1])
+
+
+def evaluate_rules_state(pattern: dict, state, df=None) -> Optional[float]:
+    """`evaluate_rules` for the newest bar of a `FeatureState`, without recomputing features.
+
+    Each predicate is checked with `state.bars_since`, so this only works for
+    the discrete attributes FeatureState tracks; returns None otherwise (and
+    for an empty state), and callers fall back to `evaluate_rules`. `df`
+    supplies the bar time for `filters.session`.
+    """
+    try:
+        rules = pattern.get('__rules')
+        if rules is None:
+            rules = compile_logic(pattern)
+    except ValueError:
+        return None
+    if state is None or not state.count:
+        return None
+    logic = pattern.get('logic') or {}
+    lookback = max(1, int(logic.get('lookback', DEFAULT_LOOKBACK)))
+
+    hits: Dict[str, bool] = {}
+    for feature, attr, value in rules:
+        if (feature, attr) not in DISCRETE_ATTRS or isinstance(value, str) or not value:
+            return None  # continuous values and "was zero" aren't tracked
+        since = state.bars_since(feature, attr, value)
+        ok = since is not None and since < lookback
+        hits[feature] = hits.get(feature, True) and ok
+
+    weights = dict((pattern.get('scoring') or {}).get('weights') or {})
+    session = (pattern.get('filters') or {}).get('session')
+    if 'session' in weights:
+        mask = _session_mask(df.index[-1:], session) if session and df is not None and len(df) else None
+        hits['session'] = bool(mask[0]) if mask is not None else True
+    for key in hits:
+        weights.setdefault(key, 1.0 / max(1, len(hits)))
+
+    total = sum(weights[k] for k in hits)
+    if total <= 0:
+        return 0.0
+    return float(sum(weights[k] for k, ok in hits.items() if ok) / total)
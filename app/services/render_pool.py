@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+"""Chart rendering in a pool of pre-warmed worker processes.
+
+mplfinance/matplotlib hold the GIL and aren't thread-safe, so rendering in
+the scan threads serializes them. Charts are rendered here instead, in
+`render_workers` spawned processes (config/settings.json, default: 2) that
+import matplotlib (Agg), mplfinance and the chart style once at start-up
+and draw a throwaway chart to warm the font cache.
+
+`submit_render` returns a Future with the PNG path (or the PNG bytes when
+no output name is given). At most `render_queue_max` jobs (default: 32) may
+be queued or running; further submits wait up to `render_submit_timeout_sec`
+(default: 10) for a slot and then fail with `RenderBusy`, so a slow renderer
+holds scans back instead of queueing unbounded work. `render_workers: 0`
+renders in the calling thread (serialized by a lock).
+"""
+
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional, Union
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RenderBusy(RuntimeError):
+    """The render queue stayed full for the whole submit timeout."""
+
+
+def _settings() -> dict:
+    cfg_path = Path('config/settings.json')
+    try:
+        data = json.loads(cfg_path.read_text(encoding='utf-8'))
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+# --- worker side ---
+
+def _warm_worker() -> None:
+    """Process initializer: import and exercise the plotting stack once."""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        from app.services import renderer
+        renderer.warm_plotting()
+    except Exception:
+        # the job falls back to the placeholder image like an in-process render
+        pass
+
+
+def _render_job(symbol: str, timeframe: str, window, out_name: Optional[str]) -> Union[str, bytes]:
+    from app.services import renderer
+    return renderer.render_local(symbol, timeframe, window, out_name)
+
+
+# --- caller side ---
+
+_pool: Optional[ProcessPoolExecutor] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_pool_lock = threading.Lock()
+_local_lock = threading.Lock()
+_pending = 0
+_workers: Optional[int] = None
+
+
+def _get_pool():
+    """(pool, slots) created on first use; pool is None with `render_workers: 0`."""
+    global _pool, _slots, _workers
+    with _pool_lock:
+        if _workers is None:
+            settings = _settings()
+            _workers = max(0, int(settings.get('render_workers', 2)))
+            _slots = threading.BoundedSemaphore(max(1, int(settings.get('render_queue_max', 32))))
+            if _workers:
+                _pool = ProcessPoolExecutor(
+                    max_workers=_workers,
+                    mp_context=multiprocessing.get_context('spawn'),  # no forked threads/locks
+                    initializer=_warm_worker,
+                )
+        return _pool, _slots
+
+
+def start_render_pool() -> None:
+    """Create the pool and start its workers now rather than on the first alert."""
+    pool, _ = _get_pool()
+    if pool is not None:
+        for _ in range(_workers or 0):
+            pool.submit(time.sleep, 0)
+
+
+def _release(fut: Future, t0: float, slots: threading.BoundedSemaphore) -> None:
+    global _pending
+    with _pool_lock:
+        _pending -= 1
+    slots.release()
+    metrics.observe('render_seconds', time.perf_counter() - t0)
+    err = None if fut.cancelled() else fut.exception()
+    if err is not None:
+        metrics.inc('render_errors_total')
+        if isinstance(err, BrokenProcessPool):
+            # a worker died; the next submit starts a fresh pool
+            logger.error("render pool broken; restarting it")
+            shutdown_render_pool()
+
+
+def submit_render(symbol: str, timeframe: str, ohlcv, out_name: Optional[str] = None,
+                  timeout: Optional[float] = None) -> "Future[Union[str, bytes]]":
+    """Queue a candle chart of `ohlcv` (DataFrame or CandleWindow) for rendering.
+
+    The Future resolves to the PNG's web path under storage/images, or to
+    PNG bytes when `out_name` is None. Raises `RenderBusy` if no queue slot
+    frees up within `timeout` (default: `render_submit_timeout_sec`).
+    """
+    global _pending
+    from app.services.candle_buffer import as_window
+    pool, slots = _get_pool()
+    if timeout is None:
+        timeout = float(_settings().get('render_submit_timeout_sec', 10))
+    window = as_window(ohlcv)
+    window = window.copy() if window is not None else None  # detached and small to pickle
+
+    if pool is None:
+        fut: Future = Future()
+        with _local_lock:
+            try:
+                fut.set_result(_render_job(symbol, timeframe, window, out_name))
+            except Exception as e:
+                fut.set_exception(e)
+        return fut
+
+    if not slots.acquire(timeout=timeout):
+        metrics.inc('render_rejected_total')
+        raise RenderBusy(f"render queue full ({symbol} {timeframe})")
+    t0 = time.perf_counter()
+    try:
+        fut = pool.submit(_render_job, symbol, timeframe, window, out_name)
+    except Exception as e:
+        slots.release()
+        if isinstance(e, BrokenProcessPool):
+            shutdown_render_pool()
+        raise
+    with _pool_lock:
+        _pending += 1
+    fut.add_done_callback(lambda f: _release(f, t0, slots))
+    return fut
+
+
+def render(symbol: str, timeframe: str, ohlcv, out_name: Optional[str] = None,
+           timeout: Optional[float] = None) -> Union[str, bytes]:
+    """Blocking `submit_render`: waits for the image (at most `render_timeout_sec`, default: 60)."""
+    fut = submit_render(symbol, timeframe, ohlcv, out_name)
+    if timeout is None:
+        timeout = float(_settings().get('render_timeout_sec', 60))
+    return fut.result(timeout=timeout)
+
+
+def shutdown_render_pool() -> None:
+    global _pool, _slots, _workers
+    with _pool_lock:
+        pool, _pool, _slots, _workers = _pool, None, None, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+metrics.gauge_fn('render_queue_depth', lambda: _pending)
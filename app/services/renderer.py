@@ -1,13 +1,33 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import Future
 from pathlib import Path
 from datetime import datetime
 from typing import Optional
 
-try:
-    import mplfinance as mpf  # type: ignore
-    import pandas as pd  # type: ignore
-    MPL_AVAILABLE = True
-except Exception:
-    MPL_AVAILABLE = False
+import numpy as np
+
+from app.services.candle_buffer import as_frame
+from app.services import render_pool
+from app.services.deps import installed
+
+logger = logging.getLogger(__name__)
+
+
+# mplfinance pulls in matplotlib: it is only imported on the first plot,
+# which normally happens in a render-pool worker (see render_pool.py)
+MPL_AVAILABLE = installed('mplfinance') and installed('pandas')
+_mpf = None
+
+
+def _mplfinance():
+    global _mpf
+    if _mpf is None:
+        import mplfinance  # type: ignore
+        _mpf = mplfinance
+    return _mpf
 
 try:
     from PIL import Image, ImageDraw, ImageFont
@@ -23,25 +43,52 @@ def _ensure_dir() -> Path:
     return img_dir
 
 
-def render_chart_png(symbol: str, timeframe: str, ohlcv_df: Optional["pd.DataFrame"], out_name: str) -> str:
-    """Render a chart to PNG if mplfinance available; fallback to simple PIL text image.
+_style = None
+
+
+def _chart_style():
+    global _style
+    if _style is None:
+        _style = _mplfinance().make_mpf_style(base_mpf_style='charles')
+    return _style
+
+
+def warm_plotting() -> None:
+    """Load the chart style and draw one throwaway chart (fonts, caches) in this process."""
+    if not MPL_AVAILABLE:
+        return
+    import pandas as pd  # type: ignore
+    idx = pd.date_range('2024-01-01', periods=3, freq='min')
+    df = pd.DataFrame({'Open': [1, 2, 3], 'High': [2, 3, 4], 'Low': [0, 1, 2], 'Close': [2, 3, 4], 'Volume': [1, 1, 1]},
+                      index=idx, dtype=float)
+    _mplfinance().plot(df, type='candle', style=_chart_style(), volume=False,
+             savefig=dict(fname=io.BytesIO(), format='png', dpi=30))
 
-    Returns web path (forward slashes).
+
+def render_local(symbol: str, timeframe: str, ohlcv_df, out_name: Optional[str]):
+    """Render in this process: the PNG's web path, or PNG bytes when `out_name` is None.
+
+    Uses mplfinance when available, else a simple PIL text image. Not
+    thread-safe with mplfinance; `render_chart_png` goes through the render pool.
     """
-    img_dir = _ensure_dir()
-    fpath = img_dir / f"{out_name}.png"
+    target = io.BytesIO() if out_name is None else _ensure_dir() / f"{out_name}.png"
+    ohlcv_df = as_frame(ohlcv_df)  # mplfinance needs pandas
+
+    def done():
+        return target.getvalue() if out_name is None else str(target).replace('\\', '/')
 
     if MPL_AVAILABLE and ohlcv_df is not None and not ohlcv_df.empty:
         try:
-            mpf.plot(
+            _mplfinance().plot(
                 ohlcv_df,
                 type='candle',
-                style='charles',
+                style=_chart_style(),
                 volume=False,
-                savefig=dict(fname=str(fpath), dpi=120, bbox_inches='tight'),
+                savefig=dict(fname=target if out_name is None else str(target), format='png',
+                             dpi=120, bbox_inches='tight'),
                 tight_layout=True,
             )
-            return str(fpath).replace('\\', '/')
+            return done()
         except Exception:
             pass
 
@@ -51,15 +98,160 @@ def render_chart_png(symbol: str, timeframe: str, ohlcv_df: Optional["pd.DataFra
         draw = ImageDraw.Draw(img)
         text = f"{symbol} {timeframe}\n{datetime.utcnow().isoformat()}Z"
         draw.text((20, 20), text, fill=(220, 220, 220))
-        img.save(fpath)
+        img.save(target, format='PNG')
+    elif out_name is None:
+        return b''
     else:
         # absolute last resort: write a .txt renamed as .png (not ideal)
-        fpath.write_text(
+        target.write_text(
             f"Placeholder image for {symbol} {timeframe} at {datetime.utcnow().isoformat()}Z\n",
             encoding='utf-8',
         )
-    return str(fpath).replace('\\', '/')
+    return done()
+
+
+def _use_pool(ohlcv_df) -> bool:
+    return MPL_AVAILABLE and ohlcv_df is not None and len(ohlcv_df) > 0
+
+
+def render_chart_png(symbol: str, timeframe: str, ohlcv_df: Optional["pd.DataFrame"], out_name: str) -> str:
+    """Render a chart to PNG if mplfinance available; fallback to simple PIL text image.
+
+    Candle charts are drawn by the render pool (services/render_pool.py);
+    this blocks until the image is written. If the pool is saturated or
+    fails, the placeholder image is written instead. Returns web path
+    (forward slashes).
+    """
+    if _use_pool(ohlcv_df):
+        try:
+            return render_pool.render(symbol, timeframe, ohlcv_df, out_name)
+        except Exception as e:
+            logger.warning("chart render for %s %s failed (%r); using placeholder", symbol, timeframe, e)
+        return render_local(symbol, timeframe, None, out_name)
+    return render_local(symbol, timeframe, ohlcv_df, out_name)
+
+
+# grayscale levels used by the rasterizer (close to the 'charles' style in L mode)
+RASTER_BG = 255
+RASTER_UP = 90
+RASTER_DOWN = 60
+RASTER_WICK = 40
+
+
+def rasterize_ohlcv(ohlcv_df: Optional["pd.DataFrame"], size: int = 256) -> Optional[np.ndarray]:
+    """Draw candles straight into a (size, size) uint8 grayscale array.
+
+    Used for template similarity instead of an mplfinance PNG: no matplotlib,
+    no file I/O. Each column maps to one bar; the centre column of a bar's
+    slot carries the wick and the middle 70% its body. Returns None without data.
+    """
+    if ohlcv_df is None or len(ohlcv_df) == 0:
+        return None
+    o = np.asarray(ohlcv_df['Open'], dtype=np.float64)
+    h = np.asarray(ohlcv_df['High'], dtype=np.float64)
+    l = np.asarray(ohlcv_df['Low'], dtype=np.float64)
+    c = np.asarray(ohlcv_df['Close'], dtype=np.float64)
+    n = c.size
+    lo, hi = float(np.nanmin(l)), float(np.nanmax(h))
+    span = hi - lo if hi - lo > 1e-12 else 1.0
+
+    def to_row(price: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((hi - price) / span * (size - 1)), 0, size - 1).astype(np.int32)
+
+    cols = np.arange(size)
+    slot = size / n
+    bar = np.minimum((cols * n) // size, n - 1)
+    frac = (cols - bar * slot) / slot  # position inside the bar's slot, [0, 1)
+    centre = np.floor((bar + 0.5) * slot).astype(np.int64) == cols
+    in_body = (frac >= 0.15) & (frac < 0.85) if slot >= 3 else np.ones(size, dtype=bool)
+
+    wick_top, wick_bot = to_row(h[bar]), to_row(l[bar])
+    body_top, body_bot = to_row(np.maximum(o, c)[bar]), to_row(np.minimum(o, c)[bar])
+    rows = np.arange(size)[:, None]
+    wick = centre[None, :] & (rows >= wick_top[None, :]) & (rows <= wick_bot[None, :])
+    body = in_body[None, :] & (rows >= body_top[None, :]) & (rows <= body_bot[None, :])
+
+    img = np.full((size, size), RASTER_BG, dtype=np.uint8)
+    img[wick] = RASTER_WICK
+    body_val = np.where(c[bar] >= o[bar], RASTER_UP, RASTER_DOWN).astype(np.uint8)
+    img[body] = np.broadcast_to(body_val[None, :], (size, size))[body]
+    return img
+
+
+def event_image_name(symbol: str, timeframe: str, event_id: int) -> str:
+    return f"event_{event_id}_{symbol.replace('/', '-')}_{timeframe}"
+
+
+def event_image_path(symbol: str, timeframe: str, event_id: int) -> str:
+    """Web path the event's chart is (or will be) served from; nothing is rendered."""
+    return f"storage/images/{event_image_name(symbol, timeframe, event_id)}.png"
 
 
 def render_placeholder_chart(symbol: str, timeframe: str, event_id: int) -> str:
-    return render_chart_png(symbol, timeframe, None, f"event_{event_id}_{symbol.replace('/', '-')}_{timeframe}")
+    return render_chart_png(symbol, timeframe, None, event_image_name(symbol, timeframe, event_id))
+
+
+_budget_lock = threading.Lock()
+
+
+def enforce_image_budget(max_bytes: Optional[int] = None) -> int:
+    """Delete the least recently used files in storage/images until they fit the budget.
+
+    Budget comes from IMAGES_MAX_MB (default: 200). Returns bytes freed.
+    Evicted event charts are rendered again on the next request.
+    """
+    if max_bytes is None:
+        try:
+            max_bytes = int(float(os.getenv('IMAGES_MAX_MB', '200')) * 1024 * 1024)
+        except ValueError:
+            max_bytes = 200 * 1024 * 1024
+    img_dir = _ensure_dir()
+    freed = 0
+    with _budget_lock:
+        files = []
+        for p in img_dir.iterdir():
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            if p.is_file():
+                files.append((max(st.st_atime, st.st_mtime), st.st_size, p))
+        total = sum(f[1] for f in files)
+        for _, size, p in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+            freed += size
+    return freed
+
+
+def render_event_chart(symbol: str, timeframe: str, event_id: int, ohlcv_df: Optional["pd.DataFrame"]) -> str:
+    """Render the alert chart for an event and keep the images dir within budget."""
+    path = render_chart_png(symbol, timeframe, ohlcv_df, event_image_name(symbol, timeframe, event_id))
+    enforce_image_budget()
+    return path
+
+
+def submit_event_chart(symbol: str, timeframe: str, event_id: int, ohlcv_df) -> "Future[str]":
+    """Non-blocking `render_event_chart`: a Future with the path (`event_image_path`).
+
+    Waits only for a render queue slot; if none frees up, the placeholder
+    is rendered in the caller instead.
+    """
+    name = event_image_name(symbol, timeframe, event_id)
+    fut: Future
+    if _use_pool(ohlcv_df):
+        try:
+            fut = render_pool.submit_render(symbol, timeframe, ohlcv_df, name)
+            fut.add_done_callback(lambda _: enforce_image_budget())
+            return fut
+        except Exception as e:
+            logger.warning("chart render for %s %s not queued (%r); using placeholder", symbol, timeframe, e)
+            ohlcv_df = None
+    fut = Future()
+    fut.set_result(render_event_chart(symbol, timeframe, event_id, ohlcv_df))
+    return fut
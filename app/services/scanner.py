@@ -1,92 +1,252 @@
 from __future__ import annotations
 
-from pathlib import Path
-from typing import Optional, Tuple
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
 
-from app.models.db import get_conn
-from app.services.patterns_engine import load_patterns_from_dir, parse_yaml
-from app.services.renderer import render_placeholder_chart, render_chart_png
-from app.services.scoring import score_simple, similarity_score
+from app.models.db import get_conn, submit_write
+from app.services.patterns_engine import evaluate_rules, evaluate_rules_state
+from app.services.pattern_registry import get_patterns
+from app.services.renderer import event_image_path, rasterize_ohlcv, submit_event_chart
+from app.services.scoring import rank_templates
+from app.services.template_index import candidate_templates
 from app.services.notifier import save_alert_record, send_telegram_alert
-from app.services.data import get_ohlcv_df
+from app.services.data import get_ohlcv_window, last_closed_bar, upto_bar
+from app import metrics
 
+logger = logging.getLogger(__name__)
 
-def run_scan(symbol: str, timeframe: str) -> Tuple[str, float, float, str]:
+
+def _event_key(symbol: str, timeframe: str, pattern_name: str, bar_time: str) -> str:
+    return f"{symbol}|{timeframe}|{pattern_name}|{bar_time}"
+
+
+def _eff_threshold(conn, symbol: str, timeframe: str, p: dict) -> float:
+    wl = conn.execute(
+        "SELECT threshold FROM watchlist WHERE symbol=? AND timeframe=? LIMIT 1",
+        (symbol, timeframe),
+    ).fetchone()
+    wl_threshold = float(wl['threshold']) if wl else 0.7
+    pat_threshold = float(p.get('scoring', {}).get('threshold_alert', 0.7))
+    return max(wl_threshold, pat_threshold)
+
+
+def _insert_event(c, row: tuple):
+    """Insert an event unless its unique_key exists; returns (event_id, inserted)."""
+    cur = c.execute(
+        "INSERT OR IGNORE INTO events (symbol, timeframe, bar_time, pattern_name, score, status, unique_key) "
+        "VALUES (?,?,?,?,?,?,?)",
+        row,
+    )
+    if cur.rowcount:
+        return cur.lastrowid, True
+    hit = c.execute("SELECT id FROM events WHERE unique_key=?", (row[-1],)).fetchone()
+    return hit[0], False
+
+
+def _evaluated(conn, symbol: str, timeframe: str, patterns, bar_time: str):
+    """Earlier event for this bar, if any pattern was already evaluated on it."""
+    keys = [_event_key(symbol, timeframe, p.get('name', 'Unnamed'), bar_time) for p in patterns]
+    marks = ','.join('?' * len(keys))
+    return conn.execute(
+        f"SELECT e.id, e.pattern_name, e.score, e.status, "
+        f"(SELECT a.image_path FROM alerts a WHERE a.event_id=e.id LIMIT 1) AS image_path "
+        f"FROM events e WHERE e.unique_key IN ({marks}) ORDER BY e.id LIMIT 1",
+        keys,
+    ).fetchone()
+
+
+def _slow_scan_sec() -> float:
+    try:
+        return float(os.getenv('SLOW_SCAN_MS', '0')) / 1000.0
+    except ValueError:
+        return 0.0
+
+
+@contextmanager
+def _stage(times: Dict[str, float], name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        times[name] = times.get(name, 0.0) + dt
+        metrics.observe('scan_stage_seconds', dt, stage=name)
+
+
+def _best_pattern(patterns, df, times: Dict[str, float], features=None) -> Tuple[dict, float]:
+    """The best-scoring pattern on `df` and its score (0 if nothing could be scored).
+
+    `features` is an optional `FeatureState` positioned on the last bar of
+    `df` (streaming); rules it can answer skip recomputing the window.
+    """
+    # Rule patterns are evaluated on the arrays directly; a chart is only
+    # rasterized if some template pattern actually has media to compare with.
+    best = None
+    templates = []
+    with _stage(times, 'rules'):
+        for p in patterns:
+            if p.get('type') == 'rules':
+                score = evaluate_rules_state(p, features, df) if features is not None else None
+                if score is None:
+                    score = evaluate_rules(p, df)
+                if score is None:
+                    # not evaluable on this data; never guess a score that could alert
+                    metrics.inc('score_fallback_total', kind='rules')
+                    continue
+                if best is None or score > best[1]:
+                    best = (p, score, None)
+            elif p.get('__media'):
+                templates.append(p)
+
+    refs = [(i, p['__media']) for i, p in enumerate(templates)]
+    if refs:
+        # rasterized in memory; matplotlib is kept for alert images only
+        with _stage(times, 'rasterize'):
+            chart = rasterize_ohlcv(df)
+        if chart is not None:
+            # large libraries: full matching only for the index's nearest templates
+            with _stage(times, 'index'):
+                refs = candidate_templates(chart, refs)
+        with _stage(times, 'templates'):
+            # fft_ncc takes the best of many shifts/scales, so it scores higher
+            # than whole-image ncc and isn't calibrated to the 0.7 thresholds
+            method = os.getenv('TEMPLATE_MATCH_METHOD', 'ncc')
+            scored = dict(rank_templates(chart, refs, method=method)) if chart is not None else {}
+        for i, img_ref in refs:
+            p = templates[i]
+            score = scored.get(i)
+            if score is None:
+                metrics.inc('score_fallback_total', kind='template')
+                continue
+            if best is None or score > best[1]:
+                best = (p, score, img_ref)
+
+    if best is None:
+        # nothing could be scored: a zero score, so the bar is still
+        # recorded (and deduped) but never alerts
+        metrics.inc('score_fallback_total', kind='none')
+        p = patterns[0]
+        score = 0.0
+    else:
+        p, score, _ = best
+    return p, score
+
+
+def run_scan(symbol: str, timeframe: str, df=None, features=None) -> Tuple[str, float, float, str]:
     """Run a single scan for symbol/timeframe.
 
+    `df` lets batch callers pass OHLCV they already fetched (see
+    `data.get_ohlcv_many`), as a DataFrame or a CandleWindow; otherwise it
+    is fetched here as a CandleWindow. The stream passes its `FeatureState`
+    for `df`'s last bar as `features`.
+
+    Each stage is timed into `scan_stage_seconds`; scans slower than
+    SLOW_SCAN_MS (default: 0, off) are logged with their stage breakdown.
+
     Returns: (pattern_name, score, eff_threshold, img_path)
     """
+    times: Dict[str, float] = {}
+    t0 = time.perf_counter()
+    try:
+        return _run_scan(symbol, timeframe, df, times, features)
+    except Exception:
+        metrics.inc('scans_total', result='error')
+        raise
+    finally:
+        total = time.perf_counter() - t0
+        metrics.observe('scan_seconds', total)
+        slow = _slow_scan_sec()
+        if slow and total >= slow:
+            metrics.inc('slow_scans_total')
+            logger.warning(
+                "slow scan %s %s: %.0f ms (%s)", symbol, timeframe, total * 1000,
+                ', '.join(f"{k}={v * 1000:.0f}ms" for k, v in times.items()),
+            )
+
+
+def _run_scan(symbol: str, timeframe: str, df, times: Dict[str, float],
+              features=None) -> Tuple[str, float, float, str]:
     conn = get_conn()
 
-    # load patterns from DB first
-    db_patterns = conn.execute(
-        "SELECT id, name, version, yaml, is_active FROM patterns WHERE is_active=1 ORDER BY id DESC"
-    ).fetchall()
-    patterns = []
-    for r in db_patterns:
-        try:
-            d = parse_yaml(r['yaml'])
-            d['__db_id'] = r['id']
-            patterns.append(d)
-        except Exception:
-            continue
-    if not patterns:
-        patterns = load_patterns_from_dir(Path("patterns"))
-        for d in patterns:
-            d['__db_id'] = None
+    with _stage(times, 'patterns'):
+        patterns = get_patterns()
     if not patterns:
         raise RuntimeError("No patterns available")
 
-    # Get data and render temporary chart
-    df = get_ohlcv_df(symbol, timeframe, limit=150)
-    tmp_img = render_chart_png(symbol, timeframe, df, f"scan_{symbol.replace('/', '-')}_{timeframe}")
+    if df is None:
+        with _stage(times, 'fetch'):
+            df = get_ohlcv_window(symbol, timeframe, limit=150)
 
-    best = None
-    for p in patterns:
-        img_ref = None
-        if p.get('__db_id') is not None:
-            row = conn.execute(
-                "SELECT filename FROM pattern_media WHERE pattern_id=? ORDER BY id DESC LIMIT 1",
-                (p['__db_id'],),
-            ).fetchone()
-            if row:
-                img_ref = str(row['filename']).replace('\\', '/')
-        if not img_ref:
-            continue
-        score = similarity_score(tmp_img, img_ref, method='ncc')
-        if score is None:
-            score = score_simple(p)
-        if best is None or score > best[1]:
-            best = (p, score, img_ref)
+    # Scans are keyed on the last closed bar: score closed bars only, and
+    # return the earlier result if this bar was already evaluated.
+    bar_time = None
+    bar = last_closed_bar(df, timeframe)
+    if bar is not None:
+        n = len(df)
+        df = upto_bar(df, bar)
+        if len(df) != n:
+            features = None  # describes a bar that was cut off
+        bar_time = bar.strftime('%Y-%m-%d %H:%M:%S')
+        with _stage(times, 'dedup'):
+            prev = _evaluated(conn, symbol, timeframe, patterns, bar_time)
+        if prev is not None:
+            metrics.inc('scans_total', result='dedup')
+            p = next((q for q in patterns if q.get('name', 'Unnamed') == prev['pattern_name']), patterns[0])
+            img_path = prev['image_path'] or event_image_path(symbol, timeframe, prev['id'])
+            return prev['pattern_name'], float(prev['score']), float(_eff_threshold(conn, symbol, timeframe, p)), img_path
 
-    if best is None:
-        p = patterns[0]
-        score = score_simple(p)
-    else:
-        p, score, _ = best
+    p, score = _best_pattern(patterns, df, times, features)
 
-    wl = conn.execute(
-        "SELECT threshold FROM watchlist WHERE symbol=? AND timeframe=? LIMIT 1",
-        (symbol, timeframe),
-    ).fetchone()
-    wl_threshold = float(wl['threshold']) if wl else 0.7
-    pat_threshold = float(p.get('scoring', {}).get('threshold_alert', 0.7))
-    eff_threshold = max(wl_threshold, pat_threshold)
+    eff_threshold = _eff_threshold(conn, symbol, timeframe, p)
     status = 'sent' if score >= eff_threshold else 'ignored'
 
-    cur = conn.execute(
-        "INSERT INTO events (symbol, timeframe, pattern_name, score, status) VALUES (?,?,?,?,?)",
-        (symbol, timeframe, p.get('name', 'Unnamed'), float(score), status),
-    )
-    event_id = cur.lastrowid
-    img_path = render_placeholder_chart(symbol, timeframe, event_id)
+    name = p.get('name', 'Unnamed')
+    key = _event_key(symbol, timeframe, name, bar_time) if bar_time else None
+    event_row = (symbol, timeframe, bar_time, name, float(score), status, key)
+    with _stage(times, 'db_insert'):
+        event_id, inserted = submit_write(lambda c: _insert_event(c, event_row)).result()
+    metrics.inc('scans_total', result='scored')
+    # charts are only rendered for alerts; others render on first request
+    img_path = event_image_path(symbol, timeframe, event_id)
+    if not inserted:
+        # a concurrent scan recorded this bar first and owns its alert
+        return name, float(score), float(eff_threshold), img_path
 
     if status == 'sent':
-        save_alert_record(event_id, img_path)
-        send_telegram_alert(
-            text=f"{symbol} {timeframe} | {p.get('name','Unnamed')} | score={score:.2f}",
-            image_path=img_path,
-        )
+        with _stage(times, 'render'):
+            # drawn by the render pool; the notifier waits for the file, not this scan
+            image = submit_event_chart(symbol, timeframe, event_id, df)
+        alert = save_alert_record(event_id, img_path)
+        with _stage(times, 'notify'):
+            # queued; delivery happens on the notifier thread
+            send_telegram_alert(
+                text=f"{symbol} {timeframe} | {p.get('name','Unnamed')} | score={score:.2f}",
+                image_path=image,
+                alert_id=alert,
+            )
 
     return p.get('name', 'Unnamed'), float(score), float(eff_threshold), img_path
 
+
+def score_window(symbol: str, timeframe: str, df, features=None) -> Tuple[str, float, float, Optional[str]]:
+    """Score the last closed bar of `df` like `run_scan`, without recording or alerting.
+
+    Nothing is written to the events table, rendered or sent (replays and
+    other dry runs). Returns (pattern_name, score, eff_threshold, bar_time).
+    """
+    patterns = get_patterns()
+    if not patterns:
+        raise RuntimeError("No patterns available")
+    bar_time = None
+    bar = last_closed_bar(df, timeframe)
+    if bar is not None:
+        n = len(df)
+        df = upto_bar(df, bar)
+        if len(df) != n:
+            features = None
+        bar_time = bar.strftime('%Y-%m-%d %H:%M:%S')
+    p, score = _best_pattern(patterns, df, {}, features)
+    return p.get('name', 'Unnamed'), float(score), float(_eff_threshold(get_conn(), symbol, timeframe, p)), bar_time
@@ -1,11 +1,20 @@
 from __future__ import annotations
 
 import json
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from typing import Optional
 
 from app.models.db import get_conn
+from app.services.data import bar_close_ms, calendar_timeframe, fixed_timeframe_seconds, get_ohlcv_many
 from app.services.scanner import run_scan
+from app import metrics
 
 try:
     from apscheduler.schedulers.background import BackgroundScheduler  # type: ignore
@@ -13,43 +22,401 @@ try:
 except Exception:
     APSCHED_AVAILABLE = False
 
+logger = logging.getLogger(__name__)
 
-def _load_scan_interval(default_sec: int = 60) -> int:
+
+def _load_settings() -> dict:
     cfg_path = Path('config/settings.json')
     if cfg_path.exists():
         try:
             data = json.loads(cfg_path.read_text(encoding='utf-8'))
-            return int(data.get('scan_interval_sec', default_sec))
+            return data if isinstance(data, dict) else {}
         except Exception:
-            return default_sec
-    return default_sec
+            return {}
+    return {}
+
+
+def _load_scan_interval(default_sec: int = 60) -> int:
+    try:
+        return int(_load_settings().get('scan_interval_sec', default_sec))
+    except Exception:
+        return default_sec
 
 
 _scheduler: Optional["BackgroundScheduler"] = None
+_streaming = False
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+# one lock per cycle ('all' or a timeframe), held while it runs; a tick that
+# can't get its lock is skipped
+_cycle_locks: dict = {}
+_cycle_locks_guard = threading.Lock()
+# (symbol, timeframe) pairs submitted and not finished yet, across cycles;
+# includes scans a cycle gave up on that are still running
+_running: set = set()
+_running_lock = threading.Lock()
+
+
+def _cycle_lock(name: str) -> threading.Lock:
+    with _cycle_locks_guard:
+        return _cycle_locks.setdefault(name, threading.Lock())
+
+
+def _get_executor(settings: dict) -> Executor:
+    """Return the shared scan pool, created on first use.
+
+    Settings (config/settings.json):
+      - scan_workers (default: 4)
+      - scan_pool: "thread" (default) or "process"
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = max(1, int(settings.get('scan_workers', 4)))
+            if settings.get('scan_pool', 'thread') == 'process':
+                # spawned: a fork would inherit the db writer, exchange loop,
+                # notifier and render-pool threads' locks and connections
+                _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan')
+        return _executor
+
+
+def _timed_scan(started: dict, key: int, submitted: float, symbol: str, timeframe: str, df=None):
+    started[key] = time.monotonic()
+    metrics.observe('scan_queue_lag_seconds', started[key] - submitted)
+    return run_scan(symbol, timeframe, df)
+
+
+def _symbol_timeframes() -> dict:
+    """{symbol: [timeframes]} of the active watchlist."""
+    out: dict = {}
+    for symbol, tf in _watchlist_pairs():
+        out.setdefault(symbol, []).append(tf)
+    return out
+
+
+def _prefetch(rows, settings: dict) -> dict:
+    """Fetch OHLCV for the whole cycle in one async batch (`prefetch_ohlcv`, default on).
+
+    Rows are grouped by symbol: each symbol's timeframes are resampled from
+    one base series, planned over all its watchlist timeframes so every
+    timeframe cycle reads the same stored base.
+    """
+    if not settings.get('prefetch_ohlcv', True) or not rows:
+        return {}
+    try:
+        with metrics.timer('ohlcv_prefetch_seconds'):
+            return get_ohlcv_many([(r['symbol'], r['timeframe']) for r in rows], limit=150, frames=False,
+                                  siblings=_symbol_timeframes())
+    except Exception:
+        # scans fetch their own data
+        logger.exception("OHLCV prefetch failed; scans will fetch individually")
+        return {}
+
+
+def _finished(pair: tuple):
+    def cb(_fut):
+        with _running_lock:
+            _running.discard(pair)
+    return cb
+
+
+def scan_watchlist(rows, settings: Optional[dict] = None) -> dict:
+    """Scan every (symbol, timeframe) row on the shared pool.
+
+    Each scan gets `scan_timeout_sec` (default: 120) from the moment it starts
+    running; scans past that budget are abandoned so the cycle can finish.
+    A timeout can't kill a scan thread (or interrupt a running worker
+    process): the abandoned scan runs to completion in the background, and
+    until it does its pair is skipped by later cycles and it keeps its pool
+    slot. At most `scan_workers` scans are submitted at once, so a submitted
+    scan starts right away and its budget is timed from submit in process
+    mode too. Returns counts of ok / failed / timed_out / skipped scans.
+    """
+    settings = _load_settings() if settings is None else settings
+    timeout = float(settings.get('scan_timeout_sec', 120))
+    workers = max(1, int(settings.get('scan_workers', 4)))
+    pool = _get_executor(settings)
+    process = isinstance(pool, ProcessPoolExecutor)
+    stats = {'ok': 0, 'failed': 0, 'timed_out': 0, 'skipped': 0}
+    data = _prefetch(rows, settings)
+
+    queue = deque(range(len(rows)))
+    futs: dict = {}
+    started: dict = {}
+    pending: set = set()
+    stalled = None
+    while queue or pending:
+        while queue:
+            i = queue[0]
+            pair = (rows[i]['symbol'], rows[i]['timeframe'])
+            with _running_lock:
+                if pair in _running:
+                    queue.popleft()
+                    stats['skipped'] += 1
+                    logger.warning("scan %s %s still running from an earlier cycle; skipping it", *pair)
+                    continue
+                if len(_running) >= workers:
+                    break  # every worker is busy (possibly with abandoned scans)
+                _running.add(pair)
+            queue.popleft()
+            try:
+                if process:
+                    fut = pool.submit(run_scan, pair[0], pair[1], data.get(pair))
+                    # a worker is free, so the job starts now; the start time
+                    # can't be reported back from the worker process
+                    started[i] = time.monotonic()
+                else:
+                    fut = pool.submit(_timed_scan, started, i, time.monotonic(), pair[0], pair[1], data.get(pair))
+            except Exception:
+                with _running_lock:
+                    _running.discard(pair)
+                raise
+            fut.add_done_callback(_finished(pair))
+            futs[fut] = i
+            pending.add(fut)
+
+        now = time.monotonic()
+        if not pending:
+            # the pool is full of scans from other cycles or abandoned ones
+            stalled = stalled or now
+            if now - stalled > timeout:
+                stats['skipped'] += len(queue)
+                logger.warning("scan pool busy for %.0fs; skipping %d scans this cycle", timeout, len(queue))
+                break
+            time.sleep(0.2)
+            continue
+        stalled = None
+
+        done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+        for fut in done:
+            err = fut.exception()
+            if err is None:
+                stats['ok'] += 1
+            else:
+                stats['failed'] += 1
+                r = rows[futs[fut]]
+                logger.error("scan %s %s failed: %r", r['symbol'], r['timeframe'], err)
+        now = time.monotonic()
+        for fut in list(pending):
+            t0 = started.get(futs[fut])
+            if t0 is not None and now - t0 > timeout:
+                fut.cancel()
+                pending.discard(fut)
+                stats['timed_out'] += 1
+                r = rows[futs[fut]]
+                logger.warning("scan %s %s timed out after %.0fs; abandoned", r['symbol'], r['timeframe'], timeout)
+    return stats
+
+
+def _run_rows(rows, settings: dict) -> dict:
+    if int(settings.get('scan_workers', 4)) <= 1:
+        stats = {'ok': 0, 'failed': 0, 'timed_out': 0, 'skipped': 0}
+        data = _prefetch(rows, settings)
+        for r in rows:
+            try:
+                run_scan(r['symbol'], r['timeframe'], data.get((r['symbol'], r['timeframe'])))
+                stats['ok'] += 1
+            except Exception:
+                # keep scanning the rest of the watchlist
+                logger.exception("scan %s %s failed", r['symbol'], r['timeframe'])
+                stats['failed'] += 1
+        return stats
+    return scan_watchlist(rows, settings)
+
+
+def run_watchlist_cycle(timeframe: Optional[str] = None) -> Optional[dict]:
+    """Scan active watchlist rows once (all, or one timeframe group).
+
+    Returns None if the same cycle is already running.
+    """
+    group = timeframe or 'all'
+    lock = _cycle_lock(group)
+    if not lock.acquire(blocking=False):
+        metrics.inc('cycle_skipped_total', timeframe=group)
+        logger.warning("cycle %s still running; skipping this tick", group)
+        return None
+    t0 = time.perf_counter()
+    try:
+        settings = _load_settings()
+        conn = get_conn()
+        if timeframe is None:
+            rows = conn.execute(
+                "SELECT symbol, timeframe FROM watchlist WHERE active=1"
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT symbol, timeframe FROM watchlist WHERE active=1 AND timeframe=?",
+                (timeframe,),
+            ).fetchall()
+        stats = _run_rows(rows, settings)
+        for result, n in stats.items():
+            metrics.inc('cycle_scans_total', n, timeframe=group, result=result)
+        return stats
+    finally:
+        metrics.observe('cycle_seconds', time.perf_counter() - t0, timeframe=group)
+        metrics.set_gauge('cycle_last_timestamp_seconds', time.time(), timeframe=group)
+        lock.release()
+
+
+def _bar_length(timeframe: str) -> Optional[int]:
+    """Bar length in seconds for ordering (months as their first, 31-day, bar); None if unknown."""
+    close = bar_close_ms(timeframe, 0)
+    return None if close is None else close // 1000
+
+
+def _bar_close_offsets(timeframes, settings: dict) -> dict:
+    """Seconds after each bar close at which a timeframe group is scanned.
+
+    Every group waits `bar_close_grace_sec` (default: 3) for the exchange to
+    publish the closed bar. Groups are then staggered across
+    `bar_close_spread_sec` (default: 10), so timeframes whose bars close
+    together (e.g. 1m/5m/1h on the hour) don't fire at the same instant.
+    Timeframes with no known bar length aren't scheduled on bar closes.
+    """
+    grace = float(settings.get('bar_close_grace_sec', 3))
+    spread = float(settings.get('bar_close_spread_sec', 10))
+    ordered = sorted((tf for tf in set(timeframes) if _bar_length(tf) is not None),
+                     key=lambda tf: (_bar_length(tf), tf))
+    return {tf: grace + spread * i / max(1, len(ordered)) for i, tf in enumerate(ordered)}
+
+
+# 1970-01-05 was the first Monday after the epoch; exchange weeks open on Monday
+_MONDAY_ANCHOR = 4 * 86400
+
+
+def _next_bar_close(period: int, offset: float, now: Optional[datetime] = None, anchor: int = 0) -> datetime:
+    now = now or datetime.now(timezone.utc)
+    epoch = now.timestamp() - anchor
+    nxt = (int(epoch // period) + 1) * period + offset
+    if nxt - period > epoch:
+        nxt -= period
+    return datetime.fromtimestamp(nxt + anchor, tz=timezone.utc)
+
+
+def _timeframe_trigger(timeframe: str, offset: Optional[float], interval: int,
+                       now: Optional[datetime] = None) -> tuple:
+    """(trigger, trigger kwargs, misfire grace) for a timeframe's scan job.
+
+    Fixed-length timeframes fire on their epoch-aligned closes, weeks on
+    Monday 00:00 UTC, and months on the first of the month via a cron
+    trigger. Anything else falls back to scanning every `interval` seconds.
+    """
+    now = now or datetime.now(timezone.utc)
+    secs = fixed_timeframe_seconds(timeframe)
+    cal = calendar_timeframe(timeframe)
+    if offset is None or (secs is None and cal is None):
+        return 'interval', {'seconds': interval, 'next_run_time': now}, max(1, interval // 2)
+    if secs is not None:
+        return 'interval', {'seconds': secs, 'start_date': _next_bar_close(secs, offset, now)}, max(1, secs // 2)
+    unit, n = cal
+    if unit == 'w':
+        period = n * 7 * 86400
+        start = _next_bar_close(period, offset, now, anchor=_MONDAY_ANCHOR)
+        return 'interval', {'weeks': n, 'start_date': start}, period // 2
+    return 'cron', {
+        'month': '*' if n == 1 else f'1-12/{n}', 'day': 1, 'hour': 0, 'minute': 0,
+        'second': int(offset), 'timezone': timezone.utc,
+    }, 86400
+
+
+def _guarded(name: str, fn):
+    """Wrap a scheduler job so a failure is logged and counted, not raised into APScheduler."""
+    def job():
+        try:
+            fn()
+        except Exception:
+            metrics.inc('scheduler_job_errors_total', job=name)
+            logger.exception("scheduler job %s failed", name)
+    return job
+
+
+def _timeframe_job(timeframe: str):
+    return _guarded(f'scan_tf:{timeframe}', lambda: run_watchlist_cycle(timeframe))
+
+
+def sync_timeframe_jobs(sched) -> None:
+    """Keep one bar-close job per active watchlist timeframe."""
+    settings = _load_settings()
+    interval = _load_scan_interval(60)
+    rows = get_conn().execute(
+        "SELECT DISTINCT timeframe FROM watchlist WHERE active=1"
+    ).fetchall()
+    wanted = {r['timeframe'] for r in rows if r['timeframe']}
+    offsets = _bar_close_offsets(wanted, settings)
+    existing = {j.id for j in sched.get_jobs() if j.id.startswith('scan_tf:')}
+    for job_id in existing - {f'scan_tf:{tf}' for tf in wanted}:
+        sched.remove_job(job_id)
+    for tf in wanted:
+        job_id = f'scan_tf:{tf}'
+        job = sched.get_job(job_id)
+        offset = offsets.get(tf)
+        name = f'{tf}@{offset:.3f}' if offset is not None else f'{tf}@every{interval}s'
+        if job is not None and getattr(job, 'name', '') == name:
+            continue
+        if offset is None:
+            logger.warning("timeframe %r has no known bar close; scanning it every %ss", tf, interval)
+        trigger, trigger_args, grace = _timeframe_trigger(tf, offset, interval)
+        sched.add_job(
+            _timeframe_job(tf), trigger, **trigger_args,
+            id=job_id, name=name, replace_existing=True,
+            max_instances=1, coalesce=True, misfire_grace_time=grace,
+        )
+
+
+def _watchlist_pairs():
+    rows = get_conn().execute("SELECT DISTINCT symbol, timeframe FROM watchlist WHERE active=1").fetchall()
+    return [(r['symbol'], r['timeframe']) for r in rows]
 
 
 def start_scheduler() -> None:
-    global _scheduler
+    """Start periodic scans.
+
+    With `stream_mode` set ("ccxtpro" or "replay", see services/stream.py),
+    scans are driven by closed bars from the candle stream and no polling
+    job is added; if the stream can't start, polling is used instead.
+    Otherwise `schedule_mode` in config/settings.json selects how:
+      - "bar_close": one job per watchlist timeframe, fired just after each
+        candle closes (see `_bar_close_offsets`); the set of timeframe jobs is
+        re-synced every `scan_interval_sec`.
+      - "interval" (default): scan the whole watchlist every `scan_interval_sec`.
+    """
+    global _scheduler, _streaming
     if not APSCHED_AVAILABLE:
         return
-    if _scheduler is not None:
+    if _scheduler is not None or _streaming:
         return
+    settings = _load_settings()
+    if settings.get('stream_mode', 'off') != 'off':
+        from app.services.stream import start_stream
+        if start_stream(settings, _get_executor(settings).submit, _watchlist_pairs):
+            _streaming = True
+            return
     interval = _load_scan_interval(60)
-    sched = BackgroundScheduler(daemon=True)
+    sched = BackgroundScheduler(daemon=True, timezone=timezone.utc)
 
-    def job():
-        conn = get_conn()
-        rows = conn.execute(
-            "SELECT symbol, timeframe FROM watchlist WHERE active=1"
-        ).fetchall()
-        for r in rows:
-            try:
-                run_scan(r['symbol'], r['timeframe'])
-            except Exception:
-                # ignore failures for robustness
-                pass
-
-    sched.add_job(job, 'interval', seconds=interval, id='watchlist_scan', replace_existing=True)
+    if _load_settings().get('schedule_mode', 'interval') == 'bar_close':
+        sched.add_job(
+            _guarded('watchlist_sync', lambda: sync_timeframe_jobs(sched)), 'interval', seconds=interval, id='watchlist_sync', replace_existing=True,
+            next_run_time=datetime.now(timezone.utc), max_instances=1, coalesce=True,
+        )
+    else:
+        sched.add_job(
+            _guarded('watchlist_scan', run_watchlist_cycle), 'interval', seconds=interval, id='watchlist_scan', replace_existing=True,
+            max_instances=1, coalesce=True,
+        )
     sched.start()
     _scheduler = sched
 
+
+def stop_scheduler() -> None:
+    """Stop the polling jobs or the candle stream (app shutdown)."""
+    global _scheduler, _streaming
+    if _streaming:
+        from app.services.stream import stop_stream
+        stop_stream()
+        _streaming = False
+    if _scheduler is not None:
+        _scheduler.shutdown(wait=False)
+        _scheduler = None
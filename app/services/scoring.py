@@ -1,6 +1,10 @@
+import glob
+import hashlib
+import os
 import random
+import threading
 from pathlib import Path
-from typing import Literal, Optional
+from typing import Dict, List, Literal, Optional, Sequence, Tuple, Union
 
 import numpy as np
 
@@ -17,34 +21,125 @@ def score_simple(pattern: dict) -> float:
     return min(0.99, base + jitter)
 
 
+def _normalize(arr: np.ndarray) -> np.ndarray:
+    # normalize to zero-mean unit-variance
+    arr = arr - arr.mean()
+    std = arr.std() if arr.std() > 1e-6 else 1.0
+    arr = arr / std
+    return arr
+
+
 def _load_grayscale(path: Path, size: int = 256) -> Optional[np.ndarray]:
     if Image is None:
         return None
     img = Image.open(path).convert('L').resize((size, size))
     arr = np.asarray(img, dtype=np.float32)
-    # normalize to zero-mean unit-variance
-    arr = arr - arr.mean()
-    std = arr.std() if arr.std() > 1e-6 else 1.0
-    arr = arr / std
+    return _normalize(arr)
+
+
+# Template images are preprocessed once and cached by (path, mtime, size);
+# set TEMPLATE_NPY_CACHE=0 to keep the cache in memory only.
+TEMPLATE_NPY_DIR = Path('storage/patterns/.npy')
+_template_cache: Dict[Tuple[str, int], Tuple[tuple, np.ndarray]] = {}
+_template_lock = threading.Lock()
+
+
+def _template_stamp(path: Path, size: int) -> Optional[tuple]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, size)
+
+
+def _npy_prefix(p: Path) -> str:
+    # basename for readability, plus a hash of the full path: templates with
+    # the same filename in different directories get separate cache files
+    digest = hashlib.sha1(str(p.resolve()).encode('utf-8')).hexdigest()[:12]
+    return f"{p.name}.{digest}"
+
+
+def load_template(path, size: int = 256) -> Optional[np.ndarray]:
+    """Normalized float32 array for a template image, decoded at most once per file version.
+
+    Lookups go memory -> `.npy` file under storage/patterns/.npy -> decode.
+    Returns None if the file is missing or can't be decoded.
+    """
+    p = Path(path)
+    stamp = _template_stamp(p, size)
+    if stamp is None:
+        return None
+    key = (str(p.resolve()), size)
+    with _template_lock:
+        hit = _template_cache.get(key)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+
+    persist = os.getenv('TEMPLATE_NPY_CACHE', '1') != '0'
+    prefix = _npy_prefix(p)
+    npy_path = TEMPLATE_NPY_DIR / f"{prefix}.{stamp[0]}.{size}.npy"
+    arr = None
+    if persist and npy_path.exists():
+        try:
+            arr = np.load(npy_path)
+        except Exception:
+            arr = None
+    if arr is None:
+        arr = _load_grayscale(p, size)
+        if arr is None:
+            return None
+        arr = arr.astype(np.float32, copy=False)
+        if persist:
+            try:
+                TEMPLATE_NPY_DIR.mkdir(parents=True, exist_ok=True)
+                for old in TEMPLATE_NPY_DIR.glob(f"{glob.escape(prefix)}.*.{size}.npy"):
+                    old.unlink(missing_ok=True)
+                np.save(npy_path, arr)
+            except Exception:
+                pass
+    arr.setflags(write=False)
+    with _template_lock:
+        _template_cache[key] = (stamp, arr)
     return arr
 
 
+def invalidate_templates(path=None) -> None:
+    """Forget cached template arrays (all, or just the one for `path`)."""
+    with _template_lock:
+        _spectra_cache.clear()
+        if path is None:
+            _template_cache.clear()
+            return
+        resolved = str(Path(path).resolve())
+        for key in [k for k in _template_cache if k[0] == resolved]:
+            del _template_cache[key]
+    if TEMPLATE_NPY_DIR.exists():
+        for old in TEMPLATE_NPY_DIR.glob(f"{glob.escape(_npy_prefix(Path(path)))}.*.npy"):
+            old.unlink(missing_ok=True)
+
+
 def similarity_score(
     a_path: str,
     b_path: str,
-    method: Literal['ncc', 'mse', 'cosine'] = 'ncc',
+    method: Literal['ncc', 'mse', 'cosine', 'fft_ncc'] = 'ncc',
 ) -> Optional[float]:
     """Compute a simple similarity score between two images.
 
+    `b_path` is treated as the template and served from the template cache.
+
     - ncc: normalized cross-correlation in [0,1]
     - mse: mean squared error mapped to [0,1] via 1/(1+MSE)
     - cosine: cosine similarity of flattened vectors in [0,1]
+    - fft_ncc: best ncc over shifts and scales (see `match_templates`)
 
     Returns None if Pillow is unavailable or images can't be processed.
     """
+    if method == 'fft_ncc':
+        hits = match_templates(a_path, [(0, b_path)])
+        return hits[0][1] if hits else None
     try:
         a = _load_grayscale(Path(a_path))
-        b = _load_grayscale(Path(b_path))
+        b = load_template(b_path)
         if a is None or b is None:
             return None
         if a.shape != b.shape:
@@ -74,3 +169,243 @@ def similarity_score(
             return max(0.0, min(1.0, 0.5 * (sim + 1.0)))
     except Exception:
         return None
+
+
+Method = Literal['ncc', 'mse', 'cosine', 'fft_ncc']
+TemplateRef = Tuple[object, str]  # (key, template path)
+
+_matrix_cache: Dict[tuple, Tuple[np.ndarray, np.ndarray, list]] = {}
+_MATRIX_CACHE_MAX = 8
+
+
+def _chart_array(chart, size: int = 256) -> Optional[np.ndarray]:
+    """Normalized float32 array for a chart given as an image path or a 2-D array."""
+    if isinstance(chart, np.ndarray):
+        if chart.shape != (size, size):
+            return None
+        return _normalize(chart.astype(np.float32))
+    try:
+        return _load_grayscale(Path(chart), size)
+    except Exception:
+        return None
+
+
+def template_matrix(templates: Sequence[TemplateRef], size: int = 256):
+    """Stack cached template arrays into one (T, size*size) float32 matrix.
+
+    Returns (matrix, squared row norms, keys of the rows kept). Templates that
+    can't be loaded are dropped. The stacked result is reused until a
+    template file changes.
+    """
+    arrays, keys, stamp = [], [], []
+    for key, path in templates:
+        st = _template_stamp(Path(path), size)
+        arr = load_template(path, size) if st is not None else None
+        if arr is None:
+            continue
+        arrays.append(arr)
+        keys.append(key)
+        stamp.append((key, str(path), st))
+    cache_key = tuple(stamp)
+    with _template_lock:
+        hit = _matrix_cache.get(cache_key)
+    if hit is not None:
+        return hit
+    if arrays:
+        mat = np.stack([a.ravel() for a in arrays]).astype(np.float32, copy=False)
+    else:
+        mat = np.zeros((0, size * size), dtype=np.float32)
+    sq = np.einsum('ij,ij->i', mat, mat)
+    res = (mat, sq, keys)
+    with _template_lock:
+        if len(_matrix_cache) >= _MATRIX_CACHE_MAX:
+            _matrix_cache.clear()
+        _matrix_cache[cache_key] = res
+    return res
+
+
+def _scores_from_dots(dots: np.ndarray, c_sq: np.ndarray, t_sq: np.ndarray, n: int, method: Method) -> np.ndarray:
+    """Map chart-template dot products (K, T) to scores in [0,1]."""
+    if method == 'mse':
+        mse = (c_sq[:, None] + t_sq[None, :] - 2.0 * dots) / n
+        return 1.0 / (1.0 + np.maximum(mse, 0.0))
+    # ncc and cosine coincide on zero-mean vectors
+    denom = np.sqrt(c_sq)[:, None] * np.sqrt(t_sq)[None, :]
+    sim = np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 1e-6)
+    return np.clip(0.5 * (sim + 1.0), 0.0, 1.0)
+
+
+def batch_similarity(
+    charts: Sequence[Union[str, np.ndarray]],
+    templates: Sequence[TemplateRef],
+    method: Method = 'ncc',
+    size: int = 256,
+) -> Tuple[np.ndarray, list]:
+    """Score every chart against every template with a single matmul.
+
+    Returns (scores of shape (charts, kept templates), kept template keys).
+    Charts that can't be loaded get a row of NaN.
+    """
+    mat, t_sq, keys = template_matrix(templates, size)
+    rows = [_chart_array(c, size) for c in charts]
+    ok = [i for i, r in enumerate(rows) if r is not None]
+    scores = np.full((len(rows), len(keys)), np.nan, dtype=np.float32)
+    if not ok or not keys:
+        return scores, keys
+    cmat = np.stack([rows[i].ravel() for i in ok]).astype(np.float32, copy=False)
+    c_sq = np.einsum('ij,ij->i', cmat, cmat)
+    dots = cmat @ mat.T
+    scores[ok] = _scores_from_dots(dots, c_sq, t_sq, size * size, method)
+    return scores, keys
+
+
+def rank_templates(
+    chart: Union[str, np.ndarray],
+    templates: Sequence[TemplateRef],
+    method: Method = 'ncc',
+) -> List[Tuple[object, float]]:
+    """Score one chart against all templates; returns [(key, score)] best first."""
+    if method == 'fft_ncc':
+        return [(key, score) for key, score, _, _ in match_templates(chart, templates)]
+    try:
+        scores, keys = batch_similarity([chart], templates, method)
+    except Exception:
+        return []
+    row = scores[0]
+    order = np.argsort(-np.nan_to_num(row, nan=-1.0))
+    return [(keys[i], float(row[i])) for i in order if not np.isnan(row[i])]
+
+
+# --- Shift- and scale-tolerant matching (FFT normalized cross-correlation) ---
+#
+# Each template is resized to every (sy, sx) in FFT_SCALES and zero-padded to
+# the chart size; the conjugate spectra of all template/scale variants are
+# computed once and cached. A chart then costs one rfft2 plus one batched
+# irfft2: correlations at every offset where the scaled template lies fully
+# inside the chart, normalized by the chart patch energy (summed-area tables).
+# At scale 1 there is exactly one offset, which is plain ncc.
+
+FFT_SIZE = int(os.getenv('FFT_NCC_SIZE', '128'))
+FFT_SCALES: Tuple[float, ...] = tuple(
+    float(x) for x in os.getenv('FFT_NCC_SCALES', '1.0,0.9,0.8,0.7').split(',') if x.strip()
+)
+_FFT_BATCH = 64  # template variants per irfft2 call (bounds peak memory)
+
+_spectra_cache: Dict[tuple, tuple] = {}
+
+Match = Tuple[object, float, Tuple[int, int], Tuple[float, float]]  # (key, score, (dy, dx), (sy, sx))
+
+
+def _resize_float(arr: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    if arr.shape == shape:
+        return arr.astype(np.float32, copy=False)
+    img = Image.fromarray(np.asarray(arr, dtype=np.float32), mode='F')
+    return np.asarray(img.resize((shape[1], shape[0]), Image.BILINEAR), dtype=np.float32)
+
+
+def _scale_pairs(scales: Sequence[float]) -> List[Tuple[float, float]]:
+    # independent vertical/horizontal factors: a pattern can span a different
+    # number of candles and a different price range than its template
+    return [(sy, sx) for sy in scales for sx in scales]
+
+
+def template_spectra(templates: Sequence[TemplateRef], size: int = FFT_SIZE,
+                     scales: Sequence[float] = FFT_SCALES):
+    """Precomputed conjugate spectra of every template at every scale pair.
+
+    Returns (spectra (V, size, size//2+1) complex64, norms (V,), variants)
+    where variants[i] = (key, (h, w), (sy, sx)). Cached until a template changes.
+    """
+    stamp = []
+    loaded = []
+    for key, path in templates:
+        st = _template_stamp(Path(path), size)
+        arr = load_template(path, size) if st is not None else None
+        if arr is None:
+            continue
+        loaded.append((key, arr))
+        stamp.append((key, str(path), st))
+    cache_key = (tuple(stamp), size, tuple(scales))
+    with _template_lock:
+        hit = _spectra_cache.get(cache_key)
+    if hit is not None:
+        return hit
+    specs, norms, variants = [], [], []
+    for key, arr in loaded:
+        for sy, sx in _scale_pairs(scales):
+            h, w = max(2, int(round(size * sy))), max(2, int(round(size * sx)))
+            t = _resize_float(arr, (h, w))
+            t = t - t.mean()
+            norm = float(np.sqrt(np.sum(t.astype(np.float64) ** 2)))
+            if norm < 1e-6:
+                continue
+            specs.append(np.conj(np.fft.rfft2(t, s=(size, size))).astype(np.complex64))
+            norms.append(norm)
+            variants.append((key, (h, w), (sy, sx)))
+    if specs:
+        res = (np.stack(specs), np.asarray(norms), variants)
+    else:
+        res = (np.zeros((0, size, size // 2 + 1), dtype=np.complex64), np.zeros(0), [])
+    with _template_lock:
+        if len(_spectra_cache) >= _MATRIX_CACHE_MAX:
+            _spectra_cache.clear()
+        _spectra_cache[cache_key] = res
+    return res
+
+
+def _patch_std(sat: np.ndarray, sat2: np.ndarray, h: int, w: int) -> np.ndarray:
+    """sqrt of the centred energy of every h x w patch (valid offsets), from summed-area tables."""
+    def box(t):
+        return t[h:, w:] - t[:-h, w:] - t[h:, :-w] + t[:-h, :-w]
+    s1, s2 = box(sat), box(sat2)
+    return np.sqrt(np.maximum(s2 - s1 * s1 / (h * w), 0.0))
+
+
+def match_templates(
+    chart: Union[str, np.ndarray],
+    templates: Sequence[TemplateRef],
+    size: int = FFT_SIZE,
+    scales: Sequence[float] = FFT_SCALES,
+) -> List[Match]:
+    """Best shift/scale-tolerant ncc of a chart against each template, best first.
+
+    Returns [(key, score in [0,1], (dy, dx), (sy, sx))]: the offset of the
+    matched region in chart pixels (scaled to the chart's own size) and the
+    template scale that matched. Templates that can't be loaded are left out.
+    """
+    if Image is None:
+        return []
+    try:
+        if isinstance(chart, np.ndarray):
+            src = chart.astype(np.float32)
+        else:
+            src = np.asarray(Image.open(chart).convert('L'), dtype=np.float32)
+    except Exception:
+        return []
+    spectra, norms, variants = template_spectra(templates, size, scales)
+    if not variants:
+        return []
+    c = _resize_float(src, (size, size))
+    c = c - c.mean()
+    cf = np.fft.rfft2(c)
+    c64 = c.astype(np.float64)
+    pad = lambda a: np.pad(a, ((1, 0), (1, 0)))
+    sat, sat2 = pad(c64.cumsum(0).cumsum(1)), pad((c64 * c64).cumsum(0).cumsum(1))
+    stds: Dict[Tuple[int, int], np.ndarray] = {}
+
+    best: Dict[object, Match] = {}
+    fy, fx = src.shape[0] / size, src.shape[1] / size
+    for lo in range(0, len(variants), _FFT_BATCH):
+        corr = np.fft.irfft2(spectra[lo:lo + _FFT_BATCH] * cf[None], s=(size, size))
+        for j, (key, (h, w), scale) in enumerate(variants[lo:lo + _FFT_BATCH]):
+            if (h, w) not in stds:
+                stds[(h, w)] = _patch_std(sat, sat2, h, w)
+            std = stds[(h, w)]
+            num = corr[j, :size - h + 1, :size - w + 1]
+            ncc = np.divide(num, std * norms[lo + j], out=np.zeros_like(num), where=std > 1e-6)
+            k = int(np.argmax(ncc))
+            dy, dx = divmod(k, ncc.shape[1])
+            score = float(np.clip(0.5 * (ncc.flat[k] + 1.0), 0.0, 1.0))
+            if key not in best or score > best[key][1]:
+                best[key] = (key, score, (int(round(dy * fy)), int(round(dx * fx))), scale)
+    return sorted(best.values(), key=lambda m: -m[1])
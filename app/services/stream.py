@@ -0,0 +1,402 @@
+from __future__ import annotations
+
+"""Streaming candle ingestion: scan each series once per closed bar.
+
+A feed pushes closed candles into `StreamEngine`, which keeps a rolling
+in-memory window per (symbol, timeframe) in a `CandleBuffer`, plus a
+`FeatureState` updated in O(1) per bar. When a bar closes, only that series
+is scanned (`run_scan` with the buffered window and a snapshot of its
+feature state, so rule patterns aren't recomputed over the window), and
+nothing is polled.
+
+Feeds:
+  - `CcxtProFeed`: exchange websockets through ccxt.pro `watch_ohlcv`
+    (optional dependency). A bar counts as closed once the next one opens.
+  - `ReplayFeed`: replays candles from the local store (`app.models.candles`)
+    in time order, as an offline stand-in for tests and demos. Replayed bars
+    are scored by `replay_scan`, which records results in a separate replay
+    database and sends would-be alerts to a stub transport: a replay never
+    writes events or reaches Telegram.
+
+Enabled with `"stream_mode"` in config/settings.json ("ccxtpro" or "replay";
+default "off", which keeps the polling scheduler).
+"""
+
+import abc
+import asyncio
+import copy
+import functools
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.models.candles import load_candles, upsert_candles
+from app import metrics
+from app.services.candle_buffer import CandleBuffer
+from app.services.data import get_ohlcv_df, timeframe_seconds
+from app.services.features import FeatureState
+
+try:
+    import ccxt.pro as ccxtpro  # type: ignore
+    CCXTPRO_AVAILABLE = True
+except Exception:
+    ccxtpro = None  # type: ignore
+    CCXTPRO_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+Pair = Tuple[str, str]
+Row = Tuple[int, float, float, float, float, float]  # (ts_ms, o, h, l, c, v)
+Emit = Callable[[str, str, Row], Awaitable[None]]
+
+DEFAULT_CAPACITY = 150
+REPLAY_DB = 'storage/replay.sqlite'
+
+
+class CandleFeed(abc.ABC):
+    """Source of closed candles.
+
+    `run(pairs, emit)` awaits `emit(symbol, timeframe, row)` for every closed
+    bar of the given pairs, in bar order per series, until cancelled.
+    `history` seeds a series' window before streaming starts, and
+    `scan_callback` may replace `run_scan` for the feed's bars.
+    """
+
+    persist = True  # write streamed bars into the candle store
+    wait_for_scans = False  # True: a bar waits for the series' previous scan instead of skipping
+
+    @abc.abstractmethod
+    async def run(self, pairs: Sequence[Pair], emit: Emit) -> None:
+        ...
+
+    def scan_callback(self) -> Optional[Callable]:
+        return None  # the engine's default, `run_scan`
+
+    def history(self, symbol: str, timeframe: str, limit: int) -> List[Row]:
+        df = get_ohlcv_df(symbol, timeframe, limit=limit + 1)
+        if df is None or len(df) == 0:
+            return []
+        # the newest bar is usually still forming; the feed delivers it on close
+        cutoff = int(time.time() * 1000) - timeframe_seconds(timeframe) * 1000
+        ts = df.index.asi8 // 1_000_000
+        return [
+            (int(t), float(o), float(h), float(l), float(c), float(v))
+            for t, o, h, l, c, v in zip(ts, df['Open'], df['High'], df['Low'], df['Close'], df['Volume'])
+            if t <= cutoff
+        ][-limit:]
+
+    async def close(self) -> None:
+        pass
+
+
+class CcxtProFeed(CandleFeed):
+    """Exchange websocket klines via ccxt.pro (one shared client, one task per pair)."""
+
+    def __init__(self, ex_id: Optional[str] = None):
+        if not CCXTPRO_AVAILABLE:
+            raise RuntimeError("ccxt.pro is not installed")
+        self.ex_id = ex_id or os.getenv('EXCHANGE_ID', 'binance')
+        opts = {'apiKey': os.getenv('EXCHANGE_API_KEY'), 'secret': os.getenv('EXCHANGE_API_SECRET'), 'enableRateLimit': True}
+        self.exchange = getattr(ccxtpro, self.ex_id)({k: v for k, v in opts.items() if v is not None})
+
+    async def _watch(self, symbol: str, timeframe: str, emit: Emit) -> None:
+        forming: Optional[list] = None
+        backoff = 1.0
+        while True:
+            try:
+                candles = await self.exchange.watch_ohlcv(symbol, timeframe)
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("watch_ohlcv %s %s failed (%r); reconnecting in %.0fs", symbol, timeframe, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(60.0, backoff * 2)
+                continue
+            for c in candles:
+                if forming is not None and c[0] > forming[0]:
+                    await emit(symbol, timeframe, tuple(forming))
+                if forming is None or c[0] >= forming[0]:
+                    forming = list(c)
+
+    async def run(self, pairs: Sequence[Pair], emit: Emit) -> None:
+        await asyncio.gather(*(self._watch(s, tf, emit) for s, tf in pairs))
+
+    async def close(self) -> None:
+        try:
+            await self.exchange.close()
+        except Exception:
+            pass
+
+
+class ReplayFeed(CandleFeed):
+    """Replays stored candles in [since_ms, until_ms] across pairs in time order.
+
+    `speed` scales the bar spacing in wall-clock time (e.g. 60 plays one
+    minute per second); 0 replays as fast as the scans allow.
+    """
+
+    persist = False
+    wait_for_scans = True  # every replayed bar is scanned
+
+    def __init__(self, since_ms: int, until_ms: Optional[int] = None, speed: float = 0.0, ex_id: Optional[str] = None,
+                 db_path: str = REPLAY_DB):
+        self.ex_id = ex_id or os.getenv('EXCHANGE_ID', 'binance')
+        self.since_ms, self.until_ms, self.speed = int(since_ms), until_ms, float(speed)
+        self.db_path = db_path
+
+    def scan_callback(self) -> Callable:
+        # a partial of a module function, so it pickles into scan processes
+        return functools.partial(replay_scan, self.db_path)
+
+    def history(self, symbol: str, timeframe: str, limit: int) -> List[Row]:
+        return [tuple(r) for r in load_candles(self.ex_id, symbol, timeframe, limit=limit, until=self.since_ms - 1)]
+
+    async def run(self, pairs: Sequence[Pair], emit: Emit) -> None:
+        streams = [
+            [(int(r[0]), s, tf, tuple(r)) for r in load_candles(self.ex_id, s, tf, since=self.since_ms, until=self.until_ms)]
+            for s, tf in pairs
+        ]
+        prev_ts = None
+        for ts, symbol, timeframe, row in heapq.merge(*streams):
+            if self.speed > 0 and prev_ts is not None and ts > prev_ts:
+                await asyncio.sleep((ts - prev_ts) / 1000.0 / self.speed)
+            prev_ts = ts
+            await emit(symbol, timeframe, row)
+
+
+class StreamEngine:
+    """Per-series rolling windows fed by a `CandleFeed`; scans a series when its bar closes.
+
+    `submit(fn, *args)` runs a scan off the event loop and returns a
+    concurrent Future (e.g. the scheduler's scan pool). For live feeds, a
+    series whose previous scan is still running skips the new bar rather than
+    queueing behind it; replays wait instead.
+    """
+
+    def __init__(self, feed: CandleFeed, submit: Callable, capacity: int = DEFAULT_CAPACITY,
+                 min_bars: int = 20, scan: Optional[Callable] = None):
+        from app.services.scanner import run_scan
+        self.feed = feed
+        self.submit = submit
+        self.capacity = capacity
+        self.min_bars = min_bars
+        self.scan = scan or feed.scan_callback() or run_scan
+        self.buffers: Dict[Pair, CandleBuffer] = {}
+        self.features: Dict[Pair, FeatureState] = {}
+        self._inflight: Dict[Pair, object] = {}
+        self.ex_id = getattr(feed, 'ex_id', None) or os.getenv('EXCHANGE_ID', 'binance')
+
+    def window(self, symbol: str, timeframe: str):
+        """The buffered closed bars of a series as a DataFrame (None if empty)."""
+        buf = self.buffers.get((symbol, timeframe))
+        return buf.window().to_frame() if buf else None
+
+    def _seed(self, pairs: Sequence[Pair]) -> None:
+        for pair in pairs:
+            if pair in self.buffers:
+                continue
+            try:
+                rows = self.feed.history(pair[0], pair[1], self.capacity)
+            except Exception:
+                logger.exception("seeding %s %s failed", *pair)
+                rows = []
+            buf = self.buffers[pair] = CandleBuffer(self.capacity)
+            buf.extend(rows)
+            self.features[pair] = FeatureState.from_data(buf.window())
+
+    async def on_candle(self, symbol: str, timeframe: str, row: Row) -> None:
+        pair = (symbol, timeframe)
+        buf = self.buffers.get(pair)
+        if buf is None:
+            buf = self.buffers[pair] = CandleBuffer(self.capacity)
+        last_ts = buf.last_ts
+        if not buf.push(row):
+            return
+        ts = int(row[0])
+        state = self.features.get(pair)
+        if state is None or ts == last_ts:
+            # first bar of the series, or a corrected one: reseed from the window
+            state = self.features[pair] = FeatureState.from_data(buf.window())
+        else:
+            state.update(*(float(x) for x in row[1:5]))
+        metrics.inc('stream_candles_total', timeframe=timeframe)
+        if self.feed.persist:
+            # live bars: keep the store current for REST scans and backtests
+            try:
+                await asyncio.to_thread(upsert_candles, self.ex_id, symbol, timeframe, [row])
+            except Exception:
+                logger.exception("storing streamed candle %s %s failed", symbol, timeframe)
+            close_ms = ts + timeframe_seconds(timeframe) * 1000
+            metrics.observe('stream_close_lag_seconds', max(0.0, time.time() - close_ms / 1000.0))
+        if len(buf) < self.min_bars:
+            return
+        prev = self._inflight.get(pair)
+        if prev is not None and not prev.done():
+            if not self.feed.wait_for_scans:
+                metrics.inc('stream_scans_skipped_total', timeframe=timeframe)
+                return
+            await asyncio.gather(asyncio.wrap_future(prev), return_exceptions=True)
+        # detached copies: the buffer and state keep changing while the scan runs
+        self._inflight[pair] = self.submit(self.scan, symbol, timeframe, buf.window().copy(),
+                                           features=copy.deepcopy(state))
+        metrics.inc('stream_scans_total', timeframe=timeframe)
+
+    async def run(self, pairs: Sequence[Pair]) -> None:
+        # history comes from the candle store or a REST fetch: keep it off the loop
+        await asyncio.to_thread(self._seed, pairs)
+        await self.feed.run(pairs, self.on_candle)
+
+    def drain(self, timeout: Optional[float] = None) -> None:
+        """Wait for scans already submitted (replay/tests)."""
+        for fut in list(self._inflight.values()):
+            try:
+                fut.result(timeout=timeout)
+            except Exception:
+                logger.exception("streamed scan failed")
+
+
+# --- replay results ---
+
+_replay_local = threading.local()
+_replay_stubs: Dict[str, object] = {}
+_replay_lock = threading.Lock()
+
+
+def _replay_conn(db_path: str) -> sqlite3.Connection:
+    conns = getattr(_replay_local, 'conns', None)
+    if conns is None:
+        conns = _replay_local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = conns[db_path] = sqlite3.connect(db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS replay_events ("
+            " symbol TEXT, timeframe TEXT, bar_time TEXT, pattern_name TEXT, score REAL, threshold REAL,"
+            " status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,"
+            " PRIMARY KEY (symbol, timeframe, bar_time))"
+        )
+    return conn
+
+
+def _replay_alert(db_path: str, text: str) -> None:
+    from app.services.notifier import StubTransport
+    with _replay_lock:  # one writer per alert log
+        stub = _replay_stubs.get(db_path)
+        if stub is None:
+            stub = _replay_stubs[db_path] = StubTransport(os.path.splitext(db_path)[0] + '.alerts.jsonl')
+        stub.send_message('replay', text)
+
+
+def replay_scan(db_path: str, symbol: str, timeframe: str, df, features=None):
+    """Scan callback for replays: score the bar like `run_scan`, record it in `db_path`.
+
+    Results go to the replay database's `replay_events` table, not the
+    events table, and alerts to a StubTransport logging next to it
+    (`<db>.alerts.jsonl`). Returns the same tuple as `run_scan`, without an
+    image path.
+    """
+    from app.services.scanner import score_window
+    name, score, threshold, bar_time = score_window(symbol, timeframe, df, features)
+    status = 'sent' if score >= threshold else 'ignored'
+    conn = _replay_conn(db_path)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO replay_events (symbol, timeframe, bar_time, pattern_name, score, threshold, status) "
+            "VALUES (?,?,?,?,?,?,?)",
+            (symbol, timeframe, bar_time, name, score, threshold, status),
+        )
+    if status == 'sent':
+        _replay_alert(db_path, f"{symbol} {timeframe} {bar_time} | {name} | score={score:.2f}")
+    return name, score, threshold, None
+
+
+# --- background runner used by the scheduler ---
+
+_thread: Optional[threading.Thread] = None
+_stop: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def make_feed(settings: dict) -> CandleFeed:
+    mode = settings.get('stream_mode', 'off')
+    if mode == 'ccxtpro':
+        return CcxtProFeed()
+    if mode == 'replay':
+        hours = float(settings.get('stream_replay_hours', 24))
+        now_ms = int(time.time() * 1000)
+        return ReplayFeed(now_ms - int(hours * 3600 * 1000), speed=float(settings.get('stream_replay_speed', 0)),
+                          db_path=str(settings.get('stream_replay_db', REPLAY_DB)))
+    raise ValueError(f"Unknown stream_mode: {mode}")
+
+
+async def _supervise(engine: StreamEngine, get_pairs: Callable[[], List[Pair]], resync_sec: float) -> None:
+    """Run the feed for the current pairs; restart it when the watchlist changes."""
+    pairs: List[Pair] = []
+    task: Optional[asyncio.Task] = None
+    try:
+        while not _stop.is_set():
+            try:
+                wanted = sorted(set(get_pairs()))
+            except Exception:
+                logger.exception("reading the watchlist failed")
+                wanted = pairs
+            crashed = task is not None and task.done() and (task.cancelled() or task.exception() is not None)
+            if crashed and not task.cancelled():
+                logger.error("candle feed stopped: %r; restarting", task.exception())
+            # a feed that finished cleanly (end of a replay) is not restarted
+            if wanted != pairs or crashed:
+                if task is not None:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                pairs = wanted
+                task = asyncio.ensure_future(engine.run(pairs)) if pairs else None
+            try:
+                await asyncio.wait_for(_stop.wait(), timeout=resync_sec)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await engine.feed.close()
+
+
+def start_stream(settings: dict, submit: Callable, get_pairs: Callable[[], List[Pair]]) -> bool:
+    """Start streaming in a daemon thread; returns False if it can't (e.g. ccxt.pro missing)."""
+    global _thread, _stop, _loop
+    if _thread is not None and _thread.is_alive():
+        return True
+    try:
+        feed = make_feed(settings)
+    except Exception as e:
+        logger.error("streaming disabled: %s", e)
+        return False
+    engine = StreamEngine(
+        feed, submit,
+        capacity=int(settings.get('stream_buffer_bars', DEFAULT_CAPACITY)),
+        min_bars=int(settings.get('stream_min_bars', 20)),
+    )
+    resync = float(settings.get('scan_interval_sec', 60))
+    _loop = asyncio.new_event_loop()
+    _stop = asyncio.Event()
+
+    def main():
+        asyncio.set_event_loop(_loop)
+        _loop.run_until_complete(_supervise(engine, get_pairs, resync))
+
+    _thread = threading.Thread(target=main, name='candle-stream', daemon=True)
+    _thread.start()
+    return True
+
+
+def stop_stream(timeout: float = 10.0) -> None:
+    if _loop is not None and _stop is not None and _thread is not None and _thread.is_alive():
+        _loop.call_soon_threadsafe(_stop.set)
+        _thread.join(timeout)
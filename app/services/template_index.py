@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+"""Approximate nearest-neighbour index over template embeddings.
+
+With a large template library, comparing every chart against every template
+dominates `run_scan`. Each template gets a compact embedding: the image
+downsampled to EMBED_SIZE x EMBED_SIZE (16x16), zero-mean and L2-normalized,
+so a dot product is a low-resolution ncc. Embeddings are kept in an IVF
+index (k-means coarse lists): a query scores the chart against the list
+centroids, then only against the members of the TEMPLATE_INDEX_NPROBE
+closest lists. The scanner runs full matching on the top-k hits only.
+
+Full matching finds a template anywhere in the chart and at any of
+FFT_NCC_SCALES, so the query is shift and scale tolerant too: the chart is
+embedded whole and as sub-windows at every scale pair and a 3x3 grid of
+offsets (`embed_crops`), and a template scores its best match over those.
+
+The index is persisted to storage/patterns/index.npz (TEMPLATE_INDEX_PATH).
+Uploads add their template with `add()`. `sync()` embeds any template the
+index hasn't seen yet, so existing media is picked up on first use. The
+lists are retrained once the library has grown to twice the size they were
+trained on; until then new entries join their nearest list.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+try:
+    from PIL import Image
+except Exception:  # pragma: no cover - optional dependency at runtime
+    Image = None  # type: ignore
+
+from app import metrics
+from app.services.scoring import FFT_SCALES
+
+logger = logging.getLogger(__name__)
+
+EMBED_SIZE = 16
+INDEX_PATH = Path(os.getenv('TEMPLATE_INDEX_PATH', 'storage/patterns/index.npz'))
+_FLAT_MAX = 64  # below this many entries a flat scan is as fast as probing lists
+_KMEANS_ITERS = 10
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _unit(arr: np.ndarray) -> Optional[np.ndarray]:
+    v = arr.astype(np.float32).ravel()
+    v = v - v.mean()
+    n = float(np.linalg.norm(v))
+    return v / n if n > 1e-6 else None
+
+
+def embed_image(src: Union[str, Path, np.ndarray]) -> Optional[np.ndarray]:
+    """Embedding of an image path or a 2-D grayscale array (None if unreadable or blank)."""
+    if Image is None:
+        return None
+    try:
+        if isinstance(src, np.ndarray):
+            img = Image.fromarray(np.asarray(src, dtype=np.float32), mode='F')
+        else:
+            img = Image.open(src).convert('F')
+        img = img.resize((EMBED_SIZE, EMBED_SIZE), Image.BILINEAR)
+    except Exception:
+        return None
+    return _unit(np.asarray(img, dtype=np.float32))
+
+
+def embed_crops(chart: np.ndarray, scales: Sequence[float] = FFT_SCALES) -> Optional[np.ndarray]:
+    """Embeddings (Q, D) of a chart and its sub-windows, for a shift/scale-tolerant query.
+
+    Sub-windows span (sy, sx) of the chart for every pair of `scales`, at the
+    start, middle and end of each axis. None if nothing could be embedded.
+    """
+    if Image is None:
+        return None
+    try:
+        img = Image.fromarray(np.asarray(chart, dtype=np.float32), mode='F')
+    except Exception:
+        return None
+    w, h = img.size
+    fracs = sorted({min(1.0, max(0.1, float(x))) for x in scales} | {1.0})
+    out = []
+    for sy in fracs:
+        for sx in fracs:
+            ch, cw = h * sy, w * sx
+            for top in sorted({0.0, (h - ch) / 2, h - ch}):
+                for left in sorted({0.0, (w - cw) / 2, w - cw}):
+                    crop = img.resize((EMBED_SIZE, EMBED_SIZE), Image.BILINEAR, box=(left, top, left + cw, top + ch))
+                    v = _unit(np.asarray(crop, dtype=np.float32))
+                    if v is not None:
+                        out.append(v)
+    return np.stack(out) if out else None
+
+
+def _stamp(path: str) -> int:
+    try:
+        return Path(path).stat().st_mtime_ns
+    except OSError:
+        return -1
+
+
+def _kmeans(x: np.ndarray, k: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means (k-means++ seeding) on unit rows; returns (k, D) unit centroids."""
+    rng = np.random.default_rng(seed)
+    cent = [x[rng.integers(len(x))]]
+    for _ in range(1, k):
+        d = np.maximum(1.0 - np.max(x @ np.stack(cent).T, axis=1), 0.0)
+        total = d.sum()
+        cent.append(x[rng.choice(len(x), p=d / total)] if total > 0 else x[rng.integers(len(x))])
+    c = np.stack(cent)
+    for _ in range(_KMEANS_ITERS):
+        assign = np.argmax(x @ c.T, axis=1)
+        for j in range(k):
+            members = x[assign == j]
+            if len(members):
+                m = members.sum(axis=0)
+                c[j] = m / max(float(np.linalg.norm(m)), 1e-6)
+    return c.astype(np.float32)
+
+
+class TemplateIndex:
+    """IVF index of template embeddings keyed by template path."""
+
+    def __init__(self, path: Path = INDEX_PATH):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.paths: List[str] = []
+        self.stamps = np.zeros(0, dtype=np.int64)
+        self.vecs = np.zeros((0, EMBED_SIZE * EMBED_SIZE), dtype=np.float32)
+        self.centroids = np.zeros((0, EMBED_SIZE * EMBED_SIZE), dtype=np.float32)
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.trained_n = 0
+        self._pos: Dict[str, int] = {}
+        self._file_stamp: Optional[int] = None
+        self._synced: Optional[tuple] = None
+        self._gen = 0  # bumped whenever paths change; invalidates the allowed mask
+        self._mask_key: Optional[tuple] = None
+        self._mask = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    # --- persistence ---
+
+    def _reload_if_changed(self) -> None:
+        """Pick up a file written by another process (e.g. the web server after an upload)."""
+        st = _stamp(str(self.path))
+        if st == self._file_stamp:
+            return
+        self._file_stamp = st
+        if st < 0:
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as z:
+                if int(z['embed_size']) != EMBED_SIZE:
+                    return
+                self.paths = [str(p) for p in z['paths']]
+                self.stamps = z['stamps'].astype(np.int64)
+                self.vecs = z['vecs'].astype(np.float32)
+                self.centroids = z['centroids'].astype(np.float32)
+                self.assign = z['assign'].astype(np.int32)
+                self.trained_n = int(z['trained_n'])
+        except Exception:
+            logger.warning("template index %s unreadable; rebuilding", self.path)
+            return
+        self._pos = {p: i for i, p in enumerate(self.paths)}
+        self._synced = None
+        self._gen += 1
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp, embed_size=EMBED_SIZE, paths=np.asarray(self.paths, dtype=str), stamps=self.stamps,
+            vecs=self.vecs, centroids=self.centroids, assign=self.assign, trained_n=self.trained_n,
+        )
+        os.replace(tmp, self.path)
+        self._file_stamp = _stamp(str(self.path))
+
+    # --- updates ---
+
+    def _put(self, path: str, vec: np.ndarray, stamp: int) -> None:
+        i = self._pos.get(path)
+        lst = int(np.argmax(self.centroids @ vec)) if len(self.centroids) else 0
+        if i is None:
+            self._gen += 1
+            self._pos[path] = len(self.paths)
+            self.paths.append(path)
+            self.stamps = np.append(self.stamps, np.int64(stamp))
+            self.vecs = np.vstack([self.vecs, vec[None]])
+            self.assign = np.append(self.assign, np.int32(lst))
+        else:
+            self.stamps[i], self.vecs[i], self.assign[i] = stamp, vec, lst
+
+    def _maybe_train(self) -> None:
+        n = len(self.paths)
+        if n <= _FLAT_MAX or (self.trained_n and n < 2 * self.trained_n):
+            return
+        k = max(2, int(np.sqrt(n)))
+        self.centroids = _kmeans(self.vecs, k)
+        self.assign = np.argmax(self.vecs @ self.centroids.T, axis=1).astype(np.int32)
+        self.trained_n = n
+
+    def add(self, path: Union[str, Path], save: bool = True) -> bool:
+        """Embed (or re-embed) one template; False if it can't be read."""
+        key = str(path).replace('\\', '/')
+        vec = embed_image(key)
+        if vec is None:
+            return False
+        with self.lock:
+            self._reload_if_changed()
+            self._put(key, vec, _stamp(key))
+            self._maybe_train()
+            if save:
+                self.save()
+        return True
+
+    def sync(self, paths: Sequence[str]) -> None:
+        """Embed any of `paths` missing from the index or changed on disk."""
+        sig = tuple(paths)
+        with self.lock:
+            self._reload_if_changed()
+            if sig == self._synced:
+                return
+            changed = False
+            for p in paths:
+                i = self._pos.get(p)
+                st = _stamp(p)
+                if st < 0 or (i is not None and self.stamps[i] == st):
+                    continue
+                vec = embed_image(p)
+                if vec is not None:
+                    self._put(p, vec, st)
+                    changed = True
+            if changed:
+                self._maybe_train()
+                try:
+                    self.save()
+                except OSError:
+                    logger.exception("could not save template index %s", self.path)
+            self._synced = sig
+
+    # --- queries ---
+
+    def _allowed_mask(self, allowed: tuple) -> np.ndarray:
+        """Boolean mask of the entries in `allowed`, cached until the paths change."""
+        if self._mask_key != (self._gen, allowed):
+            keep = set(allowed)
+            self._mask = np.fromiter((p in keep for p in self.paths), dtype=bool, count=len(self.paths))
+            self._mask_key = (self._gen, allowed)
+        return self._mask
+
+    def search(self, query: np.ndarray, k: int, allowed: Optional[Sequence[str]] = None,
+               nprobe: Optional[int] = None) -> List[tuple]:
+        """Top-k (path, similarity in [-1, 1]) for one embedding or a (Q, D) stack, best first.
+
+        With several query embeddings (e.g. `embed_crops`), lists and entries
+        score their best match over them. Only paths in `allowed` are
+        returned (e.g. the active patterns' media); the mask for a given
+        `allowed` sequence is cached. Falls back to scanning every list when
+        the probed ones hold fewer than k allowed entries.
+        """
+        nprobe = nprobe or _env_int('TEMPLATE_INDEX_NPROBE', 4)
+        q = np.atleast_2d(np.asarray(query, dtype=np.float32))
+        with self.lock:
+            self._reload_if_changed()
+            if not self.paths:
+                return []
+            if len(self.centroids) and len(self.paths) > _FLAT_MAX:
+                order = np.argsort(-(self.centroids @ q.T).max(axis=1))
+                cand = np.flatnonzero(np.isin(self.assign, order[:nprobe]))
+            else:
+                cand = np.arange(len(self.paths))
+            if allowed is not None:
+                mask = self._allowed_mask(tuple(allowed))
+                cand = cand[mask[cand]]
+                if len(cand) < k and len(self.centroids):
+                    cand = np.flatnonzero(mask)
+            if not len(cand):
+                return []
+            sims = (self.vecs[cand] @ q.T).max(axis=1)
+            top = np.argsort(-sims)[:k]
+            return [(self.paths[cand[j]], float(sims[j])) for j in top]
+
+
+_index: Optional[TemplateIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> TemplateIndex:
+    """The process-wide index, loaded from disk on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TemplateIndex()
+        return _index
+
+
+_refs_cache: Optional[tuple] = None  # (refs, normalized paths, {path: ref positions})
+
+
+def _ref_paths(refs: Sequence[tuple]) -> tuple:
+    """Normalized template paths of `refs` and their positions, cached for the same refs."""
+    global _refs_cache
+    key = tuple(refs)
+    hit = _refs_cache
+    if hit is None or hit[0] != key:
+        paths = tuple(str(p).replace('\\', '/') for _, p in key)
+        by_path: Dict[str, List[int]] = {}
+        for j, p in enumerate(paths):
+            by_path.setdefault(p, []).append(j)
+        hit = _refs_cache = (key, paths, by_path)
+    return hit[1], hit[2]
+
+
+def candidate_templates(chart, refs: Sequence[tuple], k: Optional[int] = None) -> List[tuple]:
+    """The `k` refs (key, path) whose templates look most like some window of `chart`.
+
+    Returns `refs` unchanged when the library is small enough to score in
+    full (TEMPLATE_INDEX_MIN, default 32) or the chart can't be embedded.
+    """
+    k = k or _env_int('TEMPLATE_INDEX_TOPK', 8)
+    if len(refs) <= max(k, _env_int('TEMPLATE_INDEX_MIN', 32)):
+        return list(refs)
+    q = embed_crops(chart)
+    if q is None:
+        return list(refs)
+    idx = get_index()
+    paths, by_path = _ref_paths(refs)
+    idx.sync(paths)
+    hits = idx.search(q, k, allowed=paths)
+    metrics.inc('template_index_queries_total')
+    keep = sorted(j for p, _ in hits for j in by_path.get(p, ()))
+    return [refs[j] for j in keep]
+
+
+metrics.gauge_fn('template_index_size', lambda: len(_index) if _index is not None else 0)
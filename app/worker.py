@@ -0,0 +1,48 @@
+"""Background scanning without the web app.
+
+`start_background()` starts what the scanner needs besides HTTP: the
+render pool (when mplfinance is installed) and the scheduler or candle
+stream. The web app calls it from its lifespan unless APP_ROLE=web, so
+web-only servers can be scaled (or reloaded) separately from one
+`python -m app.worker` process doing the scanning.
+"""
+
+import logging
+import signal
+import threading
+
+
+def start_background() -> None:
+    from app.services.renderer import MPL_AVAILABLE
+    from app.services.render_pool import start_render_pool
+    from app.services.scheduler import start_scheduler
+    if MPL_AVAILABLE:
+        start_render_pool()
+    start_scheduler()
+
+
+def stop_background() -> None:
+    from app.services.exchanges import close_exchange_clients
+    from app.services.notifier import flush_notifications
+    from app.services.render_pool import shutdown_render_pool
+    from app.services.scheduler import stop_scheduler
+    stop_scheduler()
+    flush_notifications(timeout=10)
+    shutdown_render_pool()
+    close_exchange_clients()
+
+
+def main() -> None:
+    from app.models.db import init_db
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    init_db()
+    start_background()
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    stop.wait()
+    stop_background()
+
+
+if __name__ == '__main__':
+    main()
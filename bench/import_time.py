@@ -0,0 +1,110 @@
+"""Check that a web-only worker boots within an import-time budget.
+
+Run from the repo root:
+
+    python -m bench.import_time --budget-ms 800 --repeat 5 --out import.json
+
+Each run is a fresh interpreter in a scratch directory with APP_ROLE=web:
+it imports `app.main` and runs the app's lifespan startup (init_db), which
+is what a web-only uvicorn worker does before serving. Reports the median
+import and startup times, the slowest modules from `python -X importtime`,
+and which heavy dependencies got imported (there should be none: they load
+on first use). Exits 1 if the median boot time is over budget or a heavy
+module was imported.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+REPO = Path(__file__).resolve().parents[1]
+
+HEAVY = ('pandas', 'numpy', 'PIL', 'yaml', 'matplotlib', 'mplfinance', 'ccxt', 'apscheduler', 'telegram')
+
+_PROBE = f"""
+import asyncio, json, sys, time
+t0 = time.perf_counter()
+import app.main
+t1 = time.perf_counter()
+async def boot():
+    async with app.main.app.router.lifespan_context(app.main.app):
+        pass
+asyncio.run(boot())
+t2 = time.perf_counter()
+print(json.dumps({{'import_ms': (t1 - t0) * 1000, 'startup_ms': (t2 - t1) * 1000,
+                  'heavy': sorted(m for m in {HEAVY!r} if m in sys.modules)}}))
+"""
+
+
+def _probe(workdir: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=str(REPO), APP_ROLE='web',
+               DB_PATH=os.path.join(workdir, 'events.sqlite'), OHLCV_DB_PATH=os.path.join(workdir, 'ohlcv.sqlite'))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROBE],
+        cwd=workdir, env=env, capture_output=True, text=True, timeout=120,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else 'probe failed')
+    res = json.loads(proc.stdout.strip().splitlines()[-1])
+    res['modules'] = _parse_importtime(proc.stderr)
+    return res
+
+
+def _parse_importtime(stderr: str) -> Dict[str, int]:
+    """{module: self time in us} from `-X importtime` output."""
+    out: Dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, _, name = line.split(':', 1)[1].split('|')
+            out[name.strip()] = int(self_us)
+        except ValueError:
+            continue
+    return out
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--budget-ms', type=float, default=800.0, help='max median import + startup time')
+    ap.add_argument('--repeat', type=int, default=5, help='fresh interpreters to time')
+    ap.add_argument('--top', type=int, default=15, help='slowest modules to list')
+    ap.add_argument('--out', help='write JSON here instead of stdout')
+    args = ap.parse_args(argv)
+
+    runs: List[dict] = []
+    with tempfile.TemporaryDirectory(prefix='smc-import-') as tmp:
+        for _ in range(max(1, args.repeat)):
+            runs.append(_probe(tmp))
+
+    boot = [r['import_ms'] + r['startup_ms'] for r in runs]
+    median_ms = statistics.median(boot)
+    heavy = sorted({m for r in runs for m in r['heavy']})
+    last = runs[-1]['modules']
+    report = {
+        'budget_ms': args.budget_ms,
+        'boot_ms_median': round(median_ms, 1),
+        'import_ms_median': round(statistics.median(r['import_ms'] for r in runs), 1),
+        'startup_ms_median': round(statistics.median(r['startup_ms'] for r in runs), 1),
+        'runs_ms': [round(b, 1) for b in boot],
+        'heavy_modules_imported': heavy,
+        'slowest_modules_ms': {m: round(us / 1000, 2) for m, us in sorted(last.items(), key=lambda kv: -kv[1])[:args.top]},
+        'python': sys.version.split()[0],
+        'ok': median_ms <= args.budget_ms and not heavy,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + '\n', encoding='utf-8')
+    else:
+        print(text)
+    return 0 if report['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Benchmark the scan pipeline stage by stage on synthetic data.
+
+Run from the repo root:
+
+    python -m bench.scan_pipeline --watchlist 1,10,50 --templates 1,8,64 --windows 150,500 --out bench.json
+
+Every combination of match method (`--methods`, default: ncc and fft_ncc),
+watchlist size, template count and window length is run in a scratch
+directory with its own events DB, candle DB and images. Nothing
+touches storage/ or the network: OHLCV comes from `data._synthetic_df`, and
+Telegram is only timed on its no-credentials path. Output is JSON with
+per-stage latency percentiles (ms), scans/sec and tracemalloc peak per
+combination, plus enough metadata (commit, versions) to compare runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+REPO = Path(__file__).resolve().parents[1]
+
+STAGES = (
+    'pattern_load',      # parse + compile every YAML in patterns/
+    'get_ohlcv_df',
+    'evaluate_rules',
+    'rasterize_ohlcv',
+    'candidate_templates',  # IVF index prefilter (a no-op below TEMPLATE_INDEX_MIN)
+    'rank_templates',    # batch match against the index's candidates
+    'render_chart_png',
+    '_load_grayscale',
+    'similarity_score',  # one call per template, file based
+    'db_insert',
+    'render_placeholder_chart',
+    'send_telegram_alert',
+)
+
+
+def _ints(s: str) -> List[int]:
+    return [int(x) for x in s.split(',') if x.strip()]
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    import numpy as np
+    a = np.asarray(samples, dtype=np.float64) * 1000.0
+    if a.size == 0:
+        return {}
+    p50, p90, p99 = np.percentile(a, [50, 90, 99])
+    return {
+        'n': int(a.size), 'mean': float(a.mean()), 'p50': float(p50),
+        'p90': float(p90), 'p99': float(p99), 'max': float(a.max()),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True, timeout=10,
+        ).stdout.strip()
+    except Exception:
+        return ''
+
+
+class Pipeline:
+    """One scan = every stage in STAGES, timed separately."""
+
+    def __init__(self, templates: int, timeframe: str, method: str = 'ncc'):
+        from app.services import data
+        from app.services.patterns_engine import compile_logic, parse_yaml
+        from app.services.renderer import rasterize_ohlcv
+        from PIL import Image
+
+        data.CCXT_AVAILABLE = False  # synthetic OHLCV only
+        self.timeframe = timeframe
+        self.method = method
+        self.yaml_files = sorted((REPO / 'patterns').glob('*.y*ml'))
+        self.patterns = [parse_yaml(p.read_text(encoding='utf-8')) for p in self.yaml_files]
+        for p in self.patterns:
+            p['__rules'] = compile_logic(p)
+        self.rules = [p for p in self.patterns if p.get('type') == 'rules']
+        self._parse, self._compile = parse_yaml, compile_logic
+
+        tpl_dir = Path('storage/patterns')
+        tpl_dir.mkdir(parents=True, exist_ok=True)
+        self.templates = []
+        for i in range(templates):
+            path = tpl_dir / f"tpl_{i}.png"
+            if not path.exists():
+                Image.fromarray(rasterize_ohlcv(data._synthetic_df(f"TPL{i}/USDT", timeframe, 60))).save(path)
+            self.templates.append((i, str(path)))
+        self.samples: Dict[str, List[float]] = {s: [] for s in STAGES}
+        self._event = 0
+
+    def scan(self, symbol: str, window: int, record: bool = True) -> None:
+        from app.models.db import submit_write
+        from app.services.data import get_ohlcv_df
+        from app.services.notifier import send_telegram_alert
+        from app.services.patterns_engine import evaluate_rules
+        from app.services.renderer import event_image_name, rasterize_ohlcv, render_chart_png, render_placeholder_chart
+        from app.services.scoring import _load_grayscale, rank_templates, similarity_score
+        from app.services.template_index import candidate_templates
+
+        t = {}
+        clock = time.perf_counter
+
+        s = clock()
+        for f in self.yaml_files:
+            self._compile(self._parse(f.read_text(encoding='utf-8')))
+        t['pattern_load'] = clock() - s
+
+        s = clock()
+        df = get_ohlcv_df(symbol, self.timeframe, limit=window)
+        t['get_ohlcv_df'] = clock() - s
+
+        s = clock()
+        for p in self.rules:
+            evaluate_rules(p, df)
+        t['evaluate_rules'] = clock() - s
+
+        s = clock()
+        chart = rasterize_ohlcv(df)
+        t['rasterize_ohlcv'] = clock() - s
+
+        # the same path as scanner._best_pattern
+        s = clock()
+        refs = candidate_templates(chart, self.templates) if self.templates else []
+        t['candidate_templates'] = clock() - s
+
+        s = clock()
+        if refs:
+            rank_templates(chart, refs, method=self.method)
+        t['rank_templates'] = clock() - s
+
+        self._event += 1
+        name = event_image_name(symbol, self.timeframe, self._event)
+        s = clock()
+        img_path = render_chart_png(symbol, self.timeframe, df, name)
+        t['render_chart_png'] = clock() - s
+
+        s = clock()
+        _load_grayscale(Path(img_path))
+        t['_load_grayscale'] = clock() - s
+
+        s = clock()
+        for _, tpl in self.templates:
+            similarity_score(img_path, tpl, method=self.method)
+        t['similarity_score'] = clock() - s
+
+        row = (symbol, self.timeframe, 'bench', 0.5, 'ignored')
+        s = clock()
+        submit_write(lambda c: c.execute(
+            "INSERT INTO events (symbol, timeframe, pattern_name, score, status) VALUES (?,?,?,?,?)", row,
+        ).lastrowid).result()
+        t['db_insert'] = clock() - s
+
+        s = clock()
+        render_placeholder_chart(symbol, self.timeframe, self._event)
+        t['render_placeholder_chart'] = clock() - s
+
+        s = clock()
+        send_telegram_alert(f"{symbol} {self.timeframe} bench", image_path=img_path)
+        t['send_telegram_alert'] = clock() - s
+
+        if record:
+            for k, v in t.items():
+                self.samples[k].append(v)
+
+
+def run_case(watchlist: int, templates: int, window: int, repeat: int, timeframe: str,
+             method: str = 'ncc') -> dict:
+    pipe = Pipeline(templates, timeframe, method)
+    symbols = [f"SYM{i}/USDT" for i in range(watchlist)]
+    pipe.scan(symbols[0], window, record=False)  # warm caches and imports
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for sym in symbols:
+            pipe.scan(sym, window)
+    elapsed = time.perf_counter() - started
+    scans = repeat * len(symbols)
+
+    # separate pass: tracemalloc slows allocation-heavy stages down
+    tracemalloc.start()
+    for sym in symbols:
+        pipe.scan(sym, window, record=False)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    totals = [sum(pipe.samples[s][i] for s in STAGES) for i in range(scans)]
+    return {
+        'method': method,
+        'watchlist': watchlist,
+        'templates': templates,
+        'window': window,
+        'scans': scans,
+        'elapsed_sec': elapsed,
+        'scans_per_sec': scans / elapsed if elapsed > 0 else None,
+        'peak_mem_kb': peak / 1024.0,
+        'scan_total': _percentiles(totals),
+        'stages': {s: _percentiles(pipe.samples[s]) for s in STAGES},
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--watchlist', default='1,10', help='comma-separated watchlist sizes')
+    ap.add_argument('--templates', default='0,8', help='comma-separated template counts')
+    ap.add_argument('--windows', default='150', help='comma-separated OHLCV window lengths')
+    ap.add_argument('--repeat', type=int, default=3, help='passes over the watchlist per case')
+    ap.add_argument('--timeframe', default='1h')
+    ap.add_argument('--methods', default='ncc,fft_ncc',
+                    help='comma-separated template match methods (the scanner uses TEMPLATE_MATCH_METHOD)')
+    ap.add_argument('--out', help='write JSON here instead of stdout')
+    args = ap.parse_args(argv)
+    out = Path(args.out).resolve() if args.out else None
+
+    # isolate everything the app writes; env must be set before app imports
+    work = tempfile.mkdtemp(prefix='smc-bench-')
+    os.environ['DB_PATH'] = os.path.join(work, 'events.sqlite')
+    os.environ['OHLCV_DB_PATH'] = os.path.join(work, 'ohlcv.sqlite')
+    os.environ.pop('TELEGRAM_BOT_TOKEN', None)
+    os.environ.pop('TELEGRAM_CHAT_ID', None)
+    sys.path.insert(0, str(REPO))
+    os.chdir(work)
+
+    import numpy
+    from app.models.db import init_db
+    from app.services import renderer
+    init_db()
+
+    methods = [m.strip() for m in args.methods.split(',') if m.strip()]
+    cases = []
+    for method in methods:
+        for w in _ints(args.watchlist):
+            for n in _ints(args.templates):
+                for win in _ints(args.windows):
+                    cases.append(run_case(w, n, win, args.repeat, args.timeframe, method))
+                    print(f"method={method} watchlist={w} templates={n} window={win}: "
+                          f"{cases[-1]['scans_per_sec']:.1f} scans/s", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat() + 'Z',
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': numpy.__version__,
+            'mplfinance': renderer.MPL_AVAILABLE,
+            'timeframe': args.timeframe,
+            'repeat': args.repeat,
+            'methods': methods,
+            'unit': 'ms',
+        },
+        'cases': cases,
+    }
+    text = json.dumps(report, indent=2)
+    if out:
+        out.write_text(text, encoding='utf-8')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Closed-bar detection for fixed, calendar and unknown timeframes (services/data.py).
+
+Run from the repo root: python -m pytest tests
+"""
+
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services.candle_buffer import CandleWindow
+from app.services.data import bar_close_ms, calendar_timeframe, last_closed_bar
+
+
+def _ms(d: datetime) -> int:
+    return int((d - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _window(opens) -> CandleWindow:
+    ones = np.ones(len(opens))
+    return CandleWindow(np.array([_ms(d) for d in opens], dtype=np.int64), ones, ones, ones, ones, ones)
+
+
+def _frame(opens) -> pd.DataFrame:
+    return pd.DataFrame({'Close': np.ones(len(opens))}, index=pd.DatetimeIndex(opens))
+
+
+@pytest.mark.parametrize('make', [_window, _frame])
+def test_fixed_timeframe(make):
+    df = make(list(pd.date_range('2026-10-18', periods=5, freq='h')))
+    assert last_closed_bar(df, '1h', datetime(2026, 10, 18, 4, 30)) == pd.Timestamp('2026-10-18 03:00')
+    assert last_closed_bar(df, '1h', datetime(2026, 10, 18, 5)) == pd.Timestamp('2026-10-18 04:00')
+    assert last_closed_bar(df, '1h', datetime(2026, 10, 18, 0, 30)) is None
+
+
+@pytest.mark.parametrize('make', [_window, _frame])
+def test_month_closes_on_the_first(make):
+    df = make([datetime(2026, 8, 1), datetime(2026, 9, 1), datetime(2026, 10, 1)])
+    # the October bar is still forming mid-month, whatever its age in minutes
+    assert last_closed_bar(df, '1M', datetime(2026, 10, 18)) == pd.Timestamp('2026-09-01')
+    assert last_closed_bar(df, '1M', datetime(2026, 11, 1, 0, 0, 1)) == pd.Timestamp('2026-10-01')
+
+
+def test_week_closes_seven_days_after_its_monday_open():
+    df = _window([datetime(2026, 10, 5), datetime(2026, 10, 12)])
+    assert last_closed_bar(df, '1w', datetime(2026, 10, 18)) == pd.Timestamp('2026-10-05')
+    assert last_closed_bar(df, '1w', datetime(2026, 10, 19)) == pd.Timestamp('2026-10-12')
+
+
+def test_unknown_timeframe_has_no_closed_bar():
+    df = _window([datetime(2026, 1, 1), datetime(2026, 2, 1)])
+    assert last_closed_bar(df, '7x', datetime(2027, 1, 1)) is None
+
+
+def test_bar_close_ms():
+    assert bar_close_ms('4h', 0) == 4 * 3_600_000
+    assert bar_close_ms('1M', _ms(datetime(2026, 12, 1))) == _ms(datetime(2027, 1, 1))
+    assert bar_close_ms('3M', _ms(datetime(2026, 10, 1))) == _ms(datetime(2027, 1, 1))
+    assert bar_close_ms('1w', _ms(datetime(2026, 10, 12))) == _ms(datetime(2026, 10, 19))
+    assert bar_close_ms('nope', 0) is None
+    assert calendar_timeframe('1w') == ('w', 1) and calendar_timeframe('1m') is None
+
+
+# --- scheduler bar-close triggers ---
+
+def _next_fire(tf, now, offset=3.0, interval=60):
+    pytest.importorskip('apscheduler')
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+    from app.services import scheduler
+
+    kind, args, _ = scheduler._timeframe_trigger(tf, offset, interval, now)
+    if kind == 'cron':
+        return CronTrigger(**args).get_next_fire_time(None, now)
+    if 'next_run_time' in args:
+        return args['next_run_time']
+    return IntervalTrigger(timezone=timezone.utc, **args).get_next_fire_time(None, now)
+
+
+@pytest.mark.parametrize('tf, want', [
+    ('1h', datetime(2026, 10, 18, 13, 0, 3)),
+    ('4h', datetime(2026, 10, 18, 16, 0, 3)),
+    ('1d', datetime(2026, 10, 19, 0, 0, 3)),
+    ('1w', datetime(2026, 10, 19, 0, 0, 3)),  # Monday, not Thursday
+    ('1M', datetime(2026, 11, 1, 0, 0, 3)),
+    ('3M', datetime(2027, 1, 1, 0, 0, 3)),
+])
+def test_bar_close_jobs_fire_after_the_close(tf, want):
+    now = datetime(2026, 10, 18, 12, 30, tzinfo=timezone.utc)  # a Sunday
+    assert _next_fire(tf, now) == want.replace(tzinfo=timezone.utc)
+
+
+def test_unknown_timeframes_get_no_offset_and_poll_on_the_interval():
+    from app.services import scheduler
+
+    offsets = scheduler._bar_close_offsets(['1h', '7x', '1M', '1w'], {})
+    assert list(offsets) == ['1h', '1w', '1M']
+    kind, args, _ = scheduler._timeframe_trigger('7x', offsets.get('7x'), 90)
+    assert kind == 'interval' and args['seconds'] == 90
@@ -0,0 +1,119 @@
+"""Timeframe planning and epoch-aligned resampling (services/data.py, services/candle_buffer.py).
+
+Run from the repo root: python -m pytest tests
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services.candle_buffer import CandleWindow, resample
+from app.services.data import RESAMPLE_BASES, fixed_timeframe_seconds, plan_timeframes
+
+
+def _window(n: int, step_ms: int, start_ms: int, seed: int = 0) -> CandleWindow:
+    rng = np.random.default_rng(seed)
+    close = 100 + np.cumsum(rng.normal(0, 1, n))
+    open_ = np.r_[close[:1], close[:-1]]
+    high = np.maximum(open_, close) + rng.random(n)
+    low = np.minimum(open_, close) - rng.random(n)
+    volume = rng.random(n) * 10
+    ts = start_ms + step_ms * np.arange(n, dtype=np.int64)
+    return CandleWindow(ts, open_, high, low, close, volume)
+
+
+def _pandas_resample(win: CandleWindow, period_ms: int) -> pd.DataFrame:
+    df = pd.DataFrame({'Open': win.open, 'High': win.high, 'Low': win.low, 'Close': win.close,
+                       'Volume': win.volume}, index=pd.to_datetime(win.ts, unit='ms'))
+    out = df.resample(f'{period_ms}ms', origin='epoch', closed='left', label='left').agg(
+        {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+    ).dropna()
+    if len(out) and out.index[0].value // 1_000_000 != win.ts[0]:
+        out = out.iloc[1:]  # resample() drops the incomplete leading bucket
+    return out
+
+
+# --- plan_timeframes ---
+
+@pytest.mark.parametrize('tf', ['1M', '1w', '2w', '7x', '0m', 'm', ''])
+def test_calendar_and_unknown_timeframes_are_fetched_directly(tf):
+    assert plan_timeframes([tf]) == {tf: [tf]}
+
+
+def test_calendar_timeframes_are_never_resampled_or_used_as_bases():
+    plan = plan_timeframes(['1w', '1M', '1d', '4h'])
+    assert plan['1w'] == ['1w'] and plan['1M'] == ['1M']
+    assert not any(tf in members for base, members in plan.items() if base not in ('1w', '1M')
+                   for tf in ('1w', '1M'))
+
+
+def test_fine_timeframes_share_one_base():
+    assert plan_timeframes(['1m', '2m', '5m']) == {'1m': ['1m', '2m', '5m']}
+
+
+def test_ties_go_to_the_coarser_base():
+    # 5m covers 5m/15m and 15m covers 15m/1h (1h from 5m needs 1800 > 1000 bars)
+    assert plan_timeframes(['5m', '15m', '1h']) == {'15m': ['15m', '1h'], '5m': ['5m']}
+
+
+@pytest.mark.parametrize('tfs', [
+    ['1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '1d'],
+    ['2m', '10m', '45m', '6h', '1d'],
+    ['1h', '1w', '1M', '90s'],
+])
+@pytest.mark.parametrize('limit', [50, 150, 500])
+def test_plan_covers_every_timeframe_once_within_the_bar_cap(tfs, limit):
+    plan = plan_timeframes(tfs, limit)
+    members = [tf for group in plan.values() for tf in group]
+    assert sorted(members) == sorted(set(tfs))
+    for base, group in plan.items():
+        if group == [base]:
+            continue
+        assert base in RESAMPLE_BASES
+        b = fixed_timeframe_seconds(base)
+        for tf in group:
+            s = fixed_timeframe_seconds(tf)
+            assert s is not None and s % b == 0
+            assert limit * (s // b) <= 1000
+
+
+def test_resampling_can_be_disabled(monkeypatch):
+    monkeypatch.setenv('OHLCV_RESAMPLE', '0')
+    assert plan_timeframes(['1m', '5m']) == {'1m': ['1m'], '5m': ['5m']}
+
+
+def test_bar_cap_is_configurable(monkeypatch):
+    monkeypatch.setenv('OHLCV_RESAMPLE_MAX_BARS', '150')
+    assert plan_timeframes(['1m', '5m'], limit=150) == {'1m': ['1m'], '5m': ['5m']}
+
+
+# --- candle_buffer.resample ---
+
+@pytest.mark.parametrize('base_ms, period_ms', [
+    (60_000, 5 * 60_000), (60_000, 15 * 60_000), (5 * 60_000, 3_600_000),
+    (3_600_000, 4 * 3_600_000), (4 * 3_600_000, 86_400_000),
+])
+@pytest.mark.parametrize('offset_bars', [0, 1, 7])
+def test_resample_matches_pandas(base_ms, period_ms, offset_bars):
+    start = 1_700_000_000_000 // period_ms * period_ms + offset_bars * base_ms
+    win = _window(500, base_ms, start, seed=offset_bars)
+    got = resample(win, period_ms)
+    want = _pandas_resample(win, period_ms)
+    assert len(got) == len(want)
+    np.testing.assert_array_equal(got.ts, want.index.as_unit('ms').asi8)
+    for col in ('Open', 'High', 'Low', 'Close', 'Volume'):
+        np.testing.assert_allclose(got[col], want[col].to_numpy())
+
+
+def test_resample_buckets_are_epoch_aligned_and_drop_the_partial_lead():
+    period = 5 * 60_000
+    start = 1_700_000_000_000 // period * period + 2 * 60_000  # mid-bucket
+    got = resample(_window(23, 60_000, start), period)
+    assert np.all(got.ts % period == 0)
+    assert got.ts[0] == start - 2 * 60_000 + period
+    assert len(got) == 4  # the 20 bars after the 3-bar lead
+
+
+def test_resample_empty_and_single_partial_bucket():
+    assert len(resample(_window(0, 60_000, 0), 300_000)) == 0
+    assert len(resample(_window(3, 60_000, 60_000), 300_000)) == 0
@@ -0,0 +1,141 @@
+"""Candle replay through the stream engine, and the stub Telegram transport
+(services/stream.py, services/notifier.py).
+
+Run from the repo root: python -m pytest tests
+"""
+
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from app.models import candles, db
+from app.services import notifier
+from app.services.data import _synthetic_df
+from app.services.features import FeatureState
+from app.services.stream import ReplayFeed, StreamEngine, replay_scan
+
+PAIR = ('BTC/USDT', '5m')
+STEP_MS = 5 * 60_000
+START_MS = 1_700_000_000_000 // STEP_MS * STEP_MS
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """Scratch events and candle databases, with 200 5m candles stored for PAIR."""
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'events.sqlite'))
+    monkeypatch.setattr(candles, 'OHLCV_DB_PATH', str(tmp_path / 'ohlcv.sqlite'))
+    monkeypatch.setattr(candles, '_initialized', False)
+    db.reset_connections()
+    candles.reset_candle_connections()
+    db.init_db()
+    df = _synthetic_df(PAIR[0], PAIR[1], 200)
+    ts = START_MS + STEP_MS * np.arange(len(df), dtype=np.int64)
+    rows = [(int(t), o, h, l, c, v) for t, o, h, l, c, v in
+            zip(ts, df['Open'], df['High'], df['Low'], df['Close'], df['Volume'])]
+    candles.upsert_candles('binance', *PAIR, rows)
+    yield tmp_path, ts
+    db.reset_connections()
+    candles.reset_candle_connections()
+
+
+def _replay(ts, db_path, scan=None, capacity=300):
+    feed = ReplayFeed(int(ts[50]), ex_id='binance', db_path=str(db_path))
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        engine = StreamEngine(feed, pool.submit, capacity=capacity, min_bars=20, scan=scan)
+        asyncio.run(engine.run([PAIR]))
+        engine.drain()
+    return engine
+
+
+def _replay_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(
+            "SELECT bar_time, pattern_name, score, status FROM replay_events ORDER BY bar_time"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def test_replay_scores_every_bar_into_the_replay_db(stores):
+    tmp, ts = stores
+    _replay(ts, tmp / 'replay.sqlite')
+    rows = _replay_rows(tmp / 'replay.sqlite')
+    assert len(rows) == 150  # every replayed bar, none of the seeded history
+    assert rows[0][0] == np.datetime64(int(ts[50]), 'ms').astype(object).strftime('%Y-%m-%d %H:%M:%S')
+    assert db.get_conn().execute("SELECT COUNT(*) FROM events").fetchone()[0] == 0
+
+
+def test_feature_state_follows_the_stream(stores):
+    tmp, ts = stores
+    engine = _replay(ts, tmp / 'replay.sqlite')
+    want = FeatureState.from_data(engine.buffers[PAIR].window())
+    got = engine.features[PAIR]
+    assert got.count == want.count == 200
+    assert got.last_seen == want.last_seen
+    np.testing.assert_equal(got.latest, want.latest)
+
+
+def test_incremental_rule_scores_match_a_full_rescan(stores):
+    tmp, ts = stores
+    _replay(ts, tmp / 'replay.sqlite')
+
+    def rescan(symbol, timeframe, df, features=None):
+        return replay_scan(str(tmp / 'rescan.sqlite'), symbol, timeframe, df)
+
+    _replay(ts, tmp / 'rescan.sqlite', scan=rescan)
+    assert _replay_rows(tmp / 'replay.sqlite') == _replay_rows(tmp / 'rescan.sqlite')
+
+
+def test_replay_alerts_go_to_the_stub_log(tmp_path, monkeypatch):
+    from app.services import scanner
+    monkeypatch.setattr(scanner, 'score_window', lambda s, tf, df, features=None: ('P', 0.9, 0.7, '2026-01-01 00:00:00'))
+    path = tmp_path / 'replay.sqlite'
+    assert replay_scan(str(path), *PAIR, None) == ('P', 0.9, 0.7, None)
+    logged = [json.loads(line) for line in (tmp_path / 'replay.alerts.jsonl').read_text().splitlines()]
+    assert len(logged) == 1 and 'BTC/USDT 5m 2026-01-01 00:00:00 | P' in logged[0]['items'][0]['text']
+    assert _replay_rows(path) == [('2026-01-01 00:00:00', 'P', 0.9, 'sent')]
+
+
+# --- notifier stub transport ---
+
+@pytest.fixture
+def stub(monkeypatch):
+    monkeypatch.setenv('TELEGRAM_TRANSPORT', 'stub')
+    monkeypatch.setenv('TELEGRAM_CHAT_ID', '42')
+    monkeypatch.setenv('TELEGRAM_BATCH_WINDOW_MS', '200')
+    monkeypatch.setenv('TELEGRAM_CHAT_RATE', '1000')
+    transport = notifier.StubTransport()
+    monkeypatch.setattr(notifier, '_transport', transport)
+    return transport
+
+
+def test_stub_transport_coalesces_text_alerts_into_a_digest(stub):
+    assert all(notifier.send_telegram_alert(f"alert {i}") for i in range(3))
+    assert notifier.flush_notifications(timeout=10)
+    assert [s['kind'] for s in stub.sent] == ['message']
+    assert stub.sent[0]['chat_id'] == '42'
+    assert stub.sent[0]['items'][0]['text'].splitlines() == ['alert 0', 'alert 1', 'alert 2']
+
+
+def test_stub_transport_groups_photos(stub, tmp_path):
+    paths = []
+    for i in range(2):
+        p = tmp_path / f"{i}.png"
+        p.write_bytes(b'png')
+        paths.append(str(p))
+    for i, p in enumerate(paths):
+        notifier.send_telegram_alert(f"alert {i}", image_path=p)
+    assert notifier.flush_notifications(timeout=10)
+    assert [s['kind'] for s in stub.sent] == ['media_group']
+    assert [it['photo'] for it in stub.sent[0]['items']] == paths
+
+
+def test_alerts_are_dropped_without_a_chat(stub, monkeypatch):
+    monkeypatch.delenv('TELEGRAM_CHAT_ID')
+    assert notifier.send_telegram_alert("nowhere") is False
+    assert stub.sent == []